@@ -0,0 +1,112 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+DEFAULT_CACHE = ".analysis_cache.sqlite"
+
+
+def hash_file(path) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(content_hash: str, model: str, prompt: str, template_version, extra: str = "") -> str:
+    """Combine an image content hash with everything else that determines the model's answer."""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    material = "\n".join([content_hash, model, prompt_hash, str(template_version), extra])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """Content-addressed cache of image analyses stored in SQLite.
+
+    Entries are keyed by `make_cache_key`, so renamed or duplicated image files
+    hit the same entry while a changed prompt, model or template version misses.
+    Eviction drops entries older than `max_age_days`, then the least recently
+    used entries until the cache fits `max_entries` and `max_bytes`.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE, max_entries: int = None,
+                 max_bytes: int = None, max_age_days: float = None):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, analysis TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the cached analysis for `key`, or None on a miss."""
+        row = self.conn.execute("SELECT analysis, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.max_age and now - row[1] > self.max_age):
+            self.misses += 1
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, analysis: Dict):
+        payload = json.dumps(analysis, ensure_ascii=False)
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, analysis, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload.encode("utf-8")), now, now),
+            )
+
+    def evict(self) -> int:
+        """Apply the age, entry count and size limits and return the number of entries removed."""
+        removed = 0
+        with self.conn:
+            if self.max_age:
+                removed += self.conn.execute(
+                    "DELETE FROM cache WHERE created_at < ?", (time.time() - self.max_age,)
+                ).rowcount
+            if self.max_entries is not None:
+                removed += self.conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC "
+                    "LIMIT -1 OFFSET ?)", (self.max_entries,)
+                ).rowcount
+            if self.max_bytes is not None:
+                total = 0
+                stale = []
+                for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY accessed_at DESC"):
+                    total += size
+                    if total > self.max_bytes:
+                        stale.append((key,))
+                self.conn.executemany("DELETE FROM cache WHERE key = ?", stale)
+                removed += len(stale)
+        return removed
+
+    def stats(self) -> Dict:
+        entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        self.conn.close()
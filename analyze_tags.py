@@ -1,21 +1,89 @@
+import argparse
 import json
 import os
-from openai import OpenAI
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict
 from datetime import datetime
-from dotenv import load_dotenv
 from pathlib import Path
+from result_store import DEFAULT_STORE, LEGACY_JSON, load_analysis
+from pattern_mining import mine_item_matrix, mine_patterns
+from tag_columns import TagColumns
+from pattern_shards import DEFAULT_SHARD_CACHE, ShardSummaryCache, compact_serialize, shard_records
+from pattern_aggregates import DEFAULT_AGGREGATES, PatternAggregates
+from metrics import add_metrics_arguments, metrics, start_metrics
+
+DEFAULT_REPORT_CACHE = ".pattern_report_cache"
+
+# Model writing the narratives and merged reports
+REPORT_MODEL = "o1-preview"
+
+# Part of every report cache key; bump whenever a report prompt changes
+REPORT_CACHE_VERSION = 1
+
+# Map step of the sharded analysis; kept constant so shard summaries can be cached
+SHARD_PROMPT = """As a senior knitwear merchandising analyst, you are given one shard of Shopbop sweater
+analyses. The data lists every attribute path once in "fields"; each row is an image path
+followed by {field index: value}.
+
+Find style combinations (groups of 2-4 attributes such as silhouette, neckline, knit pattern,
+color) that appear in at least 2 products of this shard. Do not invent combinations.
+
+Respond with JSON only:
+{"products": <number of rows>,
+ "combinations": [{"attributes": ["..."], "count": <products in this shard>, "images": ["<image path>", ...]}],
+ "notable_elements": [{"element": "...", "count": <products>}]}
+
+Shard data:
+"""
+
+REDUCE_PROMPT = """As a senior knitwear merchandising analyst, merge these per-shard summaries of Shopbop
+sweater listings ({products} products in total) into one report.
+
+Important:
+- Combine combinations that describe the same attributes and add up their counts
+- Only report combinations with a merged count of at least 3
+- Do not invent combinations, counts or images
+- Include actual images for each pattern identified "![Product Name](image_url)", using the image paths given
+
+Format your response in markdown with these sections:
+1. Top Style Combinations (minimum 3 occurrences)
+2. Premium Style Patterns (verified high-price combinations)
+3. Trending Design Combinations (with clear visual evidence)
+
+For each pattern include:
+- Detailed description of combined attributes
+- Number of occurrences in data
+- the relevant images with the formatting "![Product Name](image_url)"
+- Brief explanation of why this represents a true pattern
+
+Shard summaries:
+{summaries}"""
+
+def product_name(image_key: str) -> str:
+    """Readable product name from an image path like shopbop_images/Brand_Name_page1.jpg."""
+    stem = re.sub(r'_page\d+(_\d+)?$', '', Path(image_key).stem)
+    return stem.replace('_', ' ')
 
 class ShopbopPatternAnalyzer:
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key: str = None):
+        # Without a key only the local mining and report formatting are available
+        self.client = None
+        if api_key:
+            from openai import OpenAI
+            self.client = OpenAI(api_key=api_key)
         self.images_dir = Path("shopbop_images")
         
+    def complete(self, stage: str, model: str, **request) -> str:
+        """Send one chat completion, timed as `stage`, and record its token usage and cost."""
+        with metrics.timer(stage, model=model):
+            response = self.client.chat.completions.create(model=model, **request)
+        metrics.record_usage(getattr(response, "usage", None), model, stage=stage)
+        return response.choices[0].message.content
+
     def load_json_data(self, file_path: str) -> Dict:
-        """Load Shopbop JSON data file."""
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-            return data
+        """Load Shopbop analysis data from a legacy JSON file or a result store."""
+        return load_analysis(file_path)
 
     def analyze_patterns(self, data: Dict) -> str:
         """Analyze common style combinations and patterns in the sweater/knit data."""
@@ -62,14 +130,171 @@ class ShopbopPatternAnalyzer:
         {json.dumps(data, indent=2)}
         """
 
-        response = self.client.chat.completions.create(
-            model="o1-preview",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        
-        return response.choices[0].message.content
+        return self.complete("report_api", REPORT_MODEL, messages=[{"role": "user", "content": prompt}])
+
+    def summarize_shard(self, shard_text: str, model: str = "gpt-4o") -> str:
+        """Map step: summarize the combinations found in one shard as JSON."""
+        return self.complete("shard_api", model, messages=[{"role": "user", "content": SHARD_PROMPT + shard_text}],
+                             response_format={"type": "json_object"})
+
+    def analyze_patterns_sharded(self, data: Dict, token_budget: int = 20000, concurrency: int = 4,
+                                 map_model: str = "gpt-4o", cache_dir: str = DEFAULT_SHARD_CACHE) -> str:
+        """Analyze patterns in token-budgeted shards concurrently, then merge the shard summaries.
+
+        Shard summaries are cached by content, so after adding products only the
+        shards containing them are sent to the model again.
+        """
+        cache = ShardSummaryCache(cache_dir)
+        shard_texts = [compact_serialize(shard) for shard in shard_records(data, token_budget)]
+        keys = [cache.key(text, map_model, SHARD_PROMPT) for text in shard_texts]
+        summaries = [cache.get(key) for key in keys]
+        missing = [n for n, summary in enumerate(summaries) if summary is None]
+        print(f"Analyzing {len(missing)} of {len(shard_texts)} shards ({cache.hits} cached)")
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = {pool.submit(self.summarize_shard, shard_texts[n], map_model): n for n in missing}
+            for future in as_completed(futures):
+                n = futures[future]
+                summaries[n] = future.result()
+                cache.put(keys[n], summaries[n])
+
+        prompt = REDUCE_PROMPT.format(products=len(data), summaries="\n".join(summaries))
+        return self.complete("report_api", REPORT_MODEL, messages=[{"role": "user", "content": prompt}])
+
+    def mine_patterns(self, data: Dict, min_support: int = 3, max_size: int = 3) -> Dict:
+        """Count frequent attribute combinations locally so every reported number is verified."""
+        return mine_patterns(data, min_support=min_support, max_size=max_size)
+
+    def mine_patterns_from_columns(self, columns_dir: str, min_support: int = 3, max_size: int = 3) -> Dict:
+        """Same as mine_patterns, reading a compiled tag column store instead of parsing JSON."""
+        product_keys, items, matrix = TagColumns(columns_dir).item_matrix(min_count=min_support)
+        return mine_item_matrix(product_keys, items, matrix, min_support=min_support, max_size=max_size)
+
+    def mine_patterns_from_aggregates(self, aggregates: PatternAggregates, min_support: int = 3,
+                                      max_size: int = 3) -> Dict:
+        """Same as mine_patterns, from the item sets kept by the running aggregates."""
+        product_keys, items, matrix = aggregates.item_matrix(min_count=min_support)
+        return mine_item_matrix(product_keys, items, matrix, min_support=min_support, max_size=max_size)
 
-    def generate_report(self, analysis: str, output_file: str = None):
+    def narrate_patterns(self, patterns: Dict) -> str:
+        """Ask the LLM to describe precomputed combinations without recounting anything."""
+        combinations = [
+            {
+                "attributes": combo["items"],
+                "occurrences": combo["count"],
+                "images": [f"![{product_name(key)}]({key})" for key in combo["products"][:5]],
+            }
+            for combo in patterns["combinations"]
+        ]
+        prompt = f"""
+        As a senior knitwear merchandising analyst, write a short narrative for each of these
+        verified style combinations found in {patterns["products"]} Shopbop sweater listings.
+
+        Important:
+        - The occurrence counts below were computed from the data; quote them exactly
+        - Do not add, merge or invent combinations, attributes or counts
+        - Include the listed images for each combination exactly as given
+
+        Format your response in markdown with these sections:
+        1. Top Style Combinations
+        2. Premium Style Patterns
+        3. Trending Design Combinations
+
+        Verified Combinations:
+        {json.dumps(combinations, separators=(',', ':'))}
+
+        Frequently Co-occurring Attribute Pairs (count, lift):
+        {json.dumps(patterns["pairs"], separators=(',', ':'))}
+        """
+
+        return self.complete("report_api", REPORT_MODEL, messages=[{"role": "user", "content": prompt}])
+
+    def narrate_delta(self, delta: Dict) -> str:
+        """Ask the LLM to describe only what shifted since the previous snapshot."""
+        prompt = f"""
+        As a senior knitwear merchandising analyst, describe how the Shopbop sweater assortment
+        shifted since the previous report ({delta["products_before"]} -> {delta["products_after"]} products,
+        {len(delta["added"])} added, {len(delta["removed"])} removed, {len(delta["changed"])} re-analyzed).
+
+        Important:
+        - The counts below were computed from the data; quote them exactly
+        - Only describe the changes listed; do not restate the full assortment
+
+        Format your response in markdown with these sections:
+        1. Rising Attributes
+        2. Fading Attributes
+        3. New and Fading Combinations
+
+        Attribute changes (count before, after, change in share of products):
+        {json.dumps(delta["item_changes"], separators=(',', ':'))}
+
+        Pairs newly seen in at least {delta["min_support"]} products:
+        {json.dumps(delta["emerging_pairs"], separators=(',', ':'))}
+
+        Pairs no longer seen in {delta["min_support"]} products:
+        {json.dumps(delta["fading_pairs"], separators=(',', ':'))}
+        """
+
+        return self.complete("report_api", REPORT_MODEL, messages=[{"role": "user", "content": prompt}])
+
+    def format_delta(self, delta: Dict) -> str:
+        """Render the changes since the previous snapshot as markdown tables."""
+        since = delta["since"][:19].replace("T", " ") if delta["since"] else "an empty catalog"
+        lines = [
+            "## What Changed",
+            "",
+            f"*Since {since}: {delta['products_before']} -> {delta['products_after']} products, "
+            f"{len(delta['added'])} added, {len(delta['removed'])} removed, {len(delta['changed'])} re-analyzed*",
+            "",
+        ]
+        if not (delta["item_changes"] or delta["added"] or delta["removed"] or delta["changed"]):
+            return "\n".join(lines + ["No changes.", ""])
+        lines += [
+            "| Attribute | Before | After | Share Change |",
+            "|---|---|---|---|",
+        ]
+        for change in delta["item_changes"]:
+            lines.append(f"| {change['item']} | {change['before']} | {change['after']} | "
+                         f"{change['share_change']:+.1%} |")
+        for title, pairs in (("Emerging Pairs", delta["emerging_pairs"]), ("Fading Pairs", delta["fading_pairs"])):
+            lines += ["", f"### {title}", ""]
+            if not pairs:
+                lines.append("None.")
+                continue
+            lines += ["| Attribute A | Attribute B | Before | After |", "|---|---|---|---|"]
+            for pair in pairs:
+                lines.append(f"| {pair['items'][0]} | {pair['items'][1]} | {pair['before']} | {pair['after']} |")
+        if delta["added"]:
+            lines += ["", "### New Products", ""]
+            lines += [f"- ![{product_name(key)}]({key})" for key in delta["added"][:20]]
+        return "\n".join(lines) + "\n"
+
+    def format_patterns(self, patterns: Dict) -> str:
+        """Render mined combinations and co-occurrences as markdown tables."""
+        lines = [
+            "## Verified Combination Counts",
+            "",
+            f"*{patterns['products']} products, {patterns['items']} attribute values seen at least "
+            f"{patterns['min_support']} times*",
+            "",
+            "| Combination | Occurrences | Support | Examples |",
+            "|---|---|---|---|",
+        ]
+        for combo in patterns["combinations"]:
+            examples = " ".join(f"![{product_name(key)}]({key})" for key in combo["products"][:3])
+            lines.append(f"| {'<br>'.join(combo['items'])} | {combo['count']} | {combo['support']:.0%} | {examples} |")
+        lines += [
+            "",
+            "### Attribute Pairs by Lift",
+            "",
+            "| Attribute A | Attribute B | Co-occurrences | Lift |",
+            "|---|---|---|---|",
+        ]
+        for pair in patterns["pairs"]:
+            lines.append(f"| {pair['items'][0]} | {pair['items'][1]} | {pair['count']} | {pair['lift']} |")
+        return "\n".join(lines) + "\n"
+
+    def generate_report(self, analysis: str, output_file: str = None, patterns: Dict = None, delta: Dict = None):
         """Generate a formatted markdown report with the pattern analysis."""
         if output_file is None:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -82,15 +307,30 @@ class ShopbopPatternAnalyzer:
 
 """
 
+        sections = []
+        if delta:
+            sections.append("- [What Changed](#what-changed)")
+            if analysis:
+                sections += [
+                    "- [Rising Attributes](#rising-attributes)",
+                    "- [Fading Attributes](#fading-attributes)",
+                    "- [New and Fading Combinations](#new-and-fading-combinations)",
+                ]
+        elif analysis:
+            sections += [
+                "- [Top Style Combinations](#top-style-combinations)",
+                "- [Premium Style Patterns](#premium-style-patterns)",
+                "- [Trending Design Combinations](#trending-design-combinations)",
+            ]
+        if patterns:
+            sections.append("- [Verified Combination Counts](#verified-combination-counts)")
         table_of_contents = """
 ## Table of Contents
-- [Top Style Combinations](#top-style-combinations)
-- [Premium Style Patterns](#premium-style-patterns)
-- [Trending Design Combinations](#trending-design-combinations)
+{}
 
 ---
 
-"""
+""".format("\n".join(sections))
 
         footer = """
 *Generated by Shopbop Pattern Analyzer AI*
@@ -104,31 +344,122 @@ class ShopbopPatternAnalyzer:
         with open(output_file, 'w') as f:
             f.write(header)
             f.write(table_of_contents)
+            if delta:
+                f.write(self.format_delta(delta))
+                f.write("\n")
             f.write(analysis)
+            if patterns:
+                f.write("\n\n")
+                f.write(self.format_patterns(patterns))
             f.write(footer)
             
         return output_file
 
-def main():
+def cached_report(cache, key, generate) -> str:
+    """Return the report cached under `key`, or generate and cache it."""
+    if cache is not None:
+        report = cache.get(key)
+        if report is not None:
+            print("Aggregates unchanged since this report was written; using the cached report")
+            return report
+    report = generate()
+    if cache is not None:
+        cache.put(key, report)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Identify style patterns across analyzed Shopbop products")
+    parser.add_argument('--mode', choices=['mined', 'llm', 'sharded', 'delta'], default='mined',
+                        help="'mined' counts combinations locally and only asks the LLM to narrate them; "
+                             "'llm' sends the whole dataset to the LLM; "
+                             "'sharded' sends token-budgeted shards concurrently and merges the summaries; "
+                             "'delta' reports only what shifted since the previous report")
+    parser.add_argument('--shard-tokens', type=int, default=20000,
+                        help="Token budget per shard in sharded mode")
+    parser.add_argument('--shard-concurrency', type=int, default=4,
+                        help="Shards summarized in parallel in sharded mode")
+    parser.add_argument('--min-support', type=int, default=3,
+                        help="Minimum number of products a combination must appear in")
+    parser.add_argument('--max-size', type=int, default=3,
+                        help="Maximum number of attributes in a combination")
+    parser.add_argument('--columns', metavar='DIR',
+                        help="Mine from a compiled tag column store (see tag_columns.py) instead of the JSON results")
+    parser.add_argument('--no-llm', action='store_true',
+                        help="Write the verified combination tables without an LLM narrative")
+    parser.add_argument('--aggregates', default=DEFAULT_AGGREGATES,
+                        help="Running attribute and co-occurrence counts, updated from new or changed results")
+    parser.add_argument('--report-cache', default=DEFAULT_REPORT_CACHE,
+                        help="Directory caching LLM reports by the state of the aggregates")
+    parser.add_argument('--no-report-cache', action='store_true',
+                        help="Always ask the LLM for a fresh report")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    start_metrics(args)
+
+    from dotenv import load_dotenv
     load_dotenv()
     
     api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
+    if not api_key and not args.no_llm:
         raise ValueError("Please set the OPENAI_API_KEY environment variable")
     
     analyzer = ShopbopPatternAnalyzer(api_key)
+    aggregates = PatternAggregates(args.aggregates)
+    report_cache = None if args.no_report_cache else ShardSummaryCache(args.report_cache)
     
     try:
-        data = analyzer.load_json_data('shopbop_analysis.json')
-        analysis = analyzer.analyze_patterns(data)
+        patterns = None
+        delta = None
+        data_file = DEFAULT_STORE if os.path.exists(DEFAULT_STORE) else LEGACY_JSON
+        if os.path.exists(data_file):
+            changes = aggregates.update_from(data_file)
+            print(f"Aggregates: {changes['added']} added, {changes['changed']} changed, "
+                  f"{changes['removed']} removed, {changes['unchanged']} unchanged products")
+        digest = aggregates.digest()
+
+        def report_key(*params):
+            return ShardSummaryCache.key(";".join(map(str, (args.mode, *params, digest))), REPORT_MODEL,
+                                         f"report v{REPORT_CACHE_VERSION}")
+
+        if args.mode == 'llm':
+            analysis = cached_report(report_cache, report_key(),
+                                     lambda: analyzer.analyze_patterns(analyzer.load_json_data(data_file)))
+        elif args.mode == 'sharded':
+            analysis = cached_report(report_cache, report_key(args.shard_tokens),
+                                     lambda: analyzer.analyze_patterns_sharded(
+                                         analyzer.load_json_data(data_file), token_budget=args.shard_tokens,
+                                         concurrency=args.shard_concurrency))
+        elif args.mode == 'delta':
+            previous = aggregates.previous_snapshot()
+            delta = aggregates.delta(previous, min_support=args.min_support)
+            analysis = "" if args.no_llm else cached_report(
+                report_cache, report_key(args.min_support, previous and previous["digest"]),
+                lambda: analyzer.narrate_delta(delta))
+        elif args.columns:
+            patterns = analyzer.mine_patterns_from_columns(args.columns, min_support=args.min_support,
+                                                           max_size=args.max_size)
+            analysis = "" if args.no_llm else analyzer.narrate_patterns(patterns)
+        else:
+            patterns = analyzer.mine_patterns_from_aggregates(aggregates, min_support=args.min_support,
+                                                              max_size=args.max_size)
+            analysis = "" if args.no_llm else cached_report(
+                report_cache, report_key(args.min_support, args.max_size),
+                lambda: analyzer.narrate_patterns(patterns))
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = f"shopbop_style_patterns_{timestamp}.md"
-        output_file = analyzer.generate_report(analysis, output_file)
+        output_file = analyzer.generate_report(analysis, output_file, patterns=patterns, delta=delta)
+        # The baseline of the next delta report
+        aggregates.snapshot()
         print(f"Analysis complete! Style pattern report generated: {output_file}")
         
     except Exception as e:
         print(f"Error during analysis: {str(e)}")
 
+    finally:
+        aggregates.close()
+        print(metrics.format_summary())
+        metrics.close()
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
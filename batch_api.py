@@ -0,0 +1,103 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# OpenAI Batch API input file limits
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+
+def make_batch_line(custom_id: str, body: Dict) -> str:
+    """Serialize one request in the Batch API input format."""
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": body,
+    }, ensure_ascii=False) + "\n"
+
+
+def export_batch_requests(requests: Iterable[Tuple[str, Dict]], output_dir: str,
+                          max_requests: int = MAX_BATCH_REQUESTS,
+                          max_bytes: int = MAX_BATCH_BYTES,
+                          prefix: str = "batch_requests") -> List[str]:
+    """Write (custom_id, body) pairs to numbered JSONL files, starting a new file at either limit."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    current = None
+    count = size = 0
+    try:
+        for custom_id, body in requests:
+            line = make_batch_line(custom_id, body).encode("utf-8")
+            if len(line) > max_bytes:
+                logger.error("Request %s is larger than the batch file limit, skipping", custom_id)
+                continue
+            if current is None or count >= max_requests or size + len(line) > max_bytes:
+                if current is not None:
+                    current.close()
+                path = output_dir / f"{prefix}_{len(files) + 1:04d}.jsonl"
+                current = open(path, "wb")
+                files.append(str(path))
+                count = size = 0
+            current.write(line)
+            count += 1
+            size += len(line)
+    finally:
+        if current is not None:
+            current.close()
+    return files
+
+
+def read_batch_results(results_file: str) -> Iterator[Tuple[str, Optional[Dict], Optional[str]]]:
+    """Yield (custom_id, analysis, error) for each line of a Batch API output or error file."""
+    with open(results_file, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.error("Malformed line %d in %s", line_number, results_file)
+                continue
+            custom_id = entry.get("custom_id")
+            if entry.get("error"):
+                yield custom_id, None, json.dumps(entry["error"])
+                continue
+            response = entry.get("response") or {}
+            if response.get("status_code") != 200:
+                yield custom_id, None, f"status code {response.get('status_code')}"
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                yield custom_id, json.loads(content), None
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                yield custom_id, None, f"unparseable response: {e}"
+
+
+def ingest_batch_results(results_file: str, store, make_record) -> Dict:
+    """Merge a Batch API results file into `store`, matching requests by custom_id.
+
+    A result `make_record` rejects (e.g. an invalid structured answer) counts as
+    failed, like a failed request; the rest of the file is still ingested.
+    """
+    counts = {"ingested": 0, "failed": 0}
+    for custom_id, analysis, error in read_batch_results(results_file):
+        if analysis is None:
+            logger.error("Batch request %s failed: %s", custom_id, error)
+            counts["failed"] += 1
+            continue
+        try:
+            record = make_record(Path(custom_id), analysis)
+        except Exception as e:
+            logger.error("Batch result %s could not be stored: %s", custom_id, e)
+            counts["failed"] += 1
+            continue
+        store.put(custom_id, record)
+        counts["ingested"] += 1
+    return counts
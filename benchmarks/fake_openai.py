@@ -0,0 +1,222 @@
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from canonicalize import canonicalize
+from result_store import load_analysis
+from structured_output import FIELDS, VOCABULARY
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_RECORDINGS = REPO_ROOT / "shopbop_analysis.json"
+DEFAULT_IMAGES_DIR = REPO_ROOT / "shopbop_images"
+
+# Billed image tokens by detail level, as in image_preprocess.estimate_image_tokens for a typical shot
+IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+# The provider caches prompt prefixes in blocks of this many tokens
+CACHE_BLOCK_TOKENS = 128
+
+NARRATIVE = """## Top Style Combinations
+
+Recorded stand-in narrative: the benchmark server does not write real reports. The
+combinations below are the verified tables that follow this text, restated in prose so the
+report has a realistic length.
+
+""" + "\n".join(f"- Combination {n}: ribbed crew necks in cream with relaxed silhouettes." for n in range(1, 21))
+
+SHARD_SUMMARY = json.dumps({"products": 0, "combinations": [], "notable_elements": []})
+
+
+def structured_codes(analysis: Dict, properties: Dict) -> Dict[str, List[int]]:
+    """A free-form analysis as the {short key: [codes]} answer of --output structured."""
+    canonical = canonicalize(analysis)
+    codes = {}
+    for key in properties:
+        options = VOCABULARY.leaves[FIELDS[key]]
+        codes[key] = [options.index(value) for value in canonical.get(FIELDS[key], []) if value in options]
+    return codes
+
+
+class FakeOpenAI:
+    """Local stand-in for the OpenAI chat completions endpoint.
+
+    Image analysis requests are answered with the analyses recorded in
+    shopbop_analysis.json: an image whose bytes match a bundled image gets that
+    image's analysis, any other image the next recording in turn. Free-form,
+    structured and multi-image requests get answers in their layout; report
+    and shard requests get a canned narrative or an empty shard summary. Each
+    request waits `latency` seconds plus `latency_per_image` per image, and
+    every `rate_limit_every`-th request is refused with a 429 and a retry-after
+    of `retry_after` seconds. Usage is estimated from the request size.
+    """
+
+    def __init__(self, recordings=DEFAULT_RECORDINGS, images_dir=DEFAULT_IMAGES_DIR, latency: float = 0.0,
+                 latency_per_image: float = 0.0, jitter: float = 0.0, rate_limit_every: int = 0,
+                 retry_after: float = 0.05, seed: int = 0):
+        data = load_analysis(str(recordings))
+        self.recordings = [record.get("analysis", record) for record in data.values()]
+        self.by_hash = {}
+        for key, record in data.items():
+            path = Path(images_dir) / Path(key).name
+            if path.exists():
+                self.by_hash[hashlib.sha256(path.read_bytes()).hexdigest()] = record.get("analysis", record)
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        self.jitter = jitter
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self._next_recording = itertools.cycle(range(len(self.recordings)))
+        self._prefixes = set()
+        self.stats = {"requests": 0, "rate_limited": 0, "images": 0, "recorded": 0}
+        self.server = None
+
+    def _analysis_for(self, image_url: str) -> Dict:
+        data = image_url.split(",", 1)[1] if image_url.startswith("data:") else ""
+        digest = hashlib.sha256(base64.b64decode(data)).hexdigest() if data else None
+        with self.lock:
+            if digest in self.by_hash:
+                self.stats["recorded"] += 1
+                return self.by_hash[digest]
+            return self.recordings[next(self._next_recording)]
+
+    def _answer(self, body: Dict) -> Tuple[str, int, int, int]:
+        """(content, prompt tokens, cached prompt tokens, images) for a chat completion request."""
+        content = body["messages"][-1]["content"]
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        texts = [part["text"] for part in parts if part["type"] == "text"]
+        images = [part["image_url"] for part in parts if part["type"] == "image_url"]
+        prompt_tokens = sum(len(text) for text in texts) // 4 + sum(IMAGE_TOKENS.get(image.get("detail"), 765)
+                                                                     for image in images)
+        # The leading text is the shared prompt; a repeat of it is served from the prompt cache
+        prefix = hashlib.sha256(texts[0].encode("utf-8")).hexdigest() if texts else None
+        with self.lock:
+            cached = 0
+            if prefix in self._prefixes:
+                cached = len(texts[0]) // 4 // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+            self._prefixes.add(prefix)
+            self.stats["images"] += len(images)
+
+        response_format = body.get("response_format") or {}
+        if not images:
+            answer = SHARD_SUMMARY if response_format.get("type") == "json_object" else NARRATIVE
+            return answer, prompt_tokens, cached, 0
+        analyses = [self._analysis_for(image["url"]) for image in images]
+        schema = response_format.get("json_schema", {}).get("schema")
+        ids = [match.group(1) for match in (re.match(r"Image (\S+)", text) for text in texts[1:]) if match]
+        if ids:
+            if schema is not None:
+                properties = schema["properties"]["results"]["items"]["properties"]["analysis"]["properties"]
+                analyses = [structured_codes(analysis, properties) for analysis in analyses]
+            answer = {"results": [{"id": image_id, "analysis": analysis}
+                                  for image_id, analysis in zip(ids, analyses)]}
+        elif schema is not None:
+            answer = structured_codes(analyses[0], schema["properties"])
+        else:
+            answer = analyses[0]
+        return json.dumps(answer), prompt_tokens, cached, len(images)
+
+    def handle(self, body: Dict) -> Tuple[int, Dict[str, str], Dict]:
+        """(status, headers, payload) for one request body."""
+        with self.lock:
+            self.stats["requests"] += 1
+            number = self.stats["requests"]
+            refused = self.rate_limit_every and number % self.rate_limit_every == 0
+            if refused:
+                self.stats["rate_limited"] += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if refused:
+            return 429, {"retry-after-ms": str(int(self.retry_after * 1000))}, {
+                "error": {"message": "Rate limit reached (injected by the benchmark server)",
+                          "type": "requests", "code": "rate_limit_exceeded"}}
+
+        content, prompt_tokens, cached, images = self._answer(body)
+        time.sleep(delay + self.latency_per_image * images)
+        completion_tokens = len(content) // 4
+        return 200, {}, {
+            "id": f"chatcmpl-benchmark-{number}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached}},
+        }
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve on a background thread; returns the base URL to give the OpenAI client."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.rstrip("/").endswith("/chat/completions"):
+                    status, headers, payload = fake.handle(body)
+                else:
+                    status, headers, payload = 404, {}, {"error": {"message": f"Unknown path {self.path}"}}
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}/v1"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded analyses on a local chat completions endpoint")
+    parser.add_argument('--port', type=int, default=8011)
+    parser.add_argument('--latency', type=float, default=0.5, help="Seconds before each response")
+    parser.add_argument('--latency-per-image', type=float, default=0.0, help="Extra seconds per image")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many extra seconds, at random")
+    parser.add_argument('--rate-limit-every', type=int, default=0, metavar='N',
+                        help="Refuse every Nth request with a 429")
+    parser.add_argument('--retry-after', type=float, default=0.05, help="Seconds asked for in injected 429s")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency, latency_per_image=args.latency_per_image, jitter=args.jitter,
+                      rate_limit_every=args.rate_limit_every, retry_after=args.retry_after)
+    url = fake.start(port=args.port)
+    print(f"Serving {len(fake.recordings)} recorded analyses at {url}")
+    print(f"Point the analyzer at it with OPENAI_BASE_URL={url} OPENAI_API_KEY=benchmark")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(json.dumps(fake.stats))
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+import argparse
+import contextlib
+import hashlib
+import html
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote
+
+from benchmarks.fake_openai import DEFAULT_IMAGES_DIR, REPO_ROOT, FakeOpenAI
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines.json"
+
+# A metric more than this share worse than its baseline fails the run
+DEFAULT_TOLERANCE = 0.25
+
+# Compared metric -> (higher is better, absolute change that is always noise). Every run processes the
+# same items, so wall time stands in for throughput. The settings below keep each timed section at a few
+# seconds, so scheduling noise stays well inside the tolerance and the floors only cover tiny values.
+COMPARED = {
+    "seconds": (False, 0.05),
+    "p95_seconds": (False, 0.05),
+    "peak_rss_mb": (False, 10.0),
+}
+
+# Everything that shapes the numbers; a baseline only applies to the same settings
+DEFAULT_CONFIG = {
+    "latency": 0.05,
+    "latency_per_image": 0.01,
+    "rate_limit_every": 10,
+    "retry_after": 0.05,
+    "concurrency": 8,
+    "images_per_request": 4,
+    "download_workers": 8,
+    "per_host_rate": 200.0,
+    "parse_repeat": 150,
+    # Downloads and the concurrent analyses get through the bundled images in about a second,
+    # so they download them this many times over and analyze this many copies
+    "download_rounds": 4,
+    "analyze_copies": 10,
+    "pattern_runs": 20,
+    "shard_tokens": 4000,
+}
+
+EXPECTED_IMAGES = len(list(DEFAULT_IMAGES_DIR.glob("*.jpg")))
+
+# Two bundled images are byte-identical; the downloader keeps one copy of identical content
+EXPECTED_DOWNLOADS = len({hashlib.sha256(path.read_bytes()).digest() for path in DEFAULT_IMAGES_DIR.glob("*.jpg")})
+
+
+def replay_listing(image_names, images_url: str) -> str:
+    """A listing page in the product tile markup of fixtures/listings, one tile per bundled image."""
+    tiles = []
+    for n, name in enumerate(image_names, 1):
+        title = html.escape(Path(name).stem.rsplit("_page", 1)[0].replace("_", " "))
+        tiles.append(f"""  <div class="product-tile">
+    <a class="product-title" href="/benchmark-product/vd/v=1/{n:010d}.htm">{title}</a>
+    <img class="product-image" src="{images_url}/{quote(name)}" alt="">
+    <span class="product-price">${100 + n}.00</span>
+  </div>""")
+    return ("<!DOCTYPE html>\n<html>\n<head><title>Sweaters | Shopbop</title></head>\n<body>\n"
+            "<div class=\"product-grid\">\n" + "\n".join(tiles) + "\n</div>\n</body>\n</html>\n")
+
+
+def bundled_images():
+    return sorted(path.name for path in DEFAULT_IMAGES_DIR.glob("*.jpg"))
+
+
+# Benchmarks. Each runs in a fresh interpreter inside an empty working directory
+# and returns its timed section's duration, item count and correctness checks.
+
+def bench_parse_listings(config):
+    from listing_parser import parse_listing
+    from metrics import metrics
+
+    pages = [path.read_text() for path in sorted((REPO_ROOT / "fixtures" / "listings").glob("*.html"))]
+    replay = replay_listing(bundled_images(), "http://images.invalid")
+    pages.append(replay)
+    started = time.perf_counter()
+    for _ in range(config["parse_repeat"]):
+        for page in pages:
+            with metrics.timer("parse_listing"):
+                parse_listing(page)
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "items": config["parse_repeat"] * len(pages), "unit": "pages",
+            "latency_stage": "parse_listing",
+            "checks": {"replayed products": (len(parse_listing(replay)), EXPECTED_IMAGES)}}
+
+
+def bench_download(config):
+    from download_images import scrape_listings
+
+    listing = replay_listing(bundled_images(), os.environ["BENCHMARK_IMAGES_URL"])
+    seconds, downloaded = 0.0, []
+    for n in range(config["download_rounds"]):
+        # Each round starts from an empty directory and manifest, so every image is downloaded again
+        round_dir = Path(f"round{n}")
+        (round_dir / "listings").mkdir(parents=True)
+        (round_dir / "listings" / "page1.html").write_text(listing)
+        os.chdir(round_dir)
+        try:
+            started = time.perf_counter()
+            scrape_listings(snapshot_dir="listings", workers=config["download_workers"],
+                            per_host_rate=config["per_host_rate"], manifest_path="download_manifest.sqlite")
+            seconds += time.perf_counter() - started
+            downloaded.append(len(list(Path("shopbop_images").glob("*.jpg"))))
+        finally:
+            os.chdir("..")
+    return {"seconds": seconds, "items": sum(downloaded), "unit": "images", "latency_stage": "download",
+            "checks": {"downloaded images": (downloaded, [EXPECTED_DOWNLOADS] * config["download_rounds"])}}
+
+
+def bench_analyze(config, use_async=False, images_per_request=1):
+    from image_to_tags import analyze_shopbop_images, get_async_client, get_client
+    from request_controller import RequestController
+    from result_store import open_result_store
+
+    copies = config["analyze_copies"] if use_async else 1
+    Path("shopbop_images").mkdir()
+    for n in range(copies):
+        # Without a cache or similarity index, every copy is analyzed again
+        for path in DEFAULT_IMAGES_DIR.glob("*.jpg"):
+            shutil.copyfile(path, Path("shopbop_images") / (f"copy{n}_{path.name}" if n else path.name))
+    # Importing openai takes most of a second; keep that one-off cost out of the per-image latencies
+    (get_async_client() if use_async else get_client()).chat.completions
+    controller = RequestController(base_delay=config["retry_after"],
+                                   concurrency=config["concurrency"] if use_async else 1)
+    started = time.perf_counter()
+    analyze_shopbop_images(use_async=use_async, concurrency=config["concurrency"], requests_per_minute=10 ** 6,
+                           tokens_per_minute=10 ** 9, store_path="shopbop_analysis.jsonl", controller=controller,
+                           images_per_request=images_per_request)
+    seconds = time.perf_counter() - started
+    store = open_result_store("shopbop_analysis.jsonl")
+    try:
+        stored = len(store)
+    finally:
+        store.close()
+    return {"seconds": seconds, "items": stored, "unit": "images", "latency_stage": "image",
+            "checks": {"stored results": (stored, copies * EXPECTED_IMAGES),
+                       "dead-lettered": (len(controller.failed_keys), 0)}}
+
+
+def bench_patterns(config, sharded=False):
+    from analyze_tags import ShopbopPatternAnalyzer
+    from metrics import metrics
+
+    analyzer = ShopbopPatternAnalyzer(os.environ["OPENAI_API_KEY"])
+    started = time.perf_counter()
+    products = 0
+    for run in range(config["pattern_runs"]):
+        with metrics.timer("patterns"):
+            with metrics.timer("load"):
+                data = analyzer.load_json_data(str(REPO_ROOT / "shopbop_analysis.json"))
+            if sharded:
+                with metrics.timer("sharded"):
+                    narrative = analyzer.analyze_patterns_sharded(data, token_budget=config["shard_tokens"],
+                                                                  cache_dir=f"shard_cache_{run}")
+                patterns = None
+            else:
+                with metrics.timer("mine"):
+                    patterns = analyzer.mine_patterns(data)
+                with metrics.timer("narrate"):
+                    narrative = analyzer.narrate_patterns(patterns)
+            with metrics.timer("report"):
+                analyzer.generate_report(narrative, f"report_{run}.md", patterns=patterns)
+        products += len(data)
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "items": products, "unit": "products", "latency_stage": "patterns",
+            "checks": {"reports written": (len(list(Path(".").glob("report_*.md"))), config["pattern_runs"])}}
+
+
+BENCHMARKS = {
+    "parse_listings": bench_parse_listings,
+    "download": bench_download,
+    "analyze_sync": partial(bench_analyze, use_async=False),
+    "analyze_async": partial(bench_analyze, use_async=True),
+    "analyze_batched": lambda config: bench_analyze(config, use_async=True,
+                                                    images_per_request=config["images_per_request"]),
+    "patterns": bench_patterns,
+    "patterns_sharded": partial(bench_patterns, sharded=True),
+}
+
+
+def run_child(name, config):
+    """Run one benchmark in this process and print its result as JSON."""
+    from metrics import metrics
+
+    # The scraper and report writer print progress; keep stdout for the result
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = BENCHMARKS[name](config)
+    failed = [f"{check}: got {got}, expected {expected}" for check, (got, expected) in result["checks"].items()
+              if got != expected]
+    if failed:
+        raise SystemExit(f"Benchmark {name} produced wrong results: " + "; ".join(failed))
+
+    stages = {stage: {"count": s["count"], "total": s["total"], "p50": s["p50"], "p95": s["p95"], "p99": s["p99"],
+                      "per_second": s["count"] / s["total"] if s["total"] else None}
+              for stage, s in metrics.summary()["stages"].items()}
+    latency = stages.get(result["latency_stage"], {})
+    print(json.dumps({
+        "items": result["items"],
+        "unit": result["unit"],
+        "seconds": result["seconds"],
+        "throughput": result["items"] / result["seconds"],
+        "latency_stage": result["latency_stage"],
+        "p50_seconds": latency.get("p50"),
+        "p95_seconds": latency.get("p95"),
+        "p99_seconds": latency.get("p99"),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin"
+                                                                            else 1024),
+        "stages": stages,
+        "counters": metrics.summary()["counters"],
+    }))
+
+
+@contextlib.contextmanager
+def image_host(directory):
+    """Serve `directory` over HTTP (with Last-Modified, so refreshes can be conditional)."""
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=str(directory)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="image-host", daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_benchmark(name, config, env):
+    with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as workdir:
+        process = subprocess.run([sys.executable, "-m", "benchmarks.run", "--child", name, "--config",
+                                  json.dumps(config)], cwd=workdir, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Benchmark {name} failed:\n{process.stderr.strip()[-3000:]}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def best_of(runs):
+    """The fastest of repeated runs, whole.
+
+    Noise on a quiet machine only ever slows a run down, so the fastest run is
+    the steadiest estimate; taking all of its numbers keeps p50 <= p95 <= p99.
+    """
+    return max(runs, key=lambda run: run["throughput"])
+
+
+def compare(results, baseline, tolerance):
+    """Regression messages for metrics more than `tolerance` worse than the baseline."""
+    regressions = []
+    for name, result in results.items():
+        recorded = baseline["benchmarks"].get(name)
+        if recorded is None:
+            print(f"{name}: no baseline recorded")
+            continue
+        for metric, (higher_is_better, slack) in COMPARED.items():
+            before, after = recorded.get(metric), result.get(metric)
+            if before is None or after is None or abs(after - before) <= slack:
+                continue
+            change = (after - before) / before if before else 0.0
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{name} {metric}: {before:.4g} -> {after:.4g} ({change:+.0%}, "
+                                   f"tolerance {tolerance:.0%})")
+    return regressions
+
+
+def print_results(results, show_stages=False):
+    print(f"{'benchmark':<18} {'items':>12} {'wall':>8} {'throughput':>18} {'p50':>8} {'p95':>8} {'p99':>8} "
+          f"{'peak RSS':>9}")
+    for name, r in results.items():
+        latencies = " ".join(f"{r[key]:7.3f}s" if r[key] is not None else f"{'-':>8}"
+                             for key in ("p50_seconds", "p95_seconds", "p99_seconds"))
+        print(f"{name:<18} {r['items']:>5} {r['unit']:<6} {r['seconds']:7.2f}s "
+              f"{r['throughput']:9.1f} {r['unit']:<6}/s {latencies} {r['peak_rss_mb']:6.0f} MB")
+        if show_stages:
+            for stage, s in sorted(r["stages"].items()):
+                print(f"    {stage:<22} n={s['count']:<6} total {s['total']:7.3f}s  p50 {s['p50']:.4f}s  "
+                      f"p95 {s['p95']:.4f}s  p99 {s['p99']:.4f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks of the scraper, analyzer and pattern analyzer against local stand-ins")
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark; the fastest one counts")
+    parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help="Baseline file to compare against")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="Record the results as the new baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Fail when a metric is worse than its baseline by more than this share")
+    parser.add_argument('--record', metavar='PATH', help="Append the results to a JSONL file to track them over time")
+    parser.add_argument('--stages', action='store_true', help="Also print every stage of every benchmark")
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value, dest=key)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, json.loads(args.config))
+
+    config = {key: getattr(args, key) for key in DEFAULT_CONFIG}
+    names = args.only or list(BENCHMARKS)
+    fake = FakeOpenAI(latency=config["latency"], latency_per_image=config["latency_per_image"],
+                      rate_limit_every=config["rate_limit_every"], retry_after=config["retry_after"])
+    results = {}
+    with image_host(DEFAULT_IMAGES_DIR) as images_url:
+        env = {**os.environ, "OPENAI_BASE_URL": fake.start(), "OPENAI_API_KEY": "benchmark",
+               "BENCHMARK_IMAGES_URL": images_url,
+               "PYTHONPATH": os.pathsep.join(filter(None, (str(REPO_ROOT), os.environ.get("PYTHONPATH"))))}
+        try:
+            for name in names:
+                results[name] = best_of([run_benchmark(name, config, env) for _ in range(max(1, args.repeat))])
+        finally:
+            fake.stop()
+    print_results(results, args.stages)
+    print(f"Fake API: {fake.stats['requests']} requests, {fake.stats['rate_limited']} refused with 429, "
+          f"{fake.stats['images']} images")
+
+    if args.record:
+        with open(args.record, "a") as f:
+            f.write(json.dumps({"timestamp": datetime.now().isoformat(), "python": sys.version.split()[0],
+                                "config": config, "benchmarks": results}) + "\n")
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else None
+    if args.update_baseline:
+        kept = baseline["benchmarks"] if baseline and baseline["config"] == config else {}
+        baseline_path.write_text(json.dumps({
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+            "config": config,
+            "benchmarks": {**kept, **{name: {key: value for key, value in result.items() if key != "stages"}
+                                      for name, result in results.items()}},
+        }, indent=2) + "\n")
+        print(f"Baseline written to {baseline_path}")
+        return 0
+    if baseline is None:
+        print(f"No baseline at {baseline_path}; record one with --update-baseline")
+        return 0
+    if baseline["config"] != config:
+        print(f"The baseline in {baseline_path} was recorded with different settings "
+              f"({baseline['config']}); rerun with them or record a new baseline with --update-baseline")
+        return 2
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nREGRESSION against the baseline of {baseline['recorded_at']} ({baseline['machine']}):")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"No regressions against the baseline of {baseline['recorded_at']} ({baseline['machine']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
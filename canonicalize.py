@@ -0,0 +1,333 @@
+import argparse
+import difflib
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+from analysis_template import JSON_TEMPLATE
+from result_store import DEFAULT_STORE, open_result_store
+
+# Bump when matching rules change so stored canonical forms can be recomputed
+CANONICAL_VERSION = 1
+
+# Response keys seen in free-text analyses that do not fuzzy-match a template node
+KEY_ALIASES = {
+    "colors": "design.color_analysis.primary_color.name",
+    "precise_colors": "design.color_analysis.primary_color.name",
+    "identified_colors": "design.color_analysis.primary_color.name",
+    "color_relationships": "design.color_analysis.color_combinations",
+    "relationships": "design.color_analysis.color_combinations",
+    "color_combinations_and_harmony": "design.color_analysis.color_combinations",
+    "combinations_and_harmony": "design.color_analysis.color_combinations",
+    "design_details": "design",
+    "knit_techniques": "design.knit_patterns",
+    "special_knit_techniques": "design.knit_patterns",
+    "special_knit_techniques_and_placement": "design.knit_patterns",
+    "pattern_complexity_and_execution": "design.knit_patterns.pattern_complexity",
+    "overall_silhouette": "design.silhouette",
+    "overall_silhouette_and_impact": "design.silhouette",
+    "style_influences": "style_classification.aesthetic",
+    "key_style_influences": "style_classification.aesthetic",
+    "key_style_influences_and_aesthetic_category": "style_classification.aesthetic",
+    "aesthetic_category": "style_classification.aesthetic",
+    "dominant_design_features": "visual_impact.dominant_features",
+    "pattern_and_texture_relationships": "visual_impact",
+    "pattern_and_texture": "visual_impact",
+}
+
+# Free-text spellings of template values
+VALUE_ALIASES = {
+    "ribbing": "Ribbed",
+    "rib knit": "Ribbed",
+    "cable": "Cable knit",
+    "cables": "Cable knit",
+    "cable knitting": "Cable knit",
+    "dropped shoulder": "Drop shoulder",
+    "dropped shoulders": "Drop shoulder",
+    "drop shoulders": "Drop shoulder",
+    "crewneck": "Crew",
+    "crew neck": "Crew",
+    "crew neckline": "Crew",
+    "turtle neck": "Turtleneck",
+    "mockneck": "Mock neck",
+    "v neckline": "V-neck",
+    "boatneck": "Boat neck",
+    "gray": "Grey",
+    "ivory": "Cream",
+    "off white": "Cream",
+    "tan": "Camel",
+    "button": "Buttons",
+    "zipper": "Zippers",
+    "zip": "Zippers",
+    "striped": "Two-tone",
+    "fairisle": "Fair Isle",
+    "oversize": "Oversized",
+    "colorblock": "Color-blocked",
+    "color block": "Color-blocked",
+}
+
+# Extra words that show a sentence is about a given template node
+CONTEXT_SYNONYMS = {
+    "neckline": ["neck", "collar"],
+    "sleeve": ["cuff", "shoulder", "arm"],
+    "cuff": ["cuffs"],
+    "hem": ["hemline", "bottom"],
+    "hardware": ["button", "zip", "toggle", "snap"],
+    "trim": ["edge", "edging"],
+    "silhouette": ["fit", "shape", "cut"],
+    "tone": ["warm", "cool"],
+}
+
+GENERIC_TOKENS = {"design", "details", "detail", "elements", "element", "style", "analysis",
+                  "primary", "classification", "name", "type", "level", "features", "feature"}
+
+# Values that only count when they are the whole answer, never inside a sentence
+EXACT_ONLY = {"none", "other"}
+
+
+def normalize_key(key: str) -> str:
+    """Normalize "Color Analysis", "colorAnalysis" and "color_analysis" to the same form."""
+    key = re.sub(r"([a-z])([A-Z])", r"\1_\2", key)
+    return re.sub(r"[^a-z0-9]+", "_", key.lower()).strip("_")
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+
+class Vocabulary:
+    """Controlled vocabulary of the analysis template, indexed by dotted leaf path."""
+
+    def __init__(self, template: Dict = None):
+        template = template if template is not None else json.loads(JSON_TEMPLATE)
+        self.leaves = {}
+        self.nodes = {"": None}
+        self._walk(template, "")
+        self._codes = {path: {value: n for n, value in enumerate(values)}
+                       for path, values in self.leaves.items()}
+
+    def _walk(self, node: Dict, prefix: str):
+        for key, value in node.items():
+            path = f"{prefix}.{key}" if prefix else key
+            self.nodes[path] = None
+            if isinstance(value, dict):
+                self._walk(value, path)
+            else:
+                self.leaves[path] = list(value)
+
+    def leaves_under(self, node: str) -> List[str]:
+        if node in self.leaves:
+            return [node]
+        prefix = node + "." if node else ""
+        return [path for path in self.leaves if path.startswith(prefix)]
+
+    def descendants(self, node: str) -> List[str]:
+        prefix = node + "." if node else ""
+        return [path for path in self.nodes if path and path.startswith(prefix)]
+
+    def code(self, path: str, value: str) -> int:
+        return self._codes[path][value]
+
+    def encode(self, canonical: Dict[str, List[str]]) -> Dict[str, List[int]]:
+        """Replace canonical values with their integer codes."""
+        return {path: [self._codes[path][value] for value in values] for path, values in canonical.items()}
+
+    def decode(self, encoded: Dict[str, List[int]]) -> Dict[str, List[str]]:
+        return {path: [self.leaves[path][code] for code in codes] for path, codes in encoded.items()}
+
+
+class Canonicalizer:
+    """Maps free-text analysis keys and values onto the template vocabulary.
+
+    Keys resolve to template nodes by exact, normalized, alias and then fuzzy
+    matching. Values resolve within that node the same way, falling back to
+    scanning sentences for vocabulary phrases. Every lookup is memoized, so
+    repeated strings cost a dict lookup.
+    """
+
+    def __init__(self, vocabulary: Vocabulary = None, fuzzy_cutoff: float = 0.85):
+        self.vocabulary = vocabulary or Vocabulary()
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._key_cache = {}
+        self._value_cache = {}
+        self._scanners = {}
+        self._names = {}
+        for path in self.vocabulary.nodes:
+            if path:
+                self._names.setdefault(path.rsplit(".", 1)[-1], []).append(path)
+
+    # Key resolution
+
+    def resolve_key(self, node: str, key: str) -> Optional[str]:
+        """Return the template node a response key refers to, searching below `node`."""
+        cache_key = (node, key)
+        if cache_key not in self._key_cache:
+            self._key_cache[cache_key] = self._resolve_key(node, key)
+        return self._key_cache[cache_key]
+
+    def _resolve_key(self, node: str, key: str) -> Optional[str]:
+        norm = normalize_key(key)
+        descendants = self.vocabulary.descendants(node)
+        prefix = node + "." if node else ""
+        if prefix + key in self.vocabulary.nodes:
+            return prefix + key
+        matches = [path for path in self._names.get(norm, []) if path in descendants]
+        if matches:
+            return min(matches, key=lambda path: path.count("."))
+        if norm in KEY_ALIASES:
+            return KEY_ALIASES[norm]
+        names = {path.rsplit(".", 1)[-1]: path for path in sorted(descendants, key=lambda p: -p.count("."))}
+        close = difflib.get_close_matches(norm, list(names) + list(KEY_ALIASES), n=1, cutoff=self.fuzzy_cutoff)
+        if close:
+            return names.get(close[0]) or KEY_ALIASES[close[0]]
+        return None
+
+    # Value resolution
+
+    def _context_tokens(self, node: str, leaf: str) -> List[str]:
+        relative = leaf[len(node) + 1:] if node else leaf
+        tokens = set()
+        for segment in relative.split("."):
+            for token in segment.split("_"):
+                token = token.rstrip("s")
+                if token and token not in GENERIC_TOKENS:
+                    tokens.add(token)
+                    tokens.update(CONTEXT_SYNONYMS.get(token, []))
+        return sorted(tokens)
+
+    def _scanner(self, node: str):
+        """Build (regex, term -> [(leaf, value)], leaf -> context tokens) for a node."""
+        if node not in self._scanners:
+            terms = {}
+            for leaf in self.vocabulary.leaves_under(node):
+                for value in self.vocabulary.leaves[leaf]:
+                    term = normalize_text(value)
+                    if term not in EXACT_ONLY:
+                        terms.setdefault(term, []).append((leaf, value))
+                for alias, value in VALUE_ALIASES.items():
+                    if value in self.vocabulary.leaves[leaf]:
+                        terms.setdefault(alias, []).append((leaf, value))
+            pattern = "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+            regex = re.compile(r"\b(?:%s)s?\b" % pattern) if pattern else None
+            context = {leaf: self._context_tokens(node, leaf) for leaf in self.vocabulary.leaves_under(node)}
+            self._scanners[node] = (regex, terms, context)
+        return self._scanners[node]
+
+    def match_value(self, node: str, text: str) -> List[Tuple[str, str]]:
+        """Return the (leaf path, canonical value) pairs a response value maps to."""
+        cache_key = (node, text)
+        if cache_key not in self._value_cache:
+            self._value_cache[cache_key] = self._match_value(node, text)
+        return self._value_cache[cache_key]
+
+    def _match_value(self, node: str, text: str) -> List[Tuple[str, str]]:
+        norm = normalize_text(text)
+        if not norm:
+            return []
+        if node in self.vocabulary.leaves:
+            values = self.vocabulary.leaves[node]
+            if text in values:
+                return [(node, text)]
+            by_norm = {normalize_text(value): value for value in values}
+            if norm in by_norm:
+                return [(node, by_norm[norm])]
+            if VALUE_ALIASES.get(norm) in values:
+                return [(node, VALUE_ALIASES[norm])]
+
+        regex, terms, context = self._scanner(node)
+        found = []
+        if regex:
+            for match in regex.finditer(norm):
+                term = match.group(0)
+                candidates = terms.get(term) or terms.get(term[:-1], [])
+                if len(candidates) > 1:
+                    # Generic words ("Ribbed", "Light") belong to several attributes;
+                    # keep only those whose subject is mentioned in the same text
+                    candidates = [(leaf, value) for leaf, value in candidates
+                                  if any(token in norm for token in context[leaf])]
+                found.extend(candidates)
+        if found or node not in self.vocabulary.leaves:
+            return list(dict.fromkeys(found))
+
+        values = self.vocabulary.leaves[node]
+        by_norm = {normalize_text(value): value for value in values}
+        close = difflib.get_close_matches(norm, list(by_norm), n=1, cutoff=self.fuzzy_cutoff)
+        if close:
+            return [(node, by_norm[close[0]])]
+        if "Other" in values and len(norm.split()) <= 3:
+            return [(node, "Other")]
+        return []
+
+    # Whole analyses
+
+    def canonicalize(self, analysis: Dict) -> Dict[str, List[str]]:
+        """Map a raw analysis onto {template leaf path: [canonical values]}."""
+        found = {}
+        self._collect(analysis, "", found)
+        ordered = {}
+        for leaf in self.vocabulary.leaves:
+            if leaf in found:
+                vocabulary = self.vocabulary.leaves[leaf]
+                ordered[leaf] = sorted(found[leaf], key=vocabulary.index)
+        return ordered
+
+    def _collect(self, value, node: Optional[str], found: Dict):
+        if isinstance(value, dict):
+            for key, child in value.items():
+                resolved = self.resolve_key(node or "", key)
+                # Unrecognized keys keep their parent's scope, but never the whole
+                # template, where generic words would match everywhere
+                self._collect(child, resolved if resolved is not None else node or None, found)
+        elif isinstance(value, list):
+            for child in value:
+                self._collect(child, node, found)
+        elif isinstance(value, (str, int, float)) and not isinstance(value, bool) and node:
+            for leaf, canonical in self.match_value(node, str(value)):
+                values = found.setdefault(leaf, [])
+                if canonical not in values:
+                    values.append(canonical)
+
+
+_default_canonicalizer = None
+
+
+def canonicalize(analysis: Dict) -> Dict[str, List[str]]:
+    """Canonicalize with a shared, memoized Canonicalizer."""
+    global _default_canonicalizer
+    if _default_canonicalizer is None:
+        _default_canonicalizer = Canonicalizer()
+    return _default_canonicalizer.canonicalize(analysis)
+
+
+def add_canonical(record: Dict) -> Dict:
+    """Store the canonical form next to the raw analysis in a result record."""
+    record["canonical"] = canonicalize(record.get("analysis") or {})
+    record["canonical_version"] = CANONICAL_VERSION
+    return record
+
+
+def backfill_store(store_path: str = DEFAULT_STORE, force: bool = False) -> int:
+    """Add canonical forms to stored records that lack a current one."""
+    store = open_result_store(store_path)
+    updated = 0
+    try:
+        for key in list(store.keys()):
+            record = store.get(key)
+            if force or record.get("canonical_version") != CANONICAL_VERSION:
+                store.put(key, add_canonical(record))
+                updated += 1
+    finally:
+        store.close()
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Canonicalize analysis results onto the template vocabulary")
+    parser.add_argument("store", nargs="?", default=DEFAULT_STORE)
+    parser.add_argument("--force", action="store_true", help="Recompute canonical forms that are already current")
+    args = parser.parse_args()
+    print(f"Canonicalized {backfill_store(args.store, force=args.force)} records in {args.store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+PROG = "fashion-understander"
+
+DEFAULT_STARTUP_RUNS = 5
+
+# Heavy packages that must load on the code paths that use them, never when a subcommand's module is imported
+DEFERRED_IMPORTS = ("PIL", "openai", "selenium")
+
+# Subcommand -> (module, arguments put in front of the user's, help). A module is
+# imported only when its subcommand runs, so `--help` never pays for Selenium,
+# OpenAI, NumPy or Pillow; only patterns and tags load NumPy, which they always use.
+COMMANDS = {
+    "scrape": ("download_images", [], "Scrape the sweater listing and download product images"),
+    "download": ("download_images", ["--refresh"],
+                 "Re-fetch the images of products in the download manifest without scraping"),
+    "analyze": ("image_to_tags", [], "Analyze downloaded images with the vision model"),
+    "patterns": ("analyze_tags", [], "Mine style patterns and write the trend report"),
+    "tags": ("tag_index", [], "Update and query the inverted tag index of the analysis results"),
+}
+
+
+def measure_startup(module: str, runs: int = DEFAULT_STARTUP_RUNS) -> dict:
+    """Time importing `module` in fresh interpreters, without credentials.
+
+    Returns the median import time and the median wall time of the whole
+    process (interpreter start included), in seconds, and which of the
+    DEFERRED_IMPORTS the import loaded.
+    """
+    env = {key: value for key, value in os.environ.items() if key != "OPENAI_API_KEY"}
+    code = (f"import json, sys, time; start = time.perf_counter(); import {module}; "
+            f"print(json.dumps([time.perf_counter() - start, [name for name in {DEFERRED_IMPORTS!r} "
+            f"if name in sys.modules]]))")
+    imports, walls, loaded = [], [], set()
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        walls.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip()}")
+        seconds, names = json.loads(result.stdout.strip().splitlines()[-1])
+        imports.append(seconds)
+        loaded.update(names)
+    return {"import_seconds": statistics.median(imports), "process_seconds": statistics.median(walls),
+            "deferred_loaded": sorted(loaded)}
+
+
+def startup(argv=None):
+    parser = argparse.ArgumentParser(prog=f"{PROG} startup",
+                                     description="Measure the cold start of each subcommand")
+    parser.add_argument('--runs', type=int, default=DEFAULT_STARTUP_RUNS, help="Fresh interpreters per subcommand")
+    parser.add_argument('--record', metavar='PATH',
+                        help="Append the measurements to a JSONL file to track them over time")
+    parser.add_argument('--max-seconds', type=float,
+                        help="Exit with an error if any subcommand takes longer than this to import")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in COMMANDS:
+        module = COMMANDS[name][0]
+        results[name] = measure_startup(module, args.runs)
+        loaded = results[name]["deferred_loaded"]
+        print(f"{name:<10} {module:<18} import {results[name]['import_seconds'] * 1000:7.1f} ms  "
+              f"process {results[name]['process_seconds'] * 1000:7.1f} ms"
+              + (f"  loads {', '.join(loaded)}" if loaded else ""))
+    if args.record:
+        with open(args.record, "a") as f:
+            f.write(json.dumps({"timestamp": datetime.now().isoformat(), "python": sys.version.split()[0],
+                                "runs": args.runs, "commands": results}) + "\n")
+    slow = [name for name, result in results.items()
+            if args.max_seconds is not None and result["import_seconds"] > args.max_seconds]
+    if slow:
+        print(f"Cold start over {args.max_seconds}s: {', '.join(slow)}")
+    eager = [name for name, result in results.items() if result["deferred_loaded"]]
+    if eager:
+        print(f"Importing loads {', '.join(DEFERRED_IMPORTS)} too early for: {', '.join(eager)}")
+    return 1 if slow or eager else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog=PROG, description="Scrape, analyze and find patterns in Shopbop knitwear")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND", required=True)
+    # Each subcommand parses its own options, so `COMMAND --help` shows them
+    for name, (module, _, help) in COMMANDS.items():
+        subparsers.add_parser(name, help=help, add_help=False)
+    subparsers.add_parser("startup", help="Measure the cold start of each subcommand", add_help=False)
+    args, rest = parser.parse_known_args(argv)
+
+    if args.command == "startup":
+        return startup(rest)
+    module, prefix, _ = COMMANDS[args.command]
+    started = time.perf_counter()
+    entry_point = importlib.import_module(module).main
+    from metrics import metrics
+    metrics.observe("startup", time.perf_counter() - started, command=args.command)
+    return entry_point(prefix + rest)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,396 @@
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever segmentation, clustering or the vocabulary mapping changes, so
+# cached analyses that include local color fields are not reused
+COLOR_VERSION = 1
+
+# Template leaves filled in from pixels; the model prompt can leave these out
+LOCAL_FIELDS = (
+    "design.color_analysis.primary_color.name",
+    "design.color_analysis.primary_color.tone",
+    "design.color_analysis.primary_color.intensity",
+    "design.color_analysis.color_combinations.scheme",
+    "design.color_analysis.color_combinations.contrast_level",
+    "design.color_analysis.color_combinations.color_harmony",
+    "design.color_analysis.pattern_colors.background",
+    "design.color_analysis.pattern_colors.accent_colors",
+    "design.color_analysis.pattern_colors.color_distribution",
+)
+
+# Reference swatches (sRGB) for the template's primary color names; several per
+# name so charcoal, burgundy, tan and the like land on the right one
+COLOR_REFERENCES = {
+    "Black": [(20, 20, 22), (45, 42, 42)],
+    "Navy": [(28, 36, 70), (42, 52, 94), (20, 26, 48)],
+    "Cream": [(240, 232, 212), (226, 214, 188), (238, 228, 200)],
+    "Grey": [(128, 128, 128), (168, 168, 166), (86, 86, 90), (200, 200, 198)],
+    "Camel": [(193, 154, 107), (170, 128, 88), (212, 182, 140), (140, 100, 65)],
+    "White": [(246, 246, 246), (235, 236, 238)],
+    "Red": [(180, 30, 40), (120, 26, 36), (215, 50, 50), (150, 40, 55)],
+}
+
+# Colors further than this from every reference are "Other"
+MAX_NAME_DISTANCE = 24.0
+
+# Below this chroma a color reads as neutral (black, white, greys)
+NEUTRAL_CHROMA = 10.0
+
+# Clusters closer than this (Delta E) are shades of the same color
+MERGE_DISTANCE = 14.0
+
+# Share of garment pixels a color needs to count toward the scheme
+SIGNIFICANT_SHARE = 0.06
+
+# sRGB (D65) to XYZ
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]], dtype=np.float32)
+_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+
+def srgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """Convert an (..., 3) array of 0-255 sRGB values to CIE Lab."""
+    c = rgb.astype(np.float32) / 255.0
+    linear = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def lab_to_srgb(lab: np.ndarray) -> np.ndarray:
+    """Inverse of srgb_to_lab, clipped to 0-255."""
+    lab = np.asarray(lab, dtype=np.float32)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f ** 3 > 216 / 24389, f ** 3, (116 * f - 16) / (24389 / 27)) * _WHITE
+    linear = np.clip(xyz @ np.linalg.inv(_RGB_TO_XYZ).T, 0, 1)
+    c = np.where(linear > 0.0031308, 1.055 * linear ** (1 / 2.4) - 0.055, 12.92 * linear)
+    return np.clip(np.round(c * 255), 0, 255).astype(np.uint8)
+
+
+_REFERENCE_NAMES = [name for name, swatches in COLOR_REFERENCES.items() for _ in swatches]
+_REFERENCE_LAB = srgb_to_lab(np.array([s for swatches in COLOR_REFERENCES.values() for s in swatches]))
+
+
+def kmeans(points: np.ndarray, k: int, iterations: int = 20, tolerance: float = 0.5,
+           seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized k-means with k-means++ seeding; returns (centers, labels)."""
+    rng = np.random.default_rng(seed)
+    points = points.astype(np.float32)
+    k = min(k, len(points))
+    sq_norms = np.einsum("ij,ij->i", points, points)
+    centers = [points[rng.integers(len(points))]]
+    closest = np.full(len(points), np.inf, dtype=np.float32)
+    for _ in range(1, k):
+        closest = np.minimum(closest, ((points - centers[-1]) ** 2).sum(axis=1))
+        total = closest.sum()
+        if total <= 0:
+            break
+        centers.append(points[rng.choice(len(points), p=closest / total)])
+    centers = np.array(centers, dtype=np.float32)
+
+    for _ in range(iterations):
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, one matrix product for all pairs
+        distances = sq_norms[:, None] - 2 * points @ centers.T + np.einsum("ij,ij->i", centers, centers)
+        labels = distances.argmin(axis=1)
+        counts = np.bincount(labels, minlength=len(centers)).astype(np.float32)
+        sums = np.stack([np.bincount(labels, weights=points[:, d], minlength=len(centers))
+                         for d in range(points.shape[1])], axis=1)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        shift = np.abs(updated - centers).max()
+        centers = updated.astype(np.float32)
+        if shift < tolerance:
+            break
+    distances = sq_norms[:, None] - 2 * points @ centers.T + np.einsum("ij,ij->i", centers, centers)
+    return centers, distances.argmin(axis=1)
+
+
+def _shift(mask: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    shifted = np.zeros_like(mask)
+    h, w = mask.shape
+    shifted[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = \
+        mask[max(-dy, 0):h + min(-dy, 0), max(-dx, 0):w + min(-dx, 0)]
+    return shifted
+
+
+def border_connected(candidates: np.ndarray) -> np.ndarray:
+    """Pixels of `candidates` connected to the image border (4-connectivity)."""
+    region = np.zeros_like(candidates)
+    region[0, :], region[-1, :], region[:, 0], region[:, -1] = \
+        candidates[0, :], candidates[-1, :], candidates[:, 0], candidates[:, -1]
+    while True:
+        grown = region | _shift(region, 1, 0) | _shift(region, -1, 0) | _shift(region, 0, 1) | _shift(region, 0, -1)
+        grown &= candidates
+        if np.array_equal(grown, region):
+            return region
+        region = grown
+
+
+def skin_mask(rgb: np.ndarray) -> np.ndarray:
+    """Rough skin detector in YCbCr, for the model's face, neck and hands."""
+    r, g, b = (rgb[..., i].astype(np.float32) for i in range(3))
+    y = 0.299 * r + 0.587 * g + 0.114 * b
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    return (y > 60) & (cr > 135) & (cr < 175) & (cb > 85) & (cb < 128) & (r > g) & (g > b)
+
+
+def name_color(lab: np.ndarray) -> str:
+    """Nearest template color name, weighting hue and chroma over lightness."""
+    delta = _REFERENCE_LAB - lab
+    distances = np.sqrt(delta[:, 0] ** 2 + (2 * delta[:, 1]) ** 2 + (2 * delta[:, 2]) ** 2)
+    best = int(distances.argmin())
+    return _REFERENCE_NAMES[best] if distances[best] <= MAX_NAME_DISTANCE else "Other"
+
+
+def _chroma(lab: np.ndarray) -> float:
+    return float(np.hypot(lab[1], lab[2]))
+
+
+def _hue(lab: np.ndarray) -> float:
+    return float(np.degrees(np.arctan2(lab[2], lab[1])) % 360)
+
+
+def _hue_gap(a: float, b: float) -> float:
+    gap = abs(a - b) % 360
+    return min(gap, 360 - gap)
+
+
+def color_tone(lab: np.ndarray) -> str:
+    if _chroma(lab) < NEUTRAL_CHROMA:
+        return "Neutral"
+    # Reds through yellows read warm; greens, blues and purples cool
+    return "Warm" if _hue(lab) <= 105 or _hue(lab) >= 345 else "Cool"
+
+
+def color_intensity(lab: np.ndarray) -> str:
+    lightness, chroma = float(lab[0]), _chroma(lab)
+    if chroma >= 45:
+        return "Vibrant"
+    if lightness < 35:
+        return "Deep"
+    if lightness >= 75:
+        return "Pastel" if chroma >= NEUTRAL_CHROMA else "Light"
+    return "Muted"
+
+
+def contrast_level(colors: List[Dict]) -> str:
+    if len(colors) < 2:
+        return "Tonal"
+    base = colors[0]["lab"]
+    spread = max(float(np.linalg.norm(c["lab"] - base)) for c in colors[1:])
+    if spread >= 60:
+        return "High"
+    if spread >= 35:
+        return "Medium"
+    if spread >= 15:
+        return "Low"
+    return "Tonal"
+
+
+def color_harmony(colors: List[Dict]) -> str:
+    chromatic = [_hue(c["lab"]) for c in colors if _chroma(c["lab"]) >= NEUTRAL_CHROMA]
+    if len(chromatic) < 2:
+        return "Monochromatic"
+    gaps = [_hue_gap(a, b) for i, a in enumerate(chromatic) for b in chromatic[i + 1:]]
+    if max(gaps) <= 30:
+        return "Monochromatic"
+    if len(chromatic) >= 3 and all(abs(gap - 120) <= 30 for gap in sorted(gaps)[-3:]):
+        return "Triadic"
+    if max(gaps) <= 75:
+        return "Analogous"
+    return "Complementary"
+
+
+def _merge_clusters(centers: np.ndarray, shares: np.ndarray) -> Tuple[List[Dict], np.ndarray]:
+    """Merge clusters that are shades of one color; returns colors by share and a cluster->color map."""
+    order = np.argsort(-shares)
+    colors, mapping = [], np.zeros(len(centers), dtype=np.int64)
+    for index in order:
+        if shares[index] == 0:
+            continue
+        for n, color in enumerate(colors):
+            if np.linalg.norm(color["lab"] - centers[index]) < MERGE_DISTANCE:
+                total = color["share"] + shares[index]
+                color["lab"] = (color["lab"] * color["share"] + centers[index] * shares[index]) / total
+                color["share"] = total
+                mapping[index] = n
+                break
+        else:
+            mapping[index] = len(colors)
+            colors.append({"lab": centers[index].astype(np.float64), "share": float(shares[index])})
+    return colors, mapping
+
+
+class ColorAnalyzer:
+    """Pixel-based color analysis of product photos, filling the template's color fields.
+
+    The garment is segmented by removing the studio background (pixels close to
+    the border color and connected to the border) and skin, within a torso band
+    of the frame that excludes the face and the trousers. Garment pixels are
+    clustered with k-means in Lab space, near-identical clusters are merged, and
+    the resulting palette is mapped onto the template vocabulary.
+    """
+
+    def __init__(self, k: int = 6, max_side: int = 192, background_tolerance: float = 8.0,
+                 torso: Tuple[float, float] = (0.3, 0.8), texture: bool = True):
+        self.k = k
+        self.max_side = max_side
+        self.background_tolerance = background_tolerance
+        self.torso = torso
+        self.texture = texture
+
+    def signature(self) -> str:
+        """Describe the settings that affect results, for use in cache keys."""
+        return (f"colors={COLOR_VERSION};k={self.k};side={self.max_side};bg={self.background_tolerance};"
+                f"torso={self.torso[0]}-{self.torso[1]}")
+
+    def load(self, image_path) -> np.ndarray:
+        with Image.open(image_path) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((self.max_side, self.max_side), Image.BILINEAR)
+            return np.asarray(image)
+
+    def segment(self, rgb: np.ndarray, lab: np.ndarray) -> np.ndarray:
+        """Boolean mask of garment pixels."""
+        h, w = lab.shape[:2]
+        border = np.concatenate([lab[0], lab[-1], lab[:, 0], lab[:, -1]])
+        distance = np.linalg.norm(lab - np.median(border, axis=0), axis=-1)
+        band = np.zeros(distance.shape, dtype=bool)
+        band[int(h * self.torso[0]):int(h * self.torso[1])] = True
+        tolerance = self.background_tolerance
+        for _ in range(3):
+            mask = ~border_connected(distance < tolerance) & band
+            # A white garment on a pale backdrop floods with the background; tighten and retry
+            if mask.sum() >= 0.25 * band.sum():
+                break
+            tolerance /= 2
+        skin = skin_mask(rgb) & mask
+        # Camel and tan knits pass the skin test; keep them when skin would be most of the garment
+        if skin.sum() < 0.5 * mask.sum():
+            mask &= ~skin
+        if mask.sum() < 0.02 * h * w:
+            # Segmentation failed (e.g. a flat lay filling the frame); fall back to the band
+            mask = band
+        return mask
+
+    def texture_stats(self, lab: np.ndarray, mask: np.ndarray, labels: np.ndarray) -> Dict:
+        """Simple texture statistics of the garment's lightness channel."""
+        lightness = lab[..., 0]
+        gy, gx = np.gradient(lightness)
+        magnitude = np.hypot(gx, gy)[mask]
+        # Spread of lightness within each color cluster: high for heathered or textured knits
+        values = lightness[mask]
+        counts = np.bincount(labels, minlength=labels.max() + 1)
+        means = np.bincount(labels, weights=values) / np.maximum(counts, 1)
+        within = float(np.sqrt(np.mean((values - means[labels]) ** 2)))
+        return {"lightness_std": round(float(values.std()), 2),
+                "within_color_std": round(within, 2),
+                "mean_gradient": round(float(magnitude.mean()), 2),
+                "edge_density": round(float((magnitude > 6.0).mean()), 3)}
+
+    def analyze(self, image_path) -> Dict:
+        """Analyze one image; returns the template fields, the palette and texture statistics."""
+        rgb = self.load(image_path)
+        lab = srgb_to_lab(rgb)
+        mask = self.segment(rgb, lab)
+        pixels = lab[mask]
+        centers, labels = kmeans(pixels, self.k)
+        shares = np.bincount(labels, minlength=len(centers)) / len(labels)
+        colors, mapping = _merge_clusters(centers, shares)
+        significant = [c for c in colors if c["share"] >= SIGNIFICANT_SHARE] or colors[:1]
+        dominant, accents = significant[0], significant[1:]
+
+        if not accents:
+            scheme = "Solid"
+        else:
+            # Large, spatially coherent areas of color are blocking rather than a knitted pattern
+            color_of = np.full(mask.shape, -1)
+            color_of[mask] = mapping[labels]
+            same = (color_of[1:] == color_of[:-1])[mask[1:] & mask[:-1]]
+            coherence = float(same.mean()) if same.size else 0.0
+            if coherence > 0.97 and min(c["share"] for c in significant) > 0.2:
+                scheme = "Color-blocked"
+            else:
+                scheme = "Two-tone" if len(significant) == 2 else "Multi-color"
+
+        if not accents:
+            accent_colors = "None"
+        elif len(accents) >= 2 and len({name_color(c["lab"]) for c in accents}) >= 2:
+            accent_colors = "Multi-colored"
+        else:
+            accent = max(accents, key=lambda c: np.linalg.norm(c["lab"] - dominant["lab"]))
+            accent_colors = "Contrast" if np.linalg.norm(accent["lab"] - dominant["lab"]) >= 35 else "Tonal"
+
+        if scheme == "Multi-color" and dominant["share"] < 0.5:
+            background = "Multi"
+        else:
+            background = "Light" if dominant["lab"][0] >= 70 else "Dark" if dominant["lab"][0] < 35 else "Medium"
+
+        fields = {
+            "design.color_analysis.primary_color.name": name_color(dominant["lab"]),
+            "design.color_analysis.primary_color.tone": color_tone(dominant["lab"]),
+            "design.color_analysis.primary_color.intensity": color_intensity(dominant["lab"]),
+            "design.color_analysis.color_combinations.scheme": scheme,
+            "design.color_analysis.color_combinations.contrast_level": contrast_level(significant),
+            "design.color_analysis.color_combinations.color_harmony": color_harmony(significant),
+            "design.color_analysis.pattern_colors.background": background,
+            "design.color_analysis.pattern_colors.accent_colors": accent_colors,
+            "design.color_analysis.pattern_colors.color_distribution":
+                "Dominated" if dominant["share"] >= 0.7 else "Even",
+        }
+        result = {
+            "fields": fields,
+            "palette": [{"hex": "#" + bytes(lab_to_srgb(c["lab"]).tolist()).hex(), "name": name_color(c["lab"]),
+                         "share": round(c["share"], 3)} for c in colors],
+            "garment_fraction": round(float(mask.mean()), 3),
+        }
+        if self.texture:
+            result["texture"] = self.texture_stats(lab, mask, mapping[labels])
+        return result
+
+
+def merge_local_fields(analysis: Dict, fields: Dict[str, str]) -> Dict:
+    """Write locally computed {leaf path: value} fields into a nested analysis, replacing model values."""
+    for path, value in fields.items():
+        node = analysis
+        *parents, leaf = path.split(".")
+        for parent in parents:
+            if not isinstance(node.get(parent), dict):
+                node[parent] = {}
+            node = node[parent]
+        node[leaf] = value
+    return analysis
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Analyze garment colors locally from pixels")
+    parser.add_argument('images', nargs='*', help="Images to analyze (default: shopbop_images/*.jpg)")
+    parser.add_argument('--k', type=int, default=6, help="Number of k-means clusters")
+    parser.add_argument('--max-side', type=int, default=192, help="Downscale images to this size first")
+    parser.add_argument('--no-texture', action='store_true', help="Skip texture statistics")
+    args = parser.parse_args()
+
+    analyzer = ColorAnalyzer(k=args.k, max_side=args.max_side, texture=not args.no_texture)
+    images = [Path(p) for p in args.images] or sorted(Path("shopbop_images").glob("*.jpg"))
+    started = time.perf_counter()
+    for image_path in images:
+        print(json.dumps({"image": str(image_path), **analyzer.analyze(image_path)}))
+    elapsed = time.perf_counter() - started
+    if images:
+        logger.info(f"Analyzed {len(images)} images in {elapsed:.2f}s ({1000 * elapsed / len(images):.1f} ms/image)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,150 @@
-import undetected_chromedriver as uc
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
-import requests
+import argparse
 import os
 import time
 import urllib.parse
-import re
 import random
+from collections import defaultdict
+from contextlib import contextmanager
+from download_manifest import DEFAULT_MANIFEST, DownloadManifest
+from image_downloader import ImageDownloader, download_to_file, make_session
+from metrics import add_metrics_arguments, metrics, start_metrics
+from listing_parser import (LISTING_URL, PRODUCT_TILE_CLASSES, SHOPBOP_BASE_URL, clean_product_name,
+                            iter_snapshots, listing_page_url, parse_listing, parse_price, parse_products,
+                            product_id)
+from rate_limiter import TokenBucket
+
+# Selenium and undetected Chrome are imported only by the browser backend, so the
+# browserless backend runs on machines without them
+
+# One politeness action (page load, "Load More" click, inline image download)
+# every 5 seconds by default
+DEFAULT_ACTIONS_PER_MINUTE = 12
+
+# Shared by the in-browser scripts: the product tiles currently in the page, and
+# an image's real URL (lazy-loaded images start with an empty or data: src)
+TILES_JS = """
+const productTiles = (classes) => {
+    for (const cls of classes) {
+        const tiles = document.getElementsByClassName(cls);
+        if (tiles.length) return tiles;
+    }
+    return [];
+};
+const realSrc = (img) => {
+    if (!img) return null;
+    for (const attr of ['src', 'data-src', 'srcset']) {
+        const value = img.getAttribute(attr);
+        if (value && !value.startsWith('data:')) return value;
+    }
+    return null;
+};
+const tileImage = (tile) => tile.querySelector('img.product-image, img.productImage, img');
+"""
+
+COUNT_TILES_JS = TILES_JS + "return productTiles(arguments[0]).length;"
+
+# Tiles not yet extracted whose image URL has not resolved
+PENDING_IMAGES_JS = TILES_JS + """
+let pending = 0;
+for (const tile of productTiles(arguments[0])) {
+    if (!tile.dataset.fuExtracted && tileImage(tile) && !realSrc(tileImage(tile))) pending++;
+}
+return pending;
+"""
+
+RESOURCE_COUNT_JS = "return performance.getEntriesByType('resource').length;"
+
+# Runs in the browser: returns the tiles not returned before and marks them, so
+# each "Load More" batch costs time proportional to the new tiles only
+EXTRACT_NEW_TILES_JS = TILES_JS + """
+const found = [];
+for (const tile of productTiles(arguments[0])) {
+    if (tile.dataset.fuExtracted) continue;
+    const src = realSrc(tileImage(tile));
+    if (!src) continue;  // image not loaded yet; pick the tile up with the next batch
+    tile.dataset.fuExtracted = '1';
+    const link = tile.querySelector('a[href]');
+    const title = tile.querySelector('a.product-title');
+    found.push({
+        href: link ? link.getAttribute('href') : null,
+        src: src,
+        name: (title && title.textContent.trim()) || tile.textContent,
+        text: tile.textContent
+    });
+}
+return found;
+"""
+
+# Shared session so sequential downloads reuse connections
+_session = None
+
+class ScrapePacer:
+    """Politeness rate budget for the scraper, and where its wall time goes
+
+    Page actions draw from a token bucket of `actions_per_minute` instead of
+    sleeping a fixed time around each one. Time spent on that budget and on
+    readiness waits is tallied by reason; the rest of the wall time is work.
+    """
+
+    def __init__(self, actions_per_minute=DEFAULT_ACTIONS_PER_MINUTE):
+        self.budget = TokenBucket(actions_per_minute, capacity=1)
+        self.started = time.monotonic()
+        self.waited = defaultdict(float)
+
+    def polite(self):
+        """Wait until the rate budget allows the next page action"""
+        wait = self.budget.reserve(1)
+        if wait > 0:
+            self.waited['politeness'] += wait
+            metrics.observe('politeness_wait', wait)
+            time.sleep(wait)
+
+    @contextmanager
+    def waiting(self, reason):
+        """Count the time spent in the block as waiting for `reason`"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.waited[reason] += time.monotonic() - start
+            metrics.observe(f"{reason.replace(' ', '_')}_wait", time.monotonic() - start)
+
+    def report(self):
+        total = time.monotonic() - self.started
+        waited = sum(self.waited.values())
+        reasons = ", ".join(f"{reason} {seconds:.1f}s" for reason, seconds in sorted(self.waited.items()))
+        return (f"Wall time {total:.1f}s: waiting {waited:.1f}s ({reasons or 'none'}), "
+                f"working {total - waited:.1f}s")
+
+def wait_until(driver, condition, timeout, poll=0.2):
+    """Poll `condition(driver)` until it is truthy; False if `timeout` seconds pass first"""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support.ui import WebDriverWait
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=poll).until(condition)
+    except TimeoutException:
+        return False
+
+def count_tiles(driver):
+    return driver.execute_script(COUNT_TILES_JS, PRODUCT_TILE_CLASSES) or 0
+
+def wait_for_network_idle(driver, quiet=0.5, timeout=10):
+    """Wait until no new resources (images, XHR) have started loading for `quiet` seconds"""
+    state = {'count': -1, 'since': time.monotonic()}
+    
+    def idle(driver):
+        count = driver.execute_script(RESOURCE_COUNT_JS)
+        now = time.monotonic()
+        if count != state['count']:
+            state['count'], state['since'] = count, now
+            return False
+        return now - state['since'] >= quiet
+    
+    return wait_until(driver, idle, timeout, poll=0.1)
 
 def setup_driver():
     """Setup undetected Chrome driver with options"""
+    import undetected_chromedriver as uc
     options = uc.ChromeOptions()
     options.add_argument('--disable-gpu')
     options.add_argument('--no-sandbox')
@@ -30,234 +163,356 @@ def setup_driver():
     try:
         driver = uc.Chrome(options=options)
         driver.set_page_load_timeout(60)  # Increased timeout
-        # Add random delay to seem more human-like
-        time.sleep(random.uniform(2, 4))
         return driver
     except Exception as e:
         print(f"Error setting up driver: {str(e)}")
         raise
 
-def random_sleep():
-    """Add random delay between actions"""
-    time.sleep(random.uniform(2, 5))
+def scroll_page(driver, pacer):
+    """Scroll through the page a screen at a time so lazy-loaded images resolve
 
-def scroll_page(driver):
-    """Scroll page with random pauses"""
+    Starts from the current position, so after "Load More" only the newly
+    added rows are scrolled through. Each step waits for the requests it
+    triggered to settle rather than for a fixed pause.
+    """
     total_height = int(driver.execute_script("return document.body.scrollHeight"))
-    current_position = 0
-    scroll_step = random.randint(300, 700)  # Random scroll amount
+    current_position = int(driver.execute_script("return window.pageYOffset") or 0)
+    scroll_step = int(driver.execute_script("return window.innerHeight") or 800)
     
     while current_position < total_height:
         current_position += scroll_step
         driver.execute_script(f"window.scrollTo(0, {current_position});")
-        time.sleep(random.uniform(0.5, 1.5))  # Random pause between scrolls
+        with pacer.waiting('readiness'):
+            wait_for_network_idle(driver, quiet=0.3, timeout=3)
 
 def create_download_dir():
     """Create directory for downloaded images if it doesn't exist"""
     if not os.path.exists('shopbop_images'):
         os.makedirs('shopbop_images')
 
-def sanitize_filename(filename):
-    """Clean filename to be valid for all operating systems"""
-    # Remove invalid characters and price information
-    filename = re.sub(r'\$\d+\.?\d*', '', filename)  # Remove price
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
-    # Replace spaces with underscores
-    filename = filename.replace(' ', '_')
-    # Remove multiple underscores
-    filename = re.sub(r'_+', '_', filename)
-    # Limit length and remove trailing underscores
-    return filename[:100].strip('_')
 
 def download_image(url, filename):
     """Download image from URL and save it"""
+    global _session
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Referer': 'https://www.shopbop.com/'
-        }
-        response = requests.get(url, stream=True, headers=headers)
-        if response.status_code == 200:
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
+        if _session is None:
+            _session = make_session()
+        if download_to_file(_session, url, filename) is not None:
             print(f"Successfully downloaded: {filename}")
-        else:
-            print(f"Failed to download: {url} (Status code: {response.status_code})")
     except Exception as e:
         print(f"Error downloading {url}: {str(e)}")
 
-def get_product_info(product_element):
-    """Extract product name from Shopbop's product element"""
-    try:
-        product_name = ""
-        # Try to find the product name from the link text
-        product_link = product_element.find('a', class_='product-title')
-        if product_link:
-            product_name = product_link.text.strip()
+def extract_new_products(driver):
+    """Product tiles added since the last call, read in the browser without reparsing the page"""
+    tiles = driver.execute_script(EXTRACT_NEW_TILES_JS, PRODUCT_TILE_CLASSES) or []
+    products = []
+    for tile in tiles:
+        product_url = urllib.parse.urljoin(SHOPBOP_BASE_URL, tile['href']) if tile.get('href') else None
+        products.append({
+            'id': product_id(product_url, tile['src']),
+            'url': product_url,
+            'src': tile['src'],
+            'name': clean_product_name(tile.get('name')),
+            'price': parse_price(tile.get('text')),
+        })
+    return products
+
+def queue_products(products, page_number, total_images_downloaded, downloader=None, seen_ids=None,
+                   pacer=None):
+    """Queue (or download inline) the images of products not yet in `seen_ids`
+
+    Products are the records built by listing_parser or extract_new_products; both
+    scraper backends end here.
+    """
+    if seen_ids is None:
+        seen_ids = set()
+    if pacer is None:
+        pacer = ScrapePacer()
+    new_products = [product for product in products if product['id'] not in seen_ids]
+    print(f"Found {len(new_products)} new products on page {page_number}")
+    
+    for product in new_products:
+        seen_ids.add(product['id'])
+        src = product['src']
         
-        if not product_name:
-            # Try to find product name from any text content
-            product_name = product_element.get_text().strip()
+        if isinstance(src, str) and ('icon' in src.lower() or 'logo' in src.lower() or '.svg' in src.lower()):
+            continue
         
-        # Clean up the product name
-        product_name = re.sub(r'\s+', ' ', product_name)  # Replace multiple spaces
-        product_name = product_name.replace('Not hearted', '')  # Remove "Not hearted" text
+        # Get product name
+        product_name = product['name']
+        filename = os.path.join('shopbop_images', f'{product_name}_page{page_number}.jpg')
+        product_url = product['url']
+        product_key = product_url or src
+        manifest = downloader.manifest if downloader else None
+        known = manifest.get(product_key) if manifest else None
         
-        if not product_name:
-            product_name = f"shopbop_product_{int(time.time())}"
-            
-        return sanitize_filename(product_name)
-    except Exception as e:
-        print(f"Error getting product name: {str(e)}")
-        return f"shopbop_product_{int(time.time())}"
+        if known and known['filename']:
+            # Re-scrape of a product we already have: keep its existing file
+            filename = known['filename']
+        else:
+            # Ensure unique filename
+            exists = downloader.is_claimed if downloader else os.path.exists
+            base, ext = os.path.splitext(filename)
+            counter = 1
+            while exists(filename):
+                filename = f"{base}_{counter}{ext}"
+                counter += 1
+        
+        # Download image
+        if downloader:
+            # Blocks while the downloader's queue is full
+            with metrics.timer('download_queue_wait'):
+                downloader.submit(src, filename, product_key=product_key, product_url=product_url,
+                                  price=product.get('price'))
+        else:
+            pacer.polite()
+            download_image(src, filename)
+        total_images_downloaded += 1
+    
+    return total_images_downloaded
+
 
-def scrape_page(driver, page_number, total_images_downloaded):
-    """Scrape images from a single Shopbop page"""
+def scrape_page(driver, page_number, total_images_downloaded, downloader=None, seen_ids=None, pacer=None):
+    """Scrape images from a single Shopbop page
+
+    With a `downloader`, images are queued for background download and the browser
+    moves straight on to the next product; otherwise each image is fetched inline.
+    Only products whose ID is not yet in `seen_ids` are processed, and their IDs
+    are added to it. Waits are for readiness signals (new tiles appearing, image
+    URLs resolving, the network going quiet); `pacer` spaces out page actions.
+    """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    
+    if pacer is None:
+        pacer = ScrapePacer()
+    
     try:
         # First load the base URL
         if page_number == 1:
-            url = "https://www.shopbop.com/clothing-sweaters-knits/br/v=1/13317.htm"
-            driver.get(url)
-            random_sleep()
+            pacer.polite()
+            with pacer.waiting('page load'):
+                driver.get(LISTING_URL)
+            tiles_before = 0
         else:
             # For subsequent pages, click the "Load More" button
-            try:
-                load_more = WebDriverWait(driver, 15).until(
-                    EC.element_to_be_clickable((By.CSS_SELECTOR, "button.load-more-button"))
-                )
-                # Scroll to the button
-                driver.execute_script("arguments[0].scrollIntoView(true);", load_more)
-                random_sleep()
-                load_more.click()
-                print(f"Clicked 'Load More' button for page {page_number}")
-                random_sleep()
-            except Exception as e:
-                print(f"Could not find 'Load More' button: {str(e)}")
+            with pacer.waiting('readiness'):
+                load_more = wait_until(driver, EC.element_to_be_clickable(
+                    (By.CSS_SELECTOR, "button.load-more-button")), 15)
+            if not load_more:
+                print(f"Could not find 'Load More' button on page {page_number}")
                 return total_images_downloaded
+            tiles_before = count_tiles(driver)
+            # Scroll to the button
+            driver.execute_script("arguments[0].scrollIntoView(true);", load_more)
+            pacer.polite()
+            load_more.click()
+            print(f"Clicked 'Load More' button for page {page_number}")
         
-        # Wait for content to load
-        try:
-            # Try multiple selectors
-            selectors = [
-                (By.CSS_SELECTOR, "div.product-grid"),
-                (By.CSS_SELECTOR, "div.product-tile"),
-                (By.CSS_SELECTOR, "[data-testid='product-grid']"),
-                (By.CSS_SELECTOR, ".s-product-grid")
-            ]
-            
-            for selector in selectors:
-                try:
-                    WebDriverWait(driver, 15).until(
-                        EC.presence_of_element_located(selector)
-                    )
-                    print(f"Found products using selector: {selector}")
-                    break
-                except:
-                    continue
-        except Exception as e:
-            print(f"Warning: Timeout waiting for products on page {page_number}")
-        
-        # Scroll with random pauses
-        scroll_page(driver)
-        
-        # Parse the page
-        print("Parsing page content...")
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
+        # Wait for the new product tiles to appear
+        with pacer.waiting('readiness'):
+            if not wait_until(driver, lambda d: count_tiles(d) > tiles_before, 15):
+                print(f"Warning: Timeout waiting for products on page {page_number}")
         
-        # Try multiple selectors to find products
-        products = []
-        selectors = [
-            "product-tile",
-            "product",
-            "s-product-card",
-            "s-result-item"
-        ]
-        
-        for selector in selectors:
-            products = soup.find_all(class_=selector)
-            if products:
-                print(f"Found {len(products)} products with selector '{selector}'")
-                break
+        # Scroll through the new rows, then wait for their lazy-loaded images
+        scroll_page(driver, pacer)
+        with pacer.waiting('readiness'):
+            wait_until(driver, lambda d: d.execute_script(PENDING_IMAGES_JS, PRODUCT_TILE_CLASSES) == 0, 10)
         
+        # Extract only the tiles added by this batch
+        products = extract_new_products(driver)
         if not products:
-            print("No products found with standard selectors, trying alternative approach...")
-            products = soup.find_all('div', {'data-testid': True})
-        
-        print(f"Found {len(products)} products on page {page_number}")
-        
-        # Process only the new products (skip previously processed ones)
-        start_index = (page_number - 1) * 100
-        end_index = page_number * 100
-        products_to_process = products[start_index:end_index]
-        
-        print(f"Processing products {start_index} to {end_index}")
-        
-        for product in products_to_process:
-            # Try multiple image selectors
-            img = None
-            img_selectors = ['product-image', 'productImage', 'img']
-            for selector in img_selectors:
-                img = product.find('img', class_=selector) or product.find('img')
-                if img:
-                    break
-            
-            if not img:
-                continue
-            
-            src = img.get('src') or img.get('data-src') or img.get('srcset')
-            if not src:
-                continue
-            
-            if isinstance(src, str) and ('icon' in src.lower() or 'logo' in src.lower() or '.svg' in src.lower()):
-                continue
-            
-            # Get product name
-            product_name = get_product_info(product)
-            filename = os.path.join('shopbop_images', f'{product_name}_page{page_number}.jpg')
-            
-            # Ensure unique filename
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            while os.path.exists(filename):
-                filename = f"{base}_{counter}{ext}"
-                counter += 1
-            
-            # Download image
-            download_image(src, filename)
-            total_images_downloaded += 1
-            random_sleep()
+            print("In-browser extraction found no products, parsing page content...")
+            products = parse_products(driver.page_source)
         
-        return total_images_downloaded
+        return queue_products(products, page_number, total_images_downloaded, downloader, seen_ids, pacer)
             
     except Exception as e:
         print(f"An error occurred on page {page_number}: {str(e)}")
         return total_images_downloaded
 
-def scrape_shopbop():
-    """Main function to scrape images from Shopbop"""
+def start_downloads(workers, per_host_rate, manifest_path, on_complete=None, max_pending=None,
+                    similarity_path=None):
+    """Open the manifest for a new run and a background downloader that records into it
+
+    With `similarity_path`, new images that are near-duplicates of ones already on
+    disk are not stored again.
+    """
+    manifest = DownloadManifest(manifest_path)
+    manifest.index_directory('shopbop_images')
+    manifest.start_run()
+    similarity = None
+    if similarity_path:
+        from similarity_index import SimilarityIndex
+        similarity = SimilarityIndex(similarity_path)
+        similarity.index_directory('shopbop_images')
+    return ImageDownloader(max_workers=workers, per_host_rate=per_host_rate, manifest=manifest,
+                           on_complete=on_complete, max_pending=max_pending, similarity=similarity)
+
+def finish_downloads(downloader):
+    """Wait for queued downloads and print the download and manifest reports"""
+    stats = downloader.close()
+    print(f"Downloads finished: {stats['downloaded']} downloaded, {stats['skipped']} skipped, "
+          f"{stats['failed']} failed, {stats['bytes']} bytes")
+    manifest = downloader.manifest
+    report = manifest.finish_run()
+    manifest.close()
+    if downloader.similarity is not None:
+        downloader.similarity.save()
+    print(f"Products: {report['added']} added, {report['changed']} changed, "
+          f"{report['unchanged']} unchanged, {report['deduplicated']} deduplicated, "
+          f"{len(report['removed'])} removed")
+    for product_key in report['removed']:
+        print(f"  no longer listed: {product_key}")
+
+def scrape_shopbop(total_pages=5, workers=8, per_host_rate=4.0, manifest_path=DEFAULT_MANIFEST,
+                   actions_per_minute=DEFAULT_ACTIONS_PER_MINUTE, on_complete=None, max_pending=None,
+                   similarity_path=None):
+    """Main function to scrape images from Shopbop
+
+    The browser only collects image URLs; `workers` threads download them in the
+    background, at most `per_host_rate` requests per second per host. The manifest
+    at `manifest_path` makes re-scrapes conditional, so unchanged images are not
+    downloaded (or analyzed) again. With `total_pages=0`, "Load More" is followed
+    until a batch adds no new products. Page loads and clicks are limited to
+    `actions_per_minute` to be respectful to the server. `on_complete` and
+    `max_pending` are passed to the ImageDownloader; `similarity_path` turns on
+    near-duplicate detection.
+    """
+    pacer = ScrapePacer(actions_per_minute)
     driver = setup_driver()
     create_download_dir()
-    total_pages = 5  # First 5 pages
     total_images_downloaded = 0
+    downloader = start_downloads(workers, per_host_rate, manifest_path, on_complete, max_pending, similarity_path)
+    seen_ids = set()
     
     try:
-        for page in range(1, total_pages + 1):
-            total_images_downloaded = scrape_page(driver, page, total_images_downloaded)
-            
-            # Add a delay between pages to be respectful to the server
-            if page < total_pages:
-                time.sleep(5)  # Increased delay between pages
+        page = 1
+        while not total_pages or page <= total_pages:
+            products_before = len(seen_ids)
+            with metrics.timer('scrape_page', page=page):
+                total_images_downloaded = scrape_page(driver, page, total_images_downloaded, downloader, seen_ids,
+                                                      pacer)
+            if len(seen_ids) == products_before:
+                print(f"No new products on page {page}, stopping")
+                break
+            page += 1
                 
-        print(f"\nScraping completed! Total images downloaded: {total_images_downloaded}")
+        print(f"\nScraping completed! Total images queued: {total_images_downloaded}")
             
     except Exception as e:
         print(f"An error occurred: {str(e)}")
     
     finally:
         driver.quit()
+        print(pacer.report())
+        finish_downloads(downloader)
+
+def scrape_listings(total_pages=5, workers=8, per_host_rate=4.0, manifest_path=DEFAULT_MANIFEST,
+                    snapshot_dir=None, listing_url=LISTING_URL, actions_per_minute=DEFAULT_ACTIONS_PER_MINUTE,
+                    on_complete=None, max_pending=None, similarity_path=None):
+    """Browserless backend: read products from listing HTML without starting Chrome
+
+    Listing pages are fetched over plain HTTP, or read from the saved HTML files in
+    `snapshot_dir`, and parsed from their embedded JSON state or product tiles.
+    The records go through the same download path as the Selenium scraper.
+    """
+    pacer = ScrapePacer(actions_per_minute)
+    create_download_dir()
+    total_images_downloaded = 0
+    downloader = start_downloads(workers, per_host_rate, manifest_path, on_complete, max_pending, similarity_path)
+    seen_ids = set()
+    
+    try:
+        if snapshot_dir:
+            for page, (path, products) in enumerate(iter_snapshots(snapshot_dir), start=1):
+                print(f"Parsed {len(products)} products from {path}")
+                total_images_downloaded = queue_products(products, page, total_images_downloaded,
+                                                         downloader, seen_ids, pacer)
+        else:
+            page = 1
+            while not total_pages or page <= total_pages:
+                url = listing_page_url(page, listing_url)
+                pacer.polite()
+                with pacer.waiting('page load'):
+                    response = downloader.session.get(url, timeout=30, headers={'Accept': 'text/html,*/*;q=0.8'})
+                if response.status_code != 200:
+                    print(f"Failed to fetch listing page {page}: {url} (Status code: {response.status_code})")
+                    break
+                products_before = len(seen_ids)
+                with metrics.timer('parse_listing', page=page):
+                    products = parse_listing(response.text)
+                total_images_downloaded = queue_products(products, page, total_images_downloaded,
+                                                         downloader, seen_ids, pacer)
+                if len(seen_ids) == products_before:
+                    print(f"No new products on page {page}, stopping")
+                    break
+                page += 1
+        
+        print(f"\nScraping completed! Total images queued: {total_images_downloaded}")
+    
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+    
+    finally:
+        print(pacer.report())
+        finish_downloads(downloader)
+
+def refresh_downloads(workers=8, per_host_rate=4.0, manifest_path=DEFAULT_MANIFEST, on_complete=None,
+                      max_pending=None, similarity_path=None):
+    """Re-fetch the images of the products in the manifest without scraping the listing
+
+    Only products seen in the last finished run are fetched. Requests are
+    conditional, so only images that changed or went missing from disk are
+    downloaded again.
+    """
+    create_download_dir()
+    downloader = start_downloads(workers, per_host_rate, manifest_path, on_complete, max_pending, similarity_path)
+    try:
+        products = [p for p in downloader.manifest.products() if p['image_url'] and p['filename']]
+        for product in products:
+            downloader.submit(product['image_url'], product['filename'], product_key=product['product_key'],
+                              product_url=product['product_url'])
+        print(f"Queued {len(products)} product images from {manifest_path}")
+    finally:
+        finish_downloads(downloader)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scrape sweater images from Shopbop")
+    parser.add_argument('--pages', type=int, default=5,
+                        help="Number of listing pages to load (0 = until the listing runs out)")
+    parser.add_argument('--workers', type=int, default=8, help="Parallel image downloads")
+    parser.add_argument('--host-rate', type=float, default=4.0,
+                        help="Maximum download requests per second per host")
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                        help=f"Download manifest used to skip unchanged images (default: {DEFAULT_MANIFEST})")
+    parser.add_argument('--no-browser', action='store_true',
+                        help="Fetch listing pages over plain HTTP and parse them without Chrome")
+    parser.add_argument('--snapshots', metavar='DIR',
+                        help="Parse saved listing HTML files from DIR instead of fetching (implies --no-browser)")
+    parser.add_argument('--listing-url', default=LISTING_URL, help="Listing to scrape with --no-browser")
+    parser.add_argument('--actions-per-minute', type=float, default=DEFAULT_ACTIONS_PER_MINUTE,
+                        help="Politeness budget for page loads, clicks and inline downloads")
+    parser.add_argument('--similarity', metavar='DIR',
+                        help="Similarity index used to skip near-duplicate images")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Re-fetch the images of the products in the manifest instead of scraping")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    start_metrics(args)
+    if args.refresh:
+        refresh_downloads(workers=args.workers, per_host_rate=args.host_rate, manifest_path=args.manifest,
+                          similarity_path=args.similarity)
+    elif args.no_browser or args.snapshots:
+        scrape_listings(total_pages=args.pages, workers=args.workers, per_host_rate=args.host_rate,
+                        manifest_path=args.manifest, snapshot_dir=args.snapshots, listing_url=args.listing_url,
+                        actions_per_minute=args.actions_per_minute, similarity_path=args.similarity)
+    else:
+        scrape_shopbop(total_pages=args.pages, workers=args.workers, per_host_rate=args.host_rate,
+                       manifest_path=args.manifest, actions_per_minute=args.actions_per_minute,
+                       similarity_path=args.similarity)
+    print(metrics.format_summary())
+    metrics.close()
 
 if __name__ == "__main__":
-    scrape_shopbop() 
\ No newline at end of file
+    main()
@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from analysis_cache import hash_file
+
+DEFAULT_MANIFEST = "download_manifest.sqlite"
+STATUSES = ("added", "changed", "unchanged", "deduplicated", "failed")
+
+
+class DownloadManifest:
+    """Persistent record of every product image the scraper has seen.
+
+    Maps product keys to their file, content hash, ETag/Last-Modified and
+    first/last-seen times, and indexes files by content hash so identical
+    images under a new name are not stored twice. Safe to share between
+    download threads.
+    """
+
+    def __init__(self, path: str = DEFAULT_MANIFEST):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS products (
+                product_key TEXT PRIMARY KEY,
+                product_url TEXT,
+                image_url TEXT,
+                filename TEXT,
+                content_hash TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                last_changed TEXT
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                content_hash TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TEXT NOT NULL,
+                finished_at TEXT,
+                added INTEGER DEFAULT 0,
+                changed INTEGER DEFAULT 0,
+                unchanged INTEGER DEFAULT 0,
+                deduplicated INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                removed INTEGER DEFAULT 0
+            );
+        """)
+        self.conn.commit()
+        self.run_id = None
+        self.run_started = None
+        self.counts = dict.fromkeys(STATUSES, 0)
+
+    def start_run(self) -> int:
+        with self.lock, self.conn:
+            self.run_started = datetime.now().isoformat()
+            self.run_id = self.conn.execute("INSERT INTO runs (started_at) VALUES (?)",
+                                            (self.run_started,)).lastrowid
+            self.counts = dict.fromkeys(STATUSES, 0)
+        return self.run_id
+
+    def get(self, product_key: str):
+        with self.lock:
+            self.conn.row_factory = sqlite3.Row
+            row = self.conn.execute("SELECT * FROM products WHERE product_key = ?", (product_key,)).fetchone()
+            self.conn.row_factory = None
+        return dict(row) if row else None
+
+    def products(self, listed_only: bool = True):
+        """Product entries; by default only those seen in the last finished run, i.e. still listed."""
+        query = "SELECT * FROM products"
+        if listed_only:
+            query += (" WHERE last_seen >= (SELECT COALESCE(MAX(started_at), '') FROM runs"
+                      " WHERE finished_at IS NOT NULL)")
+        with self.lock:
+            self.conn.row_factory = sqlite3.Row
+            rows = self.conn.execute(query + " ORDER BY product_key").fetchall()
+            self.conn.row_factory = None
+        return [dict(row) for row in rows]
+
+    def find_file(self, content_hash: str):
+        """Existing file with this content, if it is still on disk."""
+        with self.lock:
+            row = self.conn.execute("SELECT filename FROM files WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row and os.path.exists(row[0]):
+            return row[0]
+        return None
+
+    def is_shared(self, filename: str, product_key: str) -> bool:
+        """True if another product points at `filename` (it was deduplicated onto it)."""
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM products WHERE filename = ? AND product_key != ? LIMIT 1",
+                                    (filename, product_key)).fetchone()
+        return row is not None
+
+    def index_file(self, filename: str, content_hash: str = None):
+        stat = os.stat(filename)
+        content_hash = content_hash or hash_file(filename)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files (content_hash, filename, size, mtime) VALUES (?, ?, ?, ?)",
+                              (content_hash, str(filename), stat.st_size, stat.st_mtime))
+        return content_hash
+
+    def index_directory(self, directory: str, pattern: str = "*.jpg") -> int:
+        """Hash images already on disk so new downloads can be deduplicated against them."""
+        with self.lock:
+            known = {row[0]: (row[1], row[2]) for row in
+                     self.conn.execute("SELECT filename, size, mtime FROM files")}
+        indexed = 0
+        for path in Path(directory).glob(pattern):
+            stat = path.stat()
+            if known.get(str(path)) != (stat.st_size, stat.st_mtime):
+                self.index_file(str(path))
+                indexed += 1
+        return indexed
+
+    def record(self, product_key: str, status: str, product_url: str = None, image_url: str = None,
+               filename: str = None, content_hash: str = None, etag: str = None, last_modified: str = None):
+        """Record the outcome of fetching a product image in the current run.
+
+        A failed fetch still counts as seeing a known product, so it stays listed,
+        but its file and content fields keep the last good download.
+        """
+        now = datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.counts[status] += 1
+            existing = self.get(product_key)
+            if status == "failed":
+                if existing is not None:
+                    self.conn.execute(
+                        "UPDATE products SET last_seen = ?, product_url = COALESCE(?, product_url), "
+                        "image_url = COALESCE(?, image_url) WHERE product_key = ?",
+                        (now, product_url, image_url, product_key))
+                return
+            if existing is None:
+                self.conn.execute(
+                    "INSERT INTO products (product_key, product_url, image_url, filename, content_hash, etag, "
+                    "last_modified, first_seen, last_seen, last_changed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (product_key, product_url, image_url, filename, content_hash, etag, last_modified, now, now, now))
+            elif status == "unchanged":
+                self.conn.execute(
+                    "UPDATE products SET last_seen = ?, image_url = COALESCE(?, image_url), "
+                    "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE product_key = ?",
+                    (now, image_url, etag, last_modified, product_key))
+            else:
+                self.conn.execute(
+                    "UPDATE products SET product_url = COALESCE(?, product_url), image_url = ?, filename = ?, "
+                    "content_hash = ?, etag = ?, last_modified = ?, last_seen = ?, last_changed = ? "
+                    "WHERE product_key = ?",
+                    (product_url, image_url, filename, content_hash, etag, last_modified, now, now, product_key))
+            if content_hash and filename and status in ("added", "changed"):
+                self.index_file(filename, content_hash)
+
+    def finish_run(self):
+        """Close the current run and return its report, including products not seen this time."""
+        with self.lock, self.conn:
+            removed = [row[0] for row in self.conn.execute(
+                "SELECT product_key FROM products WHERE last_seen < ? ORDER BY product_key", (self.run_started,))]
+            self.conn.execute(
+                "UPDATE runs SET finished_at = ?, added = ?, changed = ?, unchanged = ?, deduplicated = ?, "
+                "failed = ?, removed = ? WHERE run_id = ?",
+                (datetime.now().isoformat(), self.counts["added"], self.counts["changed"],
+                 self.counts["unchanged"], self.counts["deduplicated"], self.counts["failed"],
+                 len(removed), self.run_id))
+        report = dict(self.counts)
+        report["removed"] = removed
+        return report
+
+    def close(self):
+        self.conn.close()
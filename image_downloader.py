@@ -0,0 +1,307 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from metrics import metrics
+from rate_limiter import TokenBucket
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Referer': 'https://www.shopbop.com/'
+}
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def make_session(pool_size=8):
+    """Create a requests Session whose connection pool fits `pool_size` concurrent downloads."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    return session
+
+
+def verify_image(path, expected_length=None):
+    """Check that a downloaded file is complete and decodes as an image."""
+    if expected_length is not None and os.path.getsize(path) != expected_length:
+        return False
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            # load() decodes the pixel data, which catches truncated files that verify() misses
+            image.load()
+        return True
+    except Exception:
+        return False
+
+
+def fetch(session, url, tmp_filename, headers=None, retries=3, backoff=1.0, timeout=30, limiter=None):
+    """Fetch `url` into `tmp_filename`, retrying transient failures.
+
+    Returns None on failure, {"status": 304} when a conditional request found the
+    image unchanged, or {"status": 200, "bytes", "sha256", "etag", "last_modified"}
+    once the body has been written and passed the integrity check. A retry waits
+    for the jittered backoff or the server's Retry-After, whichever is longer.
+    """
+    import requests
+
+    retry_after = 0
+    for attempt in range(retries + 1):
+        if attempt:
+            with metrics.timer("download_backoff_wait"):
+                time.sleep(max(retry_after, backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)))
+            retry_after = 0
+        if limiter:
+            wait = limiter.reserve(1)
+            if wait > 0:
+                with metrics.timer("download_rate_wait"):
+                    time.sleep(wait)
+        started = time.perf_counter()
+        try:
+            response = session.get(url, stream=True, timeout=timeout, headers=headers)
+            try:
+                if response.status_code == 304:
+                    return {"status": 304, "etag": response.headers.get('ETag'),
+                            "last_modified": response.headers.get('Last-Modified')}
+                if response.status_code in RETRY_STATUS_CODES:
+                    header = response.headers.get('Retry-After')
+                    if header and header.isdigit():
+                        retry_after = int(header)
+                    if attempt < retries:
+                        print(f"Retrying {url} (Status code: {response.status_code})")
+                    continue
+                if response.status_code != 200:
+                    print(f"Failed to download: {url} (Status code: {response.status_code})")
+                    return None
+
+                written = 0
+                digest = hashlib.sha256()
+                with open(tmp_filename, 'wb') as f:
+                    for chunk in response.iter_content(64 * 1024):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        written += len(chunk)
+            finally:
+                response.close()
+
+            length = response.headers.get('Content-Length')
+            expected = int(length) if length and length.isdigit() and 'Content-Encoding' not in response.headers else None
+            if not verify_image(tmp_filename, expected):
+                print(f"Incomplete or corrupt image from {url}, retrying")
+                os.remove(tmp_filename)
+                continue
+            metrics.count("bytes_downloaded", written)
+            return {"status": 200, "bytes": written, "sha256": digest.hexdigest(),
+                    "etag": response.headers.get('ETag'),
+                    "last_modified": response.headers.get('Last-Modified')}
+        except requests.RequestException as e:
+            print(f"Error downloading {url}: {str(e)}")
+        finally:
+            # Transfer and integrity check of one attempt, without the waits above
+            metrics.observe("download", time.perf_counter() - started, url=url, attempt=attempt)
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    print(f"Giving up on {url} after {retries + 1} attempts")
+    return None
+
+
+def download_to_file(session, url, filename, retries=3, backoff=1.0, timeout=30, limiter=None):
+    """Download `url` into `filename` atomically, retrying transient failures.
+
+    The body is streamed to a temporary file that is renamed into place only once
+    it passes the integrity check, so a crash never leaves a truncated image.
+    Returns the number of bytes written, or None if the download failed.
+    """
+    tmp_filename = f"{filename}.part"
+    result = fetch(session, url, tmp_filename, retries=retries, backoff=backoff, timeout=timeout, limiter=limiter)
+    if result is None or result["status"] != 200:
+        return None
+    os.replace(tmp_filename, filename)
+    return result["bytes"]
+
+
+class ImageDownloader:
+    """Background image downloads over a pooled session with a per-host rate limit.
+
+    The scraper submits (url, filename) pairs and keeps going; downloads run on
+    a thread pool. Each host gets its own token bucket so parallel workers still
+    respect `per_host_rate` requests per second. With a DownloadManifest, known
+    products are fetched with conditional requests and identical content is
+    stored only once. A SimilarityIndex extends that to near-duplicates (the
+    same shot re-encoded or resized). With `max_pending`, submit() blocks while
+    that many downloads are queued or running, so a slow consumer in
+    on_complete slows the scraper down instead of letting the queue grow.
+    """
+
+    def __init__(self, max_workers=8, per_host_rate=4.0, retries=3, backoff=1.0, timeout=30,
+                 on_complete=None, manifest=None, max_pending=None, similarity=None):
+        self.session = make_session(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.per_host_rate = per_host_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.on_complete = on_complete
+        self.manifest = manifest
+        self.similarity = similarity
+        self.slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.lock = threading.Lock()
+        self.host_limiters = {}
+        self.claimed = set()
+        self.stats = {"queued": 0, "downloaded": 0, "failed": 0, "skipped": 0, "bytes": 0}
+
+    def _limiter_for(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limiters:
+                self.host_limiters[host] = TokenBucket(self.per_host_rate * 60, capacity=1)
+            return self.host_limiters[host]
+
+    def is_claimed(self, filename):
+        """True if `filename` exists or is already queued for download."""
+        with self.lock:
+            return filename in self.claimed or os.path.exists(filename)
+
+    def submit(self, url, filename, product_key=None, product_url=None, **metadata):
+        """Queue a download; `metadata` is passed on to the on_complete callback."""
+        if self.slots:
+            self.slots.acquire()
+        with self.lock:
+            self.claimed.add(filename)
+            self.stats["queued"] += 1
+        if self.manifest is not None:
+            future = self.executor.submit(self._run_with_manifest, url, filename,
+                                          product_key or url, product_url, metadata)
+        else:
+            future = self.executor.submit(self._run, url, filename, metadata)
+        if self.slots:
+            future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _run_with_manifest(self, url, filename, product_key, product_url, metadata):
+        """Download one product image, using the manifest to skip unchanged and duplicate content."""
+        entry = self.manifest.get(product_key)
+        headers = {}
+        if entry and entry["filename"] and os.path.exists(entry["filename"]):
+            filename = entry["filename"]
+            if entry["etag"]:
+                headers['If-None-Match'] = entry["etag"]
+            if entry["last_modified"]:
+                headers['If-Modified-Since'] = entry["last_modified"]
+        else:
+            entry = None
+
+        tmp_filename = f"{filename}.part"
+        record = {"product_url": product_url, "image_url": url}
+        try:
+            result = fetch(self.session, url, tmp_filename, headers=headers, retries=self.retries,
+                           backoff=self.backoff, timeout=self.timeout, limiter=self._limiter_for(url))
+            if result is None:
+                status = "failed"
+            elif result["status"] == 304:
+                status = "unchanged"
+                record.update(etag=result["etag"], last_modified=result["last_modified"])
+            else:
+                record.update(content_hash=result["sha256"], etag=result["etag"],
+                              last_modified=result["last_modified"])
+                # Described outside the manifest lock so other downloads are not held up
+                descriptor = self.similarity.describe(tmp_filename) if self.similarity is not None else None
+                with self.manifest.lock:
+                    duplicate = self.manifest.find_file(result["sha256"])
+                    if not duplicate and not entry:
+                        duplicate = self._near_duplicate(descriptor)
+                    if entry and entry["content_hash"] == result["sha256"]:
+                        status = "unchanged"
+                        os.remove(tmp_filename)
+                    elif duplicate and not entry:
+                        status = "deduplicated"
+                        filename = duplicate
+                        os.remove(tmp_filename)
+                    else:
+                        status = "changed" if entry else "added"
+                        if entry and self.manifest.is_shared(filename, product_key):
+                            # Other products still use the old content; give this one its own file
+                            base, ext = os.path.splitext(filename)
+                            filename = f"{base}_{result['sha256'][:8]}{ext}"
+                        os.replace(tmp_filename, filename)
+                        if self.similarity is not None:
+                            self.similarity.add(filename, descriptor=descriptor)
+                    record["filename"] = filename
+                    self.manifest.record(product_key, status, **record)
+        except Exception as e:
+            # A failed write, rename or descriptor must not vanish into the executor's future
+            print(f"Error saving {url}: {str(e)}")
+            status, result = "failed", None
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        if result is None or result["status"] == 304:
+            self.manifest.record(product_key, status, **record)
+
+        metrics.count(f"downloads_{status}")
+        with self.lock:
+            if status == "failed":
+                self.stats["failed"] += 1
+            elif status in ("added", "changed"):
+                self.stats["downloaded"] += 1
+                self.stats["bytes"] += result["bytes"]
+            else:
+                self.stats["skipped"] += 1
+        if status in ("added", "changed"):
+            print(f"Successfully downloaded: {filename}")
+        if self.on_complete:
+            self.on_complete(url, filename, status != "failed", dict(metadata, status=status))
+        return status
+
+    def _near_duplicate(self, descriptor):
+        """Existing file that is a near-duplicate of the described image, if any."""
+        if descriptor is None:
+            return None
+        # The closest match may be a file that was removed since; try them all
+        return next((near for near in self.similarity.near_duplicates([descriptor])[0] if os.path.exists(near)),
+                    None)
+
+    def _run(self, url, filename, metadata):
+        try:
+            written = download_to_file(self.session, url, filename, retries=self.retries, backoff=self.backoff,
+                                       timeout=self.timeout, limiter=self._limiter_for(url))
+        except Exception as e:
+            print(f"Error saving {url}: {str(e)}")
+            written = None
+            if os.path.exists(f"{filename}.part"):
+                os.remove(f"{filename}.part")
+        metrics.count("downloads_failed" if written is None else "downloads_added")
+        with self.lock:
+            if written is None:
+                self.stats["failed"] += 1
+            else:
+                self.stats["downloaded"] += 1
+                self.stats["bytes"] += written
+        if written is not None:
+            print(f"Successfully downloaded: {filename}")
+        if self.on_complete:
+            self.on_complete(url, filename, written is not None, metadata)
+        return written
+
+    def close(self, wait=True):
+        """Wait for queued downloads to finish and return the download stats."""
+        self.executor.shutdown(wait=wait)
+        self.session.close()
+        return dict(self.stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,133 @@
+import hashlib
+import io
+import logging
+import math
+from pathlib import Path
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREPROCESS_DIR = ".preprocessed_images"
+DETAIL_LEVELS = ("low", "high", "auto")
+
+# OpenAI vision billing: images are fit into 2048x2048, the short side is scaled
+# down to 768, and each 512px tile costs 170 tokens on top of a 85 token base
+TILE_SIZE = 512
+TILE_TOKENS = 170
+BASE_IMAGE_TOKENS = 85
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Estimate the vision tokens billed for an image of the given size."""
+    if detail == "low":
+        return BASE_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_IMAGE_TOKENS + TILE_TOKENS * tiles
+
+
+def crop_uniform_margins(image, tolerance: int = 12, padding: int = 8):
+    """Crop borders of a PIL image that match the background color sampled from its corners."""
+    from PIL import Image, ImageChops
+
+    rgb = image.convert("RGB")
+    width, height = rgb.size
+    corners = [rgb.getpixel((0, 0)), rgb.getpixel((width - 1, 0)),
+               rgb.getpixel((0, height - 1)), rgb.getpixel((width - 1, height - 1))]
+    background = tuple(sorted(channel)[len(channel) // 2] for channel in zip(*corners))
+    diff = ImageChops.difference(rgb, Image.new("RGB", rgb.size, background))
+    mask = diff.convert("L").point(lambda value: 255 if value > tolerance else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - padding), max(0, top - padding),
+            min(width, right + padding), min(height, bottom + padding))
+    return image.crop(bbox)
+
+
+def tile_aligned_size(width: int, height: int, max_side: int, snap_tolerance: float = 0.15):
+    """Scale (width, height) to fit `max_side`, shrinking a little more when that saves a tile."""
+    scale = min(1.0, max_side / max(width, height))
+    for side in (width, height):
+        scaled = side * scale
+        boundary = math.floor(scaled / TILE_SIZE) * TILE_SIZE
+        if boundary and boundary < scaled and boundary / scaled >= 1 - snap_tolerance:
+            scale = min(scale, boundary / side)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+class ImagePreprocessor:
+    """Shrinks product images before upload and caches the derived JPEG bytes on disk."""
+
+    def __init__(self, max_side: int = 1024, quality: int = 85, detail: str = "high",
+                 crop_tolerance: int = 12, cache_dir: str = DEFAULT_PREPROCESS_DIR):
+        if detail not in DETAIL_LEVELS:
+            raise ValueError(f"detail must be one of {DETAIL_LEVELS}")
+        self.max_side = TILE_SIZE if detail == "low" else max_side
+        self.quality = quality
+        self.detail = detail
+        self.crop_tolerance = crop_tolerance
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.totals = {"images": 0, "bytes_before": 0, "bytes_after": 0,
+                       "tokens_before": 0, "tokens_after": 0}
+
+    def signature(self) -> str:
+        """Describe the settings that affect the derived image, for use in cache keys."""
+        return f"max_side={self.max_side};quality={self.quality};detail={self.detail};crop={self.crop_tolerance}"
+
+    def _transform(self, source: bytes) -> bytes:
+        from PIL import Image, ImageOps
+
+        with Image.open(io.BytesIO(source)) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image = crop_uniform_margins(image, tolerance=self.crop_tolerance)
+            size = tile_aligned_size(*image.size, max_side=self.max_side)
+            if size != image.size:
+                image = image.resize(size, Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=self.quality, optimize=True)
+            return output.getvalue()
+
+    def process(self, image_path) -> Dict:
+        """Return the derived image bytes for `image_path` along with the savings achieved."""
+        # Pillow is imported on first use, so importing the analyzer does not load it
+        from PIL import Image
+
+        with open(image_path, "rb") as f:
+            source = f.read()
+        digest = hashlib.sha256(source + self.signature().encode("utf-8")).hexdigest()
+        cached_path = self.cache_dir / f"{digest}.jpg"
+        if cached_path.exists():
+            data = cached_path.read_bytes()
+        else:
+            data = self._transform(source)
+            tmp_path = cached_path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(cached_path)
+
+        with Image.open(io.BytesIO(source)) as original:
+            tokens_before = estimate_image_tokens(*original.size, detail="high")
+        with Image.open(io.BytesIO(data)) as derived:
+            width, height = derived.size
+        tokens_after = estimate_image_tokens(width, height, detail=self.detail)
+
+        result = {
+            "data": data,
+            "width": width,
+            "height": height,
+            "bytes_before": len(source),
+            "bytes_after": len(data),
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+        }
+        for key in ("bytes_before", "bytes_after", "tokens_before", "tokens_after"):
+            self.totals[key] += result[key]
+        self.totals["images"] += 1
+        logger.info("Preprocessed %s: %d -> %d bytes, ~%d -> ~%d image tokens",
+                    image_path, len(source), len(data), tokens_before, tokens_after)
+        return result
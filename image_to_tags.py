@@ -1,34 +1,124 @@
 import os
 from pathlib import Path
 import json
-from openai import OpenAI
+import argparse
+import asyncio
 import base64
-import shutil
 import logging
 from datetime import datetime
 import time
 from tqdm import tqdm
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('image_analysis.log'),
-        logging.StreamHandler()
-    ]
-)
+from rate_limiter import RateLimiter
+from analysis_template import TEMPLATE_VERSION, analysis_prompt
+from analysis_cache import DEFAULT_CACHE, AnalysisCache, hash_file, make_cache_key
+from canonicalize import add_canonical
+from batch_api import MAX_BATCH_BYTES, MAX_BATCH_REQUESTS, export_batch_requests, ingest_batch_results
+from image_preprocess import DEFAULT_PREPROCESS_DIR, DETAIL_LEVELS, TILE_SIZE, ImagePreprocessor, estimate_image_tokens
+from result_store import DEFAULT_STORE, LEGACY_JSON, open_result_store, import_legacy_json, export_legacy_json
+from request_controller import DEFAULT_DEAD_LETTER, RequestController
+from structured_output import (STRUCTURED_MAX_TOKENS, STRUCTURED_VERSION, expand_response, log_savings,
+                               response_format, structured_prompt)
+from metrics import add_metrics_arguments, metrics, start_metrics
+from work_queue import DEFAULT_BATCH_SIZE, DEFAULT_LEASE_TTL, DEFAULT_QUEUE, WorkQueue, run_worker
+from multi_image import (BATCH_PROMPT_VERSION, LABEL_TOKENS, MAX_OUTPUT_TOKENS, AdaptiveBatchSize, batch_prompt,
+                         batch_response_format, image_label, images_per_request, product_metadata, split_results)
+
+LOG_FILE = 'image_analysis.log'
+
 logger = logging.getLogger(__name__)
 
-# OpenAI API configuration
-api_key = os.getenv('OPENAI_API_KEY')
-if not api_key:
-    raise ValueError("Please set the OPENAI_API_KEY environment variable")
-client = OpenAI(api_key=api_key)
+# OpenAI clients are created on first use, so importing this module needs
+# neither credentials nor the openai package's import time
+client = None
+async_client = None
+
+MODEL = "gpt-4o"
+MAX_TOKENS = 1500
+TEMPERATURE = 0.5
+
+# Default limits match the gpt-4o tier 1 quota; raise them for higher tiers
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 30000
+
+# A "high" detail image is billed at up to 765 tokens for a typical product shot
+HIGH_DETAIL_IMAGE_TOKENS = 765
+
+# "json" asks for free-form JSON following the template; "structured" uses a strict
+# schema of short keys and enum codes that is expanded locally
+OUTPUT_MODES = ("json", "structured")
+
+def setup_logging(log_file=LOG_FILE):
+    """Log to the console and to `log_file`; called by the command line entry points."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
+
+def get_api_key():
+    """The OpenAI API key from the environment or a .env file."""
+    from dotenv import load_dotenv
+    load_dotenv()
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        raise ValueError("Please set the OPENAI_API_KEY environment variable")
+    return api_key
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(api_key=get_api_key())
+    return client
+
+def get_async_client():
+    """Return the shared AsyncOpenAI client, creating it on first use."""
+    global async_client
+    if async_client is None:
+        from openai import AsyncOpenAI
+        async_client = AsyncOpenAI(api_key=get_api_key())
+    return async_client
+
+def prompt_for(output_mode="json", omit=()):
+    return structured_prompt(omit) if output_mode == "structured" else analysis_prompt(omit)
+
+def omitted_fields(color_analyzer=None):
+    """Template leaves the model is not asked for because `color_analyzer` computes them."""
+    if not color_analyzer:
+        return ()
+    from color_analyzer import LOCAL_FIELDS
+    return LOCAL_FIELDS
+
+def max_tokens_for(output_mode="json"):
+    return STRUCTURED_MAX_TOKENS if output_mode == "structured" else MAX_TOKENS
+
+def estimate_request_tokens(image_tokens=HIGH_DETAIL_IMAGE_TOKENS, output_mode="json", omit=()):
+    """Rough upper bound on the tokens one analysis request counts against the TPM limit."""
+    return len(prompt_for(output_mode, omit)) // 4 + image_tokens + max_tokens_for(output_mode)
+
+def cache_key_for(image_path, preprocessor=None, detail="high", output_mode="json", color_analyzer=None,
+                  batched=False):
+    """Cache key for analyzing `image_path` with the current model, prompt and template.
+
+    Analyses from batched requests are keyed apart, since their prompt differs.
+    """
+    extra = f"max_tokens={max_tokens_for(output_mode)};temperature={TEMPERATURE};detail={detail}"
+    if output_mode == "structured":
+        extra += f";structured={STRUCTURED_VERSION}"
+    if batched:
+        extra += f";batched={BATCH_PROMPT_VERSION}"
+    if preprocessor:
+        extra += ";" + preprocessor.signature()
+    if color_analyzer:
+        extra += ";" + color_analyzer.signature()
+    prompt = prompt_for(output_mode, omitted_fields(color_analyzer))
+    with metrics.timer("cache_key"):
+        return make_cache_key(hash_file(image_path), MODEL, prompt, TEMPLATE_VERSION, extra=extra)
 
 def encode_image(image_path):
     """Encode image to base64."""
@@ -41,230 +131,922 @@ def encode_image(image_path):
         logger.error("Failed to encode image %s: %s", image_path, str(e))
         raise
 
-def analyze_image(image_path, category="sweaters", product_metadata=None):
-    """Analyze image using OpenAI's Vision model with focus on design details, styles, and colors."""
+def prepare_image(image_path, preprocessor=None):
+    """Return the base64 payload for `image_path`, shrunk first when a preprocessor is given."""
+    with metrics.timer("encode"):
+        if preprocessor is None:
+            return encode_image(image_path)
+        return base64.b64encode(preprocessor.process(image_path)["data"]).decode('utf-8')
+
+def build_request(base64_image, detail="high", output_mode="json", omit=()):
+    """Build the chat completion arguments for analyzing one encoded image.
+
+    The prompt comes first and never varies, so requests share a cacheable prefix.
+    Template leaves in `omit` are left out of the prompt.
+    """
+    return {
+        "model": MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt_for(output_mode, omit)
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}",
+                            "detail": detail
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": max_tokens_for(output_mode),
+        "temperature": TEMPERATURE,
+        "response_format": response_format(omit) if output_mode == "structured" else { "type": "json_object" }
+    }
+
+def build_batch_request(images, detail="high", output_mode="json", omit=()):
+    """Build the chat completion arguments for analyzing several encoded images in one request.
+
+    `images` are (id, base64 image, metadata) triples. Each image follows a text
+    line with its id and product metadata, and the answer is a list of
+    per-image analyses (see multi_image).
+    """
+    content = [{"type": "text", "text": batch_prompt(prompt_for(output_mode, omit))}]
+    for image_id, base64_image, metadata in images:
+        content.append({"type": "text", "text": image_label(image_id, metadata)})
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64_image}",
+                "detail": detail
+            }
+        })
+    single_format = response_format(omit) if output_mode == "structured" else { "type": "json_object" }
+    return {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": min(MAX_OUTPUT_TOKENS, max_tokens_for(output_mode) * len(images)),
+        "temperature": TEMPERATURE,
+        "response_format": batch_response_format(single_format)
+    }
+
+def parse_batch_response(response, ids, output_mode="json", omit=()):
+    """Split a batched response into {id: analysis} for the ids it answered validly.
+
+    Raises ValueError (or json.JSONDecodeError) when the content is unusable as a whole.
+    """
+    content = response.choices[0].message.content
+    if content is None:
+        raise ValueError("Response has no content")
+    results = split_results(content, ids)
+    if output_mode == "structured":
+        for image_id, payload in list(results.items()):
+            try:
+                results[image_id] = expand_response(payload, omit)
+            except ValueError as e:
+                logger.warning("Dropping invalid batched result for image %s: %s", image_id, e)
+                del results[image_id]
+    return results
+
+def parse_response(response, output_mode="json", label="", omit=()):
+    """Extract the JSON analysis from a chat completion response.
+
+    Structured responses are validated and expanded into the template layout.
+    Raises ValueError (or json.JSONDecodeError) when the content is unusable.
+    """
+    content = response.choices[0].message.content
+    if content is None:
+        raise ValueError("Response has no content")
+    result = json.loads(content)
+    if output_mode == "structured":
+        result = expand_response(result, omit)
+        log_savings(result, getattr(response, "usage", None), label)
+    logger.info("Successfully parsed JSON response")
+    return result
+
+def add_local_colors(analysis, image_path, color_analyzer=None):
+    """Fill the color fields computed from pixels into a model analysis."""
+    if analysis is None or color_analyzer is None:
+        return analysis
+    from color_analyzer import merge_local_fields
+    with metrics.timer("local_colors"):
+        return merge_local_fields(analysis, color_analyzer.analyze(image_path)["fields"])
+
+def settle_usage(limiter, estimated_tokens, usages):
+    """Correct the limiter's token budget, charged `estimated_tokens` up front, with a request's real usage.
+
+    `usages` holds the usage of every answered attempt, so a response that was
+    paid for and then retried is charged too. Settle once per reservation.
+    """
+    totals = [usage.total_tokens for usage in usages if getattr(usage, "total_tokens", None) is not None]
+    if limiter is not None and estimated_tokens and totals:
+        limiter.record_usage(estimated_tokens, sum(totals))
+
+def analyze_image(image_path, category="sweaters", product_metadata=None, preprocessor=None, detail="high",
+                  output_mode="json", controller=None, color_analyzer=None, limiter=None, estimated_tokens=None):
+    """Analyze image using OpenAI's Vision model with focus on design details, styles, and colors.
+
+    With a RequestController, failed requests are retried and images that fail
+    for good are dead-lettered; otherwise a failure returns None straight away.
+    With a ColorAnalyzer, the color fields it covers are computed locally
+    instead of being requested from the model. The caller acquires
+    `estimated_tokens` from the `limiter`; retries acquire another request,
+    and the real usage of every attempt is settled once the call is over.
+    """
     start_time = time.time()
     logger.info("Starting analysis of image: %s (Category: %s)", image_path, category)
     
     try:
-        base64_image = encode_image(image_path)
-        
-        # Updated JSON template prioritizing design and style elements
-        json_template = '''{
-  "design": {
-    "silhouette": {
-      "primary_style": ["Fitted", "Oversized", "Relaxed", "Slim", "Boxy", "Cropped"],
-      "shape_details": ["A-line", "Straight", "Trapeze", "Cocoon", "Hourglass"],
-      "key_proportions": ["Cropped", "Hip-length", "Tunic", "Oversized", "Fitted"],
-      "design_era": ["Contemporary", "Vintage-inspired", "Modern", "Classic", "Avant-garde"]
-    },
-    "color_analysis": {
-      "primary_color": {
-        "name": ["Black", "Navy", "Cream", "Grey", "Camel", "White", "Red", "Other"],
-        "tone": ["Warm", "Cool", "Neutral"],
-        "intensity": ["Vibrant", "Muted", "Pastel", "Deep", "Light"],
-        "finish": ["Matte", "Heathered", "Marled", "Space-dyed"]
-      },
-      "color_combinations": {
-        "scheme": ["Solid", "Two-tone", "Multi-color", "Ombré", "Color-blocked"],
-        "contrast_level": ["High", "Medium", "Low", "Tonal"],
-        "color_harmony": ["Monochromatic", "Complementary", "Analogous", "Triadic"]
-      },
-      "pattern_colors": {
-        "background": ["Light", "Dark", "Medium", "Multi"],
-        "accent_colors": ["Contrast", "Tonal", "Multi-colored", "None"],
-        "color_distribution": ["Even", "Dominated", "Gradient", "Random"]
-      },
-      "seasonal_palette": ["Spring", "Summer", "Fall", "Winter", "Year-round"]
-    },
-    "knit_patterns": {
-      "primary_pattern": ["Cable knit", "Ribbed", "Fair Isle", "Argyle", "Intarsia", "Plain stitch"],
-      "texture_elements": ["Chunky cables", "Fine ribs", "Honeycomb", "Popcorn", "Lattice"],
-      "pattern_placement": ["All-over", "Front panel", "Yoke", "Sleeves", "Hem"],
-      "pattern_complexity": ["Simple", "Moderate", "Complex", "Multi-technique"],
-      "pattern_scale": ["Fine", "Medium", "Large", "Mixed"],
-      "pattern_rhythm": ["Regular", "Irregular", "Graduated", "Random"]
-    },
-    "style_details": {
-      "neckline": {
-        "style": ["Crew", "V-neck", "Turtleneck", "Mock neck", "Boat neck", "Cowl"],
-        "design_features": ["Ribbed", "Folded", "Split", "Contrast", "Decorative"],
-        "depth": ["High", "Medium", "Low", "Plunging"],
-        "width": ["Narrow", "Standard", "Wide"]
-      },
-      "sleeves": {
-        "style": ["Raglan", "Set-in", "Drop shoulder", "Dolman", "Bishop", "Bell"],
-        "design_elements": ["Ribbed cuff", "Balloon", "Fitted", "Wide", "Statement"],
-        "length": ["Full", "Three-quarter", "Short", "Cap", "Sleeveless"],
-        "cuff_detail": ["Plain", "Ribbed", "Decorative", "Contrast", "Split"]
-      },
-      "hem_design": {
-        "style": ["Ribbed", "Split", "Curved", "Straight", "Asymmetric"],
-        "details": ["Side slits", "High-low", "Banded", "Raw edge", "Decorative"],
-        "length": ["Cropped", "Standard", "Extended", "Variable"],
-        "finish": ["Clean", "Distressed", "Decorative", "Contrast"]
-      }
-    },
-    "decorative_elements": {
-      "trims": ["Contrast edges", "Metallic details", "Buttons", "Zippers", "None"],
-      "embellishments": ["Embroidery", "Beading", "Appliqué", "Sequins", "None"],
-      "special_techniques": ["Color blocking", "Mixed stitch", "Openwork", "Fringe", "None"],
-      "hardware": {
-        "type": ["Buttons", "Zippers", "Toggles", "Snaps", "None"],
-        "finish": ["Metal", "Plastic", "Wood", "Horn", "Covered"],
-        "placement": ["Front", "Shoulder", "Cuff", "None"]
-      }
-    }
-  },
-  "style_classification": {
-    "aesthetic": {
-      "primary": ["Minimalist", "Bohemian", "Preppy", "Avant-garde", "Classic"],
-      "secondary": ["Romantic", "Sporty", "Artisanal", "Contemporary", "Vintage"],
-      "design_influences": ["Scandinavian", "French", "American", "Japanese", "Italian"]
-    },
-    "trend_alignment": {
-      "current_trends": ["On-trend", "Classic", "Forward", "Timeless"],
-      "trend_longevity": ["Seasonal", "Multi-season", "Timeless", "Trend-focused"],
-      "design_innovation": ["Traditional", "Contemporary", "Experimental", "Hybrid"]
-    }
-  },
-  "visual_impact": {
-    "dominant_features": ["Color", "Pattern", "Texture", "Silhouette", "Details"],
-    "visual_weight": ["Light", "Medium", "Heavy"],
-    "texture_appearance": ["Smooth", "Textured", "Mixed", "Dimensional"],
-    "pattern_impact": ["Subtle", "Moderate", "Bold", "Statement"],
-    "overall_contrast": ["High", "Medium", "Low", "Variable"]
-  }
-}'''
-
-        # Updated analysis prompt focusing on design and style
-        analysis_prompt = """As a luxury knitwear design expert, provide an extremely detailed analysis of this sweater/knit item, focusing on design elements, color, and style characteristics.
-
-Key areas to analyze:
-
-1. Color Analysis:
-   - Identify precise colors and their relationships
-   - Analyze color combinations and harmony
-   - Evaluate color application techniques
-   - Note any special color effects or treatments
-
-2. Design Details:
-   - Identify all distinctive design elements and patterns
-   - Analyze special knit techniques and their placement
-   - Note unique or innovative design features
-   - Evaluate pattern complexity and execution
-
-3. Style Elements:
-   - Assess the overall silhouette and its impact
-   - Identify key style influences and aesthetic category
-   - Evaluate visual balance and proportions
-   - Note any signature or distinctive style elements
-
-4. Visual Impact:
-   - Analyze the dominant design features
-   - Evaluate pattern and texture relationships
-   - Assess overall visual harmony
-   - Note special visual effects or treatments
-
-Provide your detailed design analysis in this exact JSON format:
-
-{json_template}"""
-
-        logger.info("Sending request to OpenAI API...")
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",  # Correct model name
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": analysis_prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1500,
-                temperature=0.5,
-                response_format={ "type": "json_object" }
-            )
+        base64_image = prepare_image(image_path, preprocessor)
+        omit = omitted_fields(color_analyzer)
+        # The controller does its own retrying
+        api_client = get_client().with_options(max_retries=0) if controller else get_client()
+        attempts, usages = 0, []
+
+        def request():
+            nonlocal attempts
+            attempts += 1
+            if limiter and attempts > 1:
+                limiter.acquire()
+            logger.info("Sending request to OpenAI API...")
+            with metrics.timer("api", image=str(image_path)):
+                response = api_client.chat.completions.create(**build_request(base64_image, detail, output_mode, omit))
+            usages.append(getattr(response, "usage", None))
+            metrics.record_usage(usages[-1], MODEL, image=str(image_path))
             logger.info("Received response from OpenAI API")
+            return parse_response(response, output_mode, str(image_path), omit)
+
+        try:
+            if controller:
+                return add_local_colors(controller.call(str(image_path), request), image_path, color_analyzer)
+            try:
+                return add_local_colors(request(), image_path, color_analyzer)
+
+            except Exception as e:
+                logger.error("Error in API request: %s", str(e))
+                return None
+        finally:
+            settle_usage(limiter, estimated_tokens, usages)
             
-            if hasattr(response.choices[0].message, 'content'):
-                result = json.loads(response.choices[0].message.content)
-                logger.info("Successfully parsed JSON response")
-                return result
-            
-        except Exception as e:
-            logger.error("Error in API request: %s", str(e))
-            return None
-            
     except Exception as e:
         logger.error("Error analyzing image %s: %s", image_path, str(e))
         return None
 
-def analyze_shopbop_images():
-    """Analyze all images in the shopbop_images directory."""
+async def analyze_image_async(image_path, category="sweaters", product_metadata=None, preprocessor=None, detail="high",
+                              output_mode="json", controller=None, color_analyzer=None, limiter=None,
+                              estimated_tokens=None):
+    """Async variant of analyze_image built on the AsyncOpenAI client."""
+    logger.info("Starting analysis of image: %s (Category: %s)", image_path, category)
+
+    try:
+        base64_image = await asyncio.to_thread(prepare_image, image_path, preprocessor)
+        omit = omitted_fields(color_analyzer)
+        api_client = get_async_client().with_options(max_retries=0) if controller else get_async_client()
+        attempts, usages = 0, []
+
+        async def request():
+            nonlocal attempts
+            attempts += 1
+            if limiter and attempts > 1:
+                await limiter.acquire_async()
+            with metrics.timer("api", image=str(image_path)):
+                response = await api_client.chat.completions.create(**build_request(base64_image, detail, output_mode,
+                                                                                    omit))
+            usages.append(getattr(response, "usage", None))
+            metrics.record_usage(usages[-1], MODEL, image=str(image_path))
+            logger.info("Received response from OpenAI API for %s", image_path)
+            return parse_response(response, output_mode, str(image_path), omit)
+
+        try:
+            if controller:
+                analysis = await controller.call_async(str(image_path), request)
+                return await asyncio.to_thread(add_local_colors, analysis, image_path, color_analyzer)
+            try:
+                return await asyncio.to_thread(add_local_colors, await request(), image_path, color_analyzer)
+
+            except Exception as e:
+                logger.error("Error in API request for %s: %s", image_path, str(e))
+                return None
+        finally:
+            settle_usage(limiter, estimated_tokens, usages)
+
+    except Exception as e:
+        logger.error("Error analyzing image %s: %s", image_path, str(e))
+        return None
+
+def analyze_image_batch(image_paths, category="sweaters", preprocessor=None, detail="high", output_mode="json",
+                        controller=None, color_analyzer=None, batch_size=None, limiter=None, estimated_tokens=None):
+    """Analyze several images in one request; returns {image path: analysis or None}.
+
+    Each image is sent with its own id and product metadata. Images the response
+    leaves out or answers invalidly, or all of them if it is unusable, are
+    analyzed one by one with analyze_image, each acquiring its own tokens from
+    the `limiter`. An AdaptiveBatchSize `batch_size` is told how complete the
+    response was.
+    """
+    ids = {str(n): image_path for n, image_path in enumerate(image_paths, 1)}
+    omit = omitted_fields(color_analyzer)
+    label = f"batch of {len(ids)} from {image_paths[0]}"
+    results, usage, started = {}, None, time.perf_counter()
+    try:
+        images = [(image_id, prepare_image(image_path, preprocessor), product_metadata(image_path, category))
+                  for image_id, image_path in ids.items()]
+        api_client = get_client().with_options(max_retries=0) if controller else get_client()
+        attempts = 0
+
+        def request():
+            nonlocal attempts
+            attempts += 1
+            if limiter and attempts > 1:
+                limiter.acquire()
+            logger.info("Sending a request for %d images to OpenAI API...", len(images))
+            with metrics.timer("api_batch", images=len(images)):
+                return api_client.chat.completions.create(**build_batch_request(images, detail, output_mode, omit))
+
+        # Transport errors are retried; a malformed answer falls back to single-image requests instead
+        response = controller.call(label, request, dead_letter=False) if controller else request()
+        if response is not None:
+            usage = getattr(response, "usage", None)
+            metrics.record_usage(usage, MODEL, images=len(images))
+            settle_usage(limiter, estimated_tokens, [usage])
+            results = parse_batch_response(response, list(ids), output_mode, omit)
+    except Exception as e:
+        logger.error("Error in batched request (%s): %s", label, str(e))
+    if batch_size is not None:
+        batch_size.on_response(len(ids), len(results), getattr(usage, "prompt_tokens", 0) or 0,
+                               time.perf_counter() - started)
+
+    analyses = {}
+    single_tokens = estimated_tokens_for(detail, output_mode, color_analyzer)
+    for image_id, image_path in ids.items():
+        if image_id in results:
+            analyses[image_path] = add_local_colors(results[image_id], image_path, color_analyzer)
+        else:
+            logger.info("Analyzing %s on its own", image_path)
+            if limiter:
+                with metrics.timer("rate_limit_wait"):
+                    limiter.acquire(single_tokens)
+            analyses[image_path] = analyze_image(image_path, category, preprocessor=preprocessor, detail=detail,
+                                                 output_mode=output_mode, controller=controller,
+                                                 color_analyzer=color_analyzer, limiter=limiter,
+                                                 estimated_tokens=single_tokens)
+    return analyses
+
+async def analyze_image_batch_async(image_paths, category="sweaters", preprocessor=None, detail="high",
+                                    output_mode="json", controller=None, color_analyzer=None, batch_size=None,
+                                    limiter=None, estimated_tokens=None):
+    """Async variant of analyze_image_batch built on the AsyncOpenAI client."""
+    ids = {str(n): image_path for n, image_path in enumerate(image_paths, 1)}
+    omit = omitted_fields(color_analyzer)
+    label = f"batch of {len(ids)} from {image_paths[0]}"
+    results, usage, started = {}, None, time.perf_counter()
+    try:
+        images = [(image_id, await asyncio.to_thread(prepare_image, image_path, preprocessor),
+                   product_metadata(image_path, category)) for image_id, image_path in ids.items()]
+        api_client = get_async_client().with_options(max_retries=0) if controller else get_async_client()
+        attempts = 0
+
+        async def request():
+            nonlocal attempts
+            attempts += 1
+            if limiter and attempts > 1:
+                await limiter.acquire_async()
+            with metrics.timer("api_batch", images=len(images)):
+                return await api_client.chat.completions.create(**build_batch_request(images, detail, output_mode,
+                                                                                      omit))
+
+        response = await controller.call_async(label, request, dead_letter=False) if controller else await request()
+        if response is not None:
+            usage = getattr(response, "usage", None)
+            metrics.record_usage(usage, MODEL, images=len(images))
+            settle_usage(limiter, estimated_tokens, [usage])
+            results = parse_batch_response(response, list(ids), output_mode, omit)
+    except Exception as e:
+        logger.error("Error in batched request (%s): %s", label, str(e))
+    if batch_size is not None:
+        batch_size.on_response(len(ids), len(results), getattr(usage, "prompt_tokens", 0) or 0,
+                               time.perf_counter() - started)
+
+    analyses = {}
+    single_tokens = estimated_tokens_for(detail, output_mode, color_analyzer)
+    for image_id, image_path in ids.items():
+        if image_id in results:
+            analyses[image_path] = await asyncio.to_thread(add_local_colors, results[image_id], image_path,
+                                                           color_analyzer)
+        else:
+            logger.info("Analyzing %s on its own", image_path)
+            if limiter:
+                with metrics.timer("rate_limit_wait"):
+                    await limiter.acquire_async(single_tokens)
+            analyses[image_path] = await analyze_image_async(image_path, category, preprocessor=preprocessor,
+                                                             detail=detail, output_mode=output_mode,
+                                                             controller=controller, color_analyzer=color_analyzer,
+                                                             limiter=limiter, estimated_tokens=single_tokens)
+    return analyses
+
+def make_record(image_path, analysis):
+    """Wrap an analysis with the metadata stored alongside it, including its canonical form."""
+    return add_canonical({
+        "analysis": analysis,
+        "timestamp": datetime.now().isoformat(),
+        "filename": image_path.name
+    })
+
+def store_record(store, image_path, analysis):
+    """Put the record for `image_path` in the store, timing the write."""
+    with metrics.timer("persist"):
+        store.put(str(image_path), make_record(image_path, analysis))
+
+def image_done(image_path, source, started):
+    """Record how long one image took end to end and where its analysis came from."""
+    metrics.observe("image", time.perf_counter() - started, image=str(image_path), source=source)
+    metrics.count(f"images_{source}")
+
+def near_duplicates_of(image_path, similarity=None):
+    """Keys of indexed near-duplicates of `image_path`, closest first (indexing it first if needed)."""
+    if similarity is None:
+        return []
+    key = str(image_path)
+    with metrics.timer("similarity"):
+        if not similarity.is_current(key, image_path):
+            similarity.add(key, image_path)
+        return similarity.near_duplicates([key])[0]
+
+def image_tokens_for(detail="high"):
+    return estimate_image_tokens(TILE_SIZE, TILE_SIZE, "low") if detail == "low" else HIGH_DETAIL_IMAGE_TOKENS
+
+def estimated_tokens_for(detail="high", output_mode="json", color_analyzer=None):
+    """Tokens to reserve per request at the given detail level."""
+    return estimate_request_tokens(image_tokens_for(detail), output_mode, omitted_fields(color_analyzer))
+
+def batch_prompt_tokens(output_mode="json", color_analyzer=None):
+    return len(batch_prompt(prompt_for(output_mode, omitted_fields(color_analyzer)))) // 4
+
+def estimated_batch_tokens(n_images, detail="high", output_mode="json", color_analyzer=None):
+    """Tokens to reserve for a batched request carrying `n_images` images."""
+    return (batch_prompt_tokens(output_mode, color_analyzer) + n_images * (image_tokens_for(detail) + LABEL_TOKENS)
+            + min(MAX_OUTPUT_TOKENS, n_images * max_tokens_for(output_mode)))
+
+def max_images_per_request(maximum, detail="high", output_mode="json", color_analyzer=None, tokens_per_minute=None):
+    """`maximum` capped so a batched request fits the output limit and the tokens-per-minute budget."""
+    return images_per_request(batch_prompt_tokens(output_mode, color_analyzer), image_tokens_for(detail),
+                              max_tokens_for(output_mode), token_budget=tokens_per_minute, maximum=maximum)
+
+def reused_analysis(image_path, store, cache=None, cache_key=None, similarity=None, near=None):
+    """An earlier analysis that answers `image_path` and where it came from, or (None, None).
+
+    The cache holds analyses of identical image content; the closest
+    near-duplicate (same shot, re-encoded or resized) already in the store is
+    reused too. `near` may hold the near-duplicates looked up beforehand (see
+    near_duplicates_of), e.g. off the event loop.
+    """
+    analysis = cache.get(cache_key) if cache else None
+    if analysis is not None:
+        logger.info(f"Cache hit for {image_path}")
+        return analysis, "cache"
+    for key in near if near is not None else near_duplicates_of(image_path, similarity):
+        if key in store:
+            logger.info(f"Reusing the analysis of near-duplicate {key} for {image_path}")
+            return store.get(key)["analysis"], "duplicate"
+    return None, None
+
+async def reused_analysis_async(image_path, store, cache=None, cache_key=None, similarity=None):
+    """reused_analysis for the event loop, with the similarity lookup run in a worker thread."""
+    analysis = cache.get(cache_key) if cache else None
+    if analysis is not None:
+        logger.info("Cache hit for %s", image_path)
+        return analysis, "cache"
+    near = await asyncio.to_thread(near_duplicates_of, image_path, similarity) if similarity is not None else []
+    return reused_analysis(image_path, store, near=near)
+
+async def analyze_and_store_async(image_path, store, limiter=None, cache=None, preprocessor=None, detail="high",
+                                  estimated_tokens=None, output_mode="json", controller=None, color_analyzer=None,
+                                  similarity=None):
+    """Analyze one image (or answer it from the cache) and put the record in the store.
+
+    With a SimilarityIndex, the analysis of an already analyzed near-duplicate is
+    reused. Cache and store access run on the event loop thread, so writes never
+    interleave. Returns the analysis, or None if it failed.
+    """
+    started = time.perf_counter()
+    cache_key = await asyncio.to_thread(cache_key_for, image_path, preprocessor, detail, output_mode,
+                                        color_analyzer) if cache else None
+    analysis, source = await reused_analysis_async(image_path, store, cache, cache_key, similarity)
+    if analysis is None:
+        estimated_tokens = estimated_tokens or estimated_tokens_for(detail, output_mode, color_analyzer)
+        if limiter:
+            with metrics.timer("rate_limit_wait"):
+                await limiter.acquire_async(estimated_tokens)
+        analysis = await analyze_image_async(image_path, preprocessor=preprocessor, detail=detail,
+                                             output_mode=output_mode, controller=controller,
+                                             color_analyzer=color_analyzer, limiter=limiter,
+                                             estimated_tokens=estimated_tokens)
+        if analysis and cache:
+            cache.put(cache_key, analysis)
+        source = "api" if analysis else "failed"
+    if analysis:
+        store_record(store, image_path, analysis)
+    image_done(image_path, source, started)
+    return analysis
+
+async def analyze_images_async(image_files, store, concurrency=DEFAULT_CONCURRENCY, limiter=None, cache=None,
+                               preprocessor=None, detail="high", estimated_tokens=None, output_mode="json",
+                               controller=None, color_analyzer=None, similarity=None):
+    """Analyze images with at most `concurrency` requests in flight, paced by `limiter`.
+
+    A `controller` may hold the number in flight lower while the API is throttling.
+    """
+    queue = asyncio.Queue()
+    for image_path in image_files:
+        queue.put_nowait(image_path)
+    estimated_tokens = estimated_tokens or estimated_tokens_for(detail, output_mode, color_analyzer)
+    progress = tqdm(total=len(image_files), desc="Analyzing images")
+
+    async def worker():
+        while True:
+            try:
+                image_path = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await analyze_and_store_async(image_path, store, limiter=limiter, cache=cache,
+                                          preprocessor=preprocessor, detail=detail,
+                                          estimated_tokens=estimated_tokens, output_mode=output_mode,
+                                          controller=controller, color_analyzer=color_analyzer,
+                                          similarity=similarity)
+            progress.update(1)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        progress.close()
+
+def analyze_images(image_files, store, limiter=None, cache=None, preprocessor=None, detail="high",
+                   estimated_tokens=None, output_mode="json", controller=None, color_analyzer=None,
+                   similarity=None):
+    """Analyze images one at a time, paced by `limiter`, putting each record in the store."""
+    estimated_tokens = estimated_tokens or estimated_tokens_for(detail, output_mode, color_analyzer)
+    for image_path in tqdm(image_files, desc="Analyzing images"):
+        started = time.perf_counter()
+
+        # Reuse an earlier analysis of identical image content or of a near-duplicate
+        cache_key = cache_key_for(image_path, preprocessor, detail, output_mode, color_analyzer) if cache else None
+        analysis, source = reused_analysis(image_path, store, cache, cache_key, similarity)
+        if analysis is not None:
+            store_record(store, image_path, analysis)
+            image_done(image_path, source, started)
+            continue
+        
+        # Wait for rate limit budget
+        if limiter:
+            with metrics.timer("rate_limit_wait"):
+                limiter.acquire(estimated_tokens)
+
+        # Analyze image
+        logger.info(f"Analyzing {image_path}")
+        analysis = analyze_image(image_path, preprocessor=preprocessor, detail=detail,
+                                 output_mode=output_mode, controller=controller,
+                                 color_analyzer=color_analyzer, limiter=limiter, estimated_tokens=estimated_tokens)
+        
+        if analysis:
+            if cache:
+                cache.put(cache_key, analysis)
+
+            # Append the analysis with metadata to the store
+            store_record(store, image_path, analysis)
+        image_done(image_path, "api" if analysis else "failed", started)
+
+def analyze_images_batched(image_files, store, batch_size, limiter=None, cache=None, preprocessor=None,
+                           detail="high", output_mode="json", controller=None, color_analyzer=None, similarity=None):
+    """Analyze images several to a request, as many as the AdaptiveBatchSize `batch_size` allows.
+
+    Images answered from the cache or by a near-duplicate are stored straight
+    away, as in analyze_images; the others are collected into batches.
+    """
+    progress = tqdm(total=len(image_files), desc="Analyzing images")
+    batch = []
+
+    def flush():
+        started = time.perf_counter()
+        estimated_tokens = estimated_batch_tokens(len(batch), detail, output_mode, color_analyzer)
+        if limiter:
+            with metrics.timer("rate_limit_wait"):
+                limiter.acquire(estimated_tokens)
+        analyses = analyze_image_batch([image_path for image_path, _ in batch], preprocessor=preprocessor,
+                                       detail=detail, output_mode=output_mode, controller=controller,
+                                       color_analyzer=color_analyzer, batch_size=batch_size, limiter=limiter,
+                                       estimated_tokens=estimated_tokens)
+        for image_path, cache_key in batch:
+            analysis = analyses.get(image_path)
+            if analysis:
+                if cache:
+                    cache.put(cache_key, analysis)
+                store_record(store, image_path, analysis)
+            image_done(image_path, "api" if analysis else "failed", started)
+        progress.update(len(batch))
+        batch.clear()
+
+    try:
+        for image_path in image_files:
+            started = time.perf_counter()
+            cache_key = cache_key_for(image_path, preprocessor, detail, output_mode, color_analyzer,
+                                      batched=True) if cache else None
+            analysis, source = reused_analysis(image_path, store, cache, cache_key, similarity)
+            if analysis is not None:
+                store_record(store, image_path, analysis)
+                image_done(image_path, source, started)
+                progress.update(1)
+                continue
+            batch.append((image_path, cache_key))
+            if len(batch) >= batch_size.size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        progress.close()
+
+async def analyze_images_batched_async(image_files, store, batch_size, concurrency=DEFAULT_CONCURRENCY, limiter=None,
+                                       cache=None, preprocessor=None, detail="high", output_mode="json",
+                                       controller=None, color_analyzer=None, similarity=None):
+    """analyze_images_batched with at most `concurrency` batched requests in flight."""
+    queue = asyncio.Queue()
+    for image_path in image_files:
+        queue.put_nowait(image_path)
+    progress = tqdm(total=len(image_files), desc="Analyzing images")
+
+    async def worker():
+        while True:
+            batch = []
+            while len(batch) < batch_size.size and not queue.empty():
+                image_path = queue.get_nowait()
+                started = time.perf_counter()
+                cache_key = await asyncio.to_thread(cache_key_for, image_path, preprocessor, detail, output_mode,
+                                                    color_analyzer, True) if cache else None
+                analysis, source = await reused_analysis_async(image_path, store, cache, cache_key, similarity)
+                if analysis is not None:
+                    store_record(store, image_path, analysis)
+                    image_done(image_path, source, started)
+                    progress.update(1)
+                    continue
+                batch.append((image_path, cache_key))
+            if not batch:
+                return
+            started = time.perf_counter()
+            estimated_tokens = estimated_batch_tokens(len(batch), detail, output_mode, color_analyzer)
+            if limiter:
+                with metrics.timer("rate_limit_wait"):
+                    await limiter.acquire_async(estimated_tokens)
+            analyses = await analyze_image_batch_async([image_path for image_path, _ in batch],
+                                                       preprocessor=preprocessor, detail=detail,
+                                                       output_mode=output_mode, controller=controller,
+                                                       color_analyzer=color_analyzer, batch_size=batch_size,
+                                                       limiter=limiter, estimated_tokens=estimated_tokens)
+            for image_path, cache_key in batch:
+                analysis = analyses.get(image_path)
+                if analysis:
+                    if cache:
+                        cache.put(cache_key, analysis)
+                    store_record(store, image_path, analysis)
+                image_done(image_path, "api" if analysis else "failed", started)
+            progress.update(len(batch))
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        progress.close()
+
+def open_analysis_store(store_path=DEFAULT_STORE, durable=False):
+    """Open the result store, carrying over results from the legacy JSON file."""
+    store = open_result_store(store_path, durable=durable)
+    if len(store) == 0:
+        imported = import_legacy_json(store, LEGACY_JSON)
+        if imported:
+            logger.info(f"Imported {imported} results from {LEGACY_JSON} into {store_path}")
+    return store
+
+def export_batch(output_dir, store_path=DEFAULT_STORE, preprocessor=None, detail="high",
+                 max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES, output_mode="json",
+                 color_analyzer=None):
+    """Write Batch API request files for every image that is not in the result store yet."""
+    store = open_analysis_store(store_path)
+    try:
+        pending = [p for p in Path("shopbop_images").glob("*.jpg") if str(p) not in store]
+    finally:
+        store.close()
+
+    if preprocessor:
+        detail = preprocessor.detail
+    omit = omitted_fields(color_analyzer)
+    requests = ((str(p), build_request(prepare_image(p, preprocessor), detail, output_mode, omit)) for p in pending)
+    files = export_batch_requests(requests, output_dir, max_requests=max_requests, max_bytes=max_bytes)
+    logger.info(f"Exported {len(pending)} requests to {len(files)} batch files in {output_dir}")
+    return files
+
+def ingest_batch(results_file, store_path=DEFAULT_STORE, output_mode="json", color_analyzer=None):
+    """Merge a Batch API results file into the result store.
+
+    `output_mode` and `color_analyzer` must match the ones the batch was exported with.
+    """
+    store = open_analysis_store(store_path)
+    omit = omitted_fields(color_analyzer)
+
+    def record(image_path, analysis):
+        if output_mode == "structured":
+            analysis = expand_response(analysis, omit)
+        return make_record(image_path, add_local_colors(analysis, image_path, color_analyzer))
+    try:
+        counts = ingest_batch_results(results_file, store, record)
+    finally:
+        store.close()
+    logger.info(f"Ingested {counts['ingested']} results from {results_file} ({counts['failed']} failed)")
+    return counts
+
+def analyze_shopbop_images(use_async=False, concurrency=DEFAULT_CONCURRENCY,
+                           requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                           tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                           store_path=DEFAULT_STORE, cache=None, preprocessor=None, detail="high",
+                           output_mode="json", controller=None, retry_dead_letters=False, color_analyzer=None,
+                           similarity=None, work_queue=None, worker_id=None, lease_batch=DEFAULT_BATCH_SIZE,
+                           lease_ttl=DEFAULT_LEASE_TTL, tag_index=None, images_per_request=1, durable=False):
+    """Analyze all images in the shopbop_images directory.
+
+    When `cache` is given, images whose content was analyzed before with the same
+    model and prompt are answered from it without an API call. A `preprocessor`
+    shrinks each image before upload and decides the detail level. A `controller`
+    retries failed requests; with `retry_dead_letters`, only the images in its
+    dead-letter list are analyzed, and the ones that succeed are taken off it.
+    A `color_analyzer` computes the color fields from pixels instead. With a
+    `similarity` index, near-duplicates of analyzed images reuse their analysis.
+
+    With a shared `work_queue`, several workers (processes or hosts) can run at
+    once: each leases batches of `lease_batch` images for `lease_ttl` seconds,
+    and results finished by the others are merged into its own store.
+
+    A `tag_index` is brought up to date with the store's new results at the end
+    of the run, including a run that fails part way.
+
+    With `images_per_request` above 1, images are packed several to a request,
+    adapting the number to the token limits and to malformed responses.
+
+    With `durable`, every stored result is flushed to disk before the next.
+    """
+    retried = []
+    store = None
+    batch_size = None
     try:
         # Setup paths
         images_dir = Path("shopbop_images")
-        output_file = "shopbop_analysis.json"
         
-        # Load existing analysis if any
-        existing_analysis = {}
-        if os.path.exists(output_file):
-            with open(output_file, 'r') as f:
-                existing_analysis = json.load(f)
+        store = open_analysis_store(store_path, durable=durable)
         
         # Get list of image files
         image_files = list(images_dir.glob("*.jpg"))
         logger.info(f"Found {len(image_files)} images to analyze")
-        
-        # Process each image
-        for image_path in tqdm(image_files, desc="Analyzing images"):
-            image_key = str(image_path)
-            
-            # Skip if already analyzed
-            if image_key in existing_analysis:
-                logger.debug(f"Skipping already analyzed image: {image_key}")
-                continue
-            
-            # Analyze image
-            logger.info(f"Analyzing {image_path}")
-            analysis = analyze_image(image_path)
-            
-            if analysis:
-                # Store analysis with metadata
-                existing_analysis[image_key] = {
-                    "analysis": analysis,
-                    "timestamp": datetime.now().isoformat(),
-                    "filename": image_path.name
-                }
-                
-                # Save after each successful analysis
-                with open(output_file, 'w') as f:
-                    json.dump(existing_analysis, f, indent=2)
-                
-                # Add delay to respect rate limits
-                time.sleep(1)
-            
+        if similarity is not None:
+            logger.info(f"Indexed {similarity.index_directory(images_dir)} new or changed images for similarity")
+
+        if retry_dead_letters:
+            # Targeted re-run of the images that failed for good last time
+            retried = [key for key in controller.dead_letters.keys() if Path(key).exists()]
+            pending = [Path(key) for key in retried]
+            logger.info(f"Retrying {len(pending)} dead-lettered images")
+        else:
+            # Skip images that were already analyzed
+            pending = [p for p in image_files if str(p) not in store]
+            logger.info(f"Skipping {len(image_files) - len(pending)} already analyzed images")
+
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        if preprocessor:
+            detail = preprocessor.detail
+        estimated_tokens = estimated_tokens_for(detail, output_mode, color_analyzer)
+        if images_per_request > 1:
+            batch_size = AdaptiveBatchSize(max_images_per_request(images_per_request, detail, output_mode,
+                                                                  color_analyzer, tokens_per_minute))
+            logger.info(f"Sending up to {batch_size.maximum} images per request")
+
+        def process(image_paths):
+            if batch_size is not None and use_async:
+                asyncio.run(analyze_images_batched_async(image_paths, store, batch_size, concurrency=concurrency,
+                                                         limiter=limiter, cache=cache, preprocessor=preprocessor,
+                                                         detail=detail, output_mode=output_mode,
+                                                         controller=controller, color_analyzer=color_analyzer,
+                                                         similarity=similarity))
+            elif batch_size is not None:
+                analyze_images_batched(image_paths, store, batch_size, limiter=limiter, cache=cache,
+                                       preprocessor=preprocessor, detail=detail, output_mode=output_mode,
+                                       controller=controller, color_analyzer=color_analyzer, similarity=similarity)
+            elif use_async:
+                asyncio.run(analyze_images_async(image_paths, store, concurrency=concurrency,
+                                                 limiter=limiter, cache=cache, preprocessor=preprocessor,
+                                                 detail=detail, estimated_tokens=estimated_tokens,
+                                                 output_mode=output_mode, controller=controller,
+                                                 color_analyzer=color_analyzer, similarity=similarity))
+            else:
+                analyze_images(image_paths, store, limiter=limiter, cache=cache, preprocessor=preprocessor,
+                               detail=detail, estimated_tokens=estimated_tokens, output_mode=output_mode,
+                               controller=controller, color_analyzer=color_analyzer, similarity=similarity)
+
+        if work_queue is not None:
+            # Other workers may share the queue; a key is analyzed by whoever leases it
+            logger.info(f"Queued {work_queue.add(str(p) for p in pending)} new images in {work_queue.path}")
+            run_worker(work_queue, lambda keys: process([Path(key) for key in keys if key not in store]), store,
+                       worker=worker_id, batch_size=lease_batch, ttl=lease_ttl)
+        else:
+            process(pending)
+
         logger.info("Analysis complete")
         
     except Exception as e:
         logger.error(f"Error in analyze_shopbop_images: {str(e)}")
         raise
 
-if __name__ == "__main__":
+    finally:
+        if store is not None:
+            if tag_index is not None:
+                with metrics.timer("tag_index"):
+                    stats = tag_index.update_from_store(store)
+                    tag_index.save()
+                logger.info(f"Tag index: indexed {stats['indexed']} new or changed results, "
+                            f"{stats['products']} products in {tag_index.path}")
+            store.close()
+        if similarity is not None:
+            similarity.save()
+        if batch_size is not None:
+            logger.info(f"Batching: {batch_size.report()}")
+        if controller is not None:
+            logger.info(f"Request controller: {controller.report()}")
+            if retried:
+                controller.dead_letters.remove(key for key in retried if key not in controller.failed_keys)
+        if cache is not None:
+            logger.info(f"Analysis cache: {cache.stats()}")
+        if preprocessor is not None and preprocessor.totals["images"]:
+            totals = preprocessor.totals
+            logger.info(f"Preprocessing saved {totals['bytes_before'] - totals['bytes_after']} bytes and "
+                        f"~{totals['tokens_before'] - totals['tokens_after']} image tokens "
+                        f"over {totals['images']} images")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze Shopbop product images with OpenAI's Vision model")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Send requests concurrently with the async OpenAI client")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of requests in flight in async mode")
+    parser.add_argument('--rpm', type=int, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help="Requests per minute limit")
+    parser.add_argument('--tpm', type=int, default=DEFAULT_TOKENS_PER_MINUTE,
+                        help="Tokens per minute limit")
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help="Result store to append to (.jsonl or .sqlite)")
+    parser.add_argument('--fsync', action='store_true',
+                        help="Flush every result to disk as it is stored (slower; survives power loss)")
+    parser.add_argument('--export-json', nargs='?', const=LEGACY_JSON, metavar='PATH',
+                        help="Export the result store as legacy JSON after the run")
+    parser.add_argument('--cache', default=DEFAULT_CACHE,
+                        help="Content-addressed analysis cache file")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Always call the API, even for previously analyzed image content")
+    parser.add_argument('--cache-max-entries', type=int, default=None,
+                        help="Evict least recently used entries beyond this count")
+    parser.add_argument('--cache-max-mb', type=float, default=None,
+                        help="Evict least recently used entries beyond this size")
+    parser.add_argument('--cache-max-age-days', type=float, default=None,
+                        help="Treat entries older than this as stale and evict them")
+    parser.add_argument('--detail', choices=DETAIL_LEVELS, default="high",
+                        help="Vision detail level sent with each image")
+    parser.add_argument('--preprocess', action='store_true',
+                        help="Crop, resize and re-encode images before upload")
+    parser.add_argument('--max-side', type=int, default=1024,
+                        help="Longest side of preprocessed images, snapped to 512px tiles")
+    parser.add_argument('--quality', type=int, default=85,
+                        help="JPEG quality of preprocessed images")
+    parser.add_argument('--preprocess-dir', default=DEFAULT_PREPROCESS_DIR,
+                        help="Directory caching preprocessed images")
+    parser.add_argument('--export-batch', metavar='DIR',
+                        help="Write Batch API request files for unanalyzed images instead of calling the API")
+    parser.add_argument('--ingest-batch', metavar='FILE',
+                        help="Merge a Batch API results file into the result store")
+    parser.add_argument('--batch-max-requests', type=int, default=MAX_BATCH_REQUESTS,
+                        help="Maximum requests per batch file")
+    parser.add_argument('--batch-max-mb', type=float, default=MAX_BATCH_BYTES / (1024 * 1024),
+                        help="Maximum size of each batch file")
+    parser.add_argument('--output', choices=OUTPUT_MODES, default="json",
+                        help="Free-form JSON, or a strict schema of enum codes with far fewer output tokens")
+    parser.add_argument('--max-retries', type=int, default=5,
+                        help="Retries for rate-limited, timed out or failed requests")
+    parser.add_argument('--no-retry', action='store_true',
+                        help="Give up on an image after its first failed request")
+    parser.add_argument('--dead-letter', default=DEFAULT_DEAD_LETTER,
+                        help="File listing images whose analysis failed for good")
+    parser.add_argument('--retry-dead-letters', action='store_true',
+                        help="Only re-analyze the images in the dead-letter file")
+    parser.add_argument('--local-colors', action='store_true',
+                        help="Compute the color fields from pixels and leave them out of the prompt")
+    # Directory defaults (const=True) are resolved in main so numpy and PIL load only when used
+    parser.add_argument('--similarity', nargs='?', const=True, metavar='DIR',
+                        help="Reuse analyses of near-duplicate images found with this similarity index "
+                             "(default DIR: shopbop_similarity)")
+    parser.add_argument('--queue', nargs='?', const=DEFAULT_QUEUE, metavar='PATH',
+                        help="Share the work with other workers through this lease queue (SQLite, may be on a "
+                             "shared filesystem)")
+    parser.add_argument('--worker-id', help="Name of this worker in the queue (default: host:pid)")
+    parser.add_argument('--lease-batch', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Images leased from the queue at a time")
+    parser.add_argument('--lease-ttl', type=float, default=DEFAULT_LEASE_TTL,
+                        help="Seconds before the lease of a worker that stopped sending heartbeats expires")
+    parser.add_argument('--images-per-request', type=int, default=1, metavar='N',
+                        help="Pack up to N images into each request to share the prompt; lowered automatically "
+                             "to fit the token limits and after malformed responses")
+    parser.add_argument('--tag-index', nargs='?', const=True, metavar='DIR',
+                        help="Keep this inverted tag index up to date with the results (query it with tag_index.py; "
+                             "default DIR: shopbop_tag_index)")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging()
+    start_metrics(args)
+
+    # Exporting and ingesting batches need no API access; everything else fails fast without a key
+    if not (args.export_batch or args.ingest_batch):
+        get_api_key()
+
     logger.info("=" * 80)
     logger.info(f"Starting image analysis process at {datetime.now()}")
     logger.info("=" * 80)
     
-    analyze_shopbop_images() 
\ No newline at end of file
+    cache = None
+    if not args.no_cache:
+        cache = AnalysisCache(args.cache, max_entries=args.cache_max_entries,
+                              max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None,
+                              max_age_days=args.cache_max_age_days)
+
+    preprocessor = None
+    if args.preprocess:
+        preprocessor = ImagePreprocessor(max_side=args.max_side, quality=args.quality,
+                                         detail=args.detail, cache_dir=args.preprocess_dir)
+
+    color_analyzer = None
+    if args.local_colors:
+        from color_analyzer import ColorAnalyzer
+        color_analyzer = ColorAnalyzer()
+    similarity = None
+    if args.similarity:
+        from similarity_index import SimilarityIndex
+        similarity = SimilarityIndex() if args.similarity is True else SimilarityIndex(args.similarity)
+    tag_index = None
+    if args.tag_index:
+        from tag_index import TagIndex
+        tag_index = TagIndex() if args.tag_index is True else TagIndex(args.tag_index)
+
+    controller = None
+    if not args.no_retry:
+        controller = RequestController(max_retries=args.max_retries,
+                                       concurrency=args.concurrency if args.use_async else 1,
+                                       dead_letter_path=args.dead_letter)
+
+    work_queue = WorkQueue(args.queue) if args.queue else None
+
+    try:
+        if args.export_batch:
+            export_batch(args.export_batch, store_path=args.store, preprocessor=preprocessor,
+                         detail=args.detail, max_requests=args.batch_max_requests,
+                         max_bytes=int(args.batch_max_mb * 1024 * 1024), output_mode=args.output,
+                         color_analyzer=color_analyzer)
+        elif args.ingest_batch:
+            ingest_batch(args.ingest_batch, store_path=args.store, output_mode=args.output,
+                         color_analyzer=color_analyzer)
+        else:
+            analyze_shopbop_images(use_async=args.use_async, concurrency=args.concurrency,
+                                   requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                   store_path=args.store, cache=cache, preprocessor=preprocessor,
+                                   detail=args.detail, output_mode=args.output, controller=controller,
+                                   retry_dead_letters=args.retry_dead_letters and controller is not None,
+                                   color_analyzer=color_analyzer,
+                                   similarity=similarity,
+                                   work_queue=work_queue, worker_id=args.worker_id, lease_batch=args.lease_batch,
+                                   lease_ttl=args.lease_ttl,
+                                   tag_index=tag_index,
+                                   images_per_request=args.images_per_request, durable=args.fsync)
+    finally:
+        if work_queue is not None:
+            work_queue.close()
+        if cache is not None:
+            evicted = cache.evict()
+            if evicted:
+                logger.info(f"Evicted {evicted} entries from the analysis cache")
+            cache.close()
+        metrics.close()
+
+    if args.export_json:
+        store = open_result_store(args.store)
+        try:
+            logger.info(f"Exported results to {export_legacy_json(store, args.export_json)}")
+        finally:
+            store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import argparse
+import json
+import re
+import time
+import urllib.parse
+from pathlib import Path
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+SHOPBOP_BASE_URL = "https://www.shopbop.com/"
+LISTING_URL = "https://www.shopbop.com/clothing-sweaters-knits/br/v=1/13317.htm"
+LISTING_PAGE_SIZE = 100
+
+# Classes that mark a product tile, most specific first
+PRODUCT_TILE_CLASSES = ["product-tile", "product", "s-product-card", "s-result-item"]
+
+PRICE_PATTERN = re.compile(r'\$\s?(\d[\d,]*(?:\.\d{2})?)')
+
+# Assignments of the page's client-side state to a global, e.g. window.__INITIAL_STATE__ = {...};
+STATE_ASSIGNMENT = re.compile(r'window\.(__[A-Z_]+__)\s*=\s*')
+
+NAME_KEYS = ('name', 'productName', 'shortDescription', 'title')
+IMAGE_KEYS = ('image', 'imageUrl', 'imageURL', 'images', 'img', 'src')
+ID_KEYS = ('productId', 'productID', 'sku', 'styleNumber', 'id')
+URL_KEYS = ('url', 'productUrl', 'productDetailUrl', 'href')
+PRICE_KEYS = ('price', 'salePrice', 'retailPrice', 'offers')
+
+
+def sanitize_filename(filename):
+    """Clean filename to be valid for all operating systems"""
+    # Remove invalid characters and price information
+    filename = re.sub(r'\$\d+\.?\d*', '', filename)  # Remove price
+    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
+    # Replace spaces with underscores
+    filename = filename.replace(' ', '_')
+    # Remove multiple underscores
+    filename = re.sub(r'_+', '_', filename)
+    # Limit length and remove trailing underscores
+    return filename[:100].strip('_')
+
+
+def clean_product_name(product_name):
+    """Turn a product tile's text into a filename-safe product name"""
+    product_name = re.sub(r'\s+', ' ', product_name or '').strip()  # Replace multiple spaces
+    product_name = product_name.replace('Not hearted', '')  # Remove "Not hearted" text
+    
+    if not product_name:
+        product_name = f"shopbop_product_{int(time.time())}"
+        
+    return sanitize_filename(product_name)
+
+
+def get_product_info(product_element):
+    """Extract product name from Shopbop's product element"""
+    try:
+        product_name = ""
+        # Try to find the product name from the link text
+        product_link = product_element.find('a', class_='product-title')
+        if product_link:
+            product_name = product_link.text.strip()
+        
+        if not product_name:
+            # Try to find product name from any text content
+            product_name = product_element.get_text().strip()
+        
+        return clean_product_name(product_name)
+    except Exception as e:
+        print(f"Error getting product name: {str(e)}")
+        return f"shopbop_product_{int(time.time())}"
+
+
+def parse_price(text):
+    """First dollar amount in `text` as a float, or None"""
+    match = PRICE_PATTERN.search(text or '')
+    return float(match.group(1).replace(',', '')) if match else None
+
+
+def get_product_url(product_element):
+    """Absolute URL of the product detail page, used as the product's stable key"""
+    link = product_element.find('a', href=True)
+    if not link:
+        return None
+    return urllib.parse.urljoin(SHOPBOP_BASE_URL, link['href'])
+
+
+def product_id(product_url, src):
+    """Stable product ID: the numeric Shopbop ID from the product URL, else the URL or image"""
+    if product_url:
+        match = re.search(r'/(\d+)\.htm', product_url) or re.search(r'[?&]productId=(\d+)', product_url)
+        if match:
+            return match.group(1)
+        return urllib.parse.urlsplit(product_url).path
+    return src
+
+
+def parse_products(html):
+    """Product tiles in `html`, parsing only the tile subtrees
+
+    A SoupStrainer keeps BeautifulSoup from building the rest of the page.
+    """
+    soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(class_=PRODUCT_TILE_CLASSES))
+    
+    # Try multiple selectors to find products
+    elements = []
+    for selector in PRODUCT_TILE_CLASSES:
+        elements = soup.find_all(class_=selector)
+        if elements:
+            print(f"Found {len(elements)} products with selector '{selector}'")
+            break
+    
+    if not elements:
+        print("No products found with standard selectors, trying alternative approach...")
+        soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(attrs={'data-testid': True}))
+        elements = soup.find_all('div', {'data-testid': True})
+    
+    products = []
+    for element in elements:
+        # Try multiple image selectors
+        img = None
+        img_selectors = ['product-image', 'productImage', 'img']
+        for selector in img_selectors:
+            img = element.find('img', class_=selector) or element.find('img')
+            if img:
+                break
+        
+        if not img:
+            continue
+        
+        src = img.get('src') or img.get('data-src') or img.get('srcset')
+        if not src:
+            continue
+        
+        product_url = get_product_url(element)
+        products.append({
+            'id': product_id(product_url, src),
+            'url': product_url,
+            'src': src,
+            'name': get_product_info(element),
+            'price': parse_price(element.get_text(' ')),
+        })
+    return products
+
+
+def _first(mapping, keys):
+    for key in keys:
+        value = mapping.get(key)
+        if value not in (None, '', [], {}):
+            return value
+    return None
+
+
+def _image_url(value):
+    """Image URL from a string, a list of images or an image object"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list) and value:
+        return _image_url(value[0])
+    if isinstance(value, dict):
+        return _image_url(_first(value, ('url', 'src', 'contentUrl', 'imageUrl', 'large', 'main')))
+    return None
+
+
+def _price(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        return parse_price(value if '$' in value else f'${value}')
+    if isinstance(value, list) and value:
+        return _price(value[0])
+    if isinstance(value, dict):
+        return _price(_first(value, ('price', 'lowPrice', 'amount', 'value', 'current', 'sale', 'retail')))
+    return None
+
+
+def _product_from_object(obj):
+    """Product record from an embedded JSON object, or None if it does not describe one"""
+    name = _first(obj, NAME_KEYS)
+    src = _image_url(_first(obj, IMAGE_KEYS))
+    identifier = _first(obj, ID_KEYS)
+    href = _first(obj, URL_KEYS)
+    if not isinstance(name, str) or not src or not (identifier or href):
+        return None
+    product_url = urllib.parse.urljoin(SHOPBOP_BASE_URL, href) if isinstance(href, str) else None
+    return {
+        'id': str(identifier) if identifier is not None else product_id(product_url, src),
+        'url': product_url,
+        'src': urllib.parse.urljoin(SHOPBOP_BASE_URL, src),
+        'name': clean_product_name(name),
+        'price': _price(_first(obj, PRICE_KEYS)),
+    }
+
+
+def _walk_products(node, products, seen):
+    if isinstance(node, dict):
+        # schema.org ItemList entries wrap the product in "item"
+        product = _product_from_object(node)
+        if product and product['id'] not in seen:
+            seen.add(product['id'])
+            products.append(product)
+            return
+        for value in node.values():
+            _walk_products(value, products, seen)
+    elif isinstance(node, list):
+        for value in node:
+            _walk_products(value, products, seen)
+
+
+def _embedded_json(html):
+    """JSON documents embedded in the page: ld+json, __NEXT_DATA__ and window.__STATE__ globals"""
+    soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer('script'))
+    documents = []
+    decoder = json.JSONDecoder()
+    for script in soup.find_all('script'):
+        text = script.string or ''
+        if script.get('type') == 'application/ld+json' or script.get('id') == '__NEXT_DATA__':
+            try:
+                documents.append(json.loads(text))
+            except ValueError:
+                continue
+            continue
+        for match in STATE_ASSIGNMENT.finditer(text):
+            try:
+                documents.append(decoder.raw_decode(text, match.end())[0])
+            except ValueError:
+                continue
+    return documents
+
+
+def extract_embedded_products(html):
+    """Products described by the JSON state embedded in a listing page"""
+    products = []
+    seen = set()
+    for document in _embedded_json(html):
+        _walk_products(document, products, seen)
+    return products
+
+
+def parse_listing(html):
+    """Products on a listing page: the embedded JSON state if present, else the product tiles"""
+    products = extract_embedded_products(html)
+    if not products:
+        products = parse_products(html)
+    return products
+
+
+def listing_page_url(page_number, base_url=LISTING_URL, page_size=LISTING_PAGE_SIZE):
+    """URL of the n-th listing page; "Load More" pages through the baseIndex offset"""
+    if page_number == 1:
+        return base_url
+    separator = '&' if '?' in base_url else '?'
+    return f"{base_url}{separator}baseIndex={(page_number - 1) * page_size}"
+
+
+def iter_snapshots(directory):
+    """(path, products) for every saved HTML snapshot in `directory`, in name order"""
+    for path in sorted(Path(directory).glob('*.htm*')):
+        yield path, parse_listing(path.read_text(encoding='utf-8', errors='replace'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse Shopbop listing HTML into product records")
+    parser.add_argument('paths', nargs='+', help="Saved listing HTML files or directories of them")
+    args = parser.parse_args()
+    for path in args.paths:
+        snapshots = iter_snapshots(path) if Path(path).is_dir() else \
+            [(path, parse_listing(Path(path).read_text(encoding='utf-8', errors='replace')))]
+        for _, products in snapshots:
+            for product in products:
+                print(json.dumps(product))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_FILE = "metrics.jsonl"
+METRIC_PREFIX = "shopbop"
+QUANTILES = (0.5, 0.95, 0.99)
+
+# USD per million tokens: (input, cached input, output). Update when pricing changes.
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "o1-preview": (15.00, 7.50, 60.00),
+}
+
+# Stages whose time is spent sleeping or blocked rather than working
+WAIT_SUFFIX = "_wait"
+
+# Timings kept per stage for percentiles; beyond this many they are a uniform sample
+RESERVOIR_SIZE = 4096
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    """Estimated USD cost of one call, or None for a model without a known price."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1_000_000
+
+
+def _label_string(labels: Dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+class StageTimings:
+    """Count, total and max of a stage's timings, plus a bounded sample for percentiles.
+
+    The first RESERVOIR_SIZE timings are all kept, so short runs get exact
+    percentiles; after that each new timing replaces a random kept one with the
+    probability that keeps the sample uniform (reservoir sampling), so memory
+    stays bounded however long a run or scrape goes on.
+    """
+
+    def __init__(self, size: int = RESERVOIR_SIZE, seed: int = 0):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sample = []
+        self._sorted = None
+        self._random = random.Random(seed)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.sample) < self.size:
+            self.sample.append(seconds)
+        else:
+            slot = self._random.randrange(self.count)
+            if slot >= self.size:
+                return
+            self.sample[slot] = seconds
+        self._sorted = None
+
+    def percentile(self, q: float) -> float:
+        if self._sorted is None:
+            self._sorted = sorted(self.sample)
+        return percentile(self._sorted, q)
+
+
+class Metrics:
+    """Per-stage timings, counters, token usage and cost for one run.
+
+    Every observation updates in-memory aggregates and, once `open()` has been
+    called with a path, is appended to a JSONL file as one event. The
+    aggregates feed the end-of-run summary (with p50/p95/p99 per stage) and
+    the Prometheus text exposition served by `serve()`. Safe to use from any
+    thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.timings = defaultdict(StageTimings)
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.tokens = defaultdict(int)
+        self.cost = 0.0
+        self._file = None
+        self._server = None
+
+    def open(self, path: str = DEFAULT_METRICS_FILE):
+        """Start appending events to the JSONL file at `path`."""
+        with self.lock:
+            if self._file is None:
+                self._file = open(path, "a", buffering=1)
+        self.event("run_started")
+
+    def event(self, kind: str, **fields):
+        """Write one JSONL event (a no-op until open() is called)."""
+        if self._file is None:
+            return
+        line = json.dumps({"type": kind, "time": datetime.now().isoformat(), **fields}, default=str)
+        with self.lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def observe(self, stage: str, seconds: float, **labels):
+        """Record that `stage` took `seconds`; stages ending in "_wait" count as waiting."""
+        with self.lock:
+            self.timings[stage].add(seconds)
+        self.event("timing", stage=stage, seconds=round(seconds, 6), **labels)
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """Time the block as `stage`, including when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            self.counters[name] += value
+        if labels:
+            self.event("count", name=name, value=value, **labels)
+
+    def gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def record_usage(self, usage, model: str, **labels) -> Optional[float]:
+        """Record the token usage of one API call; returns its estimated cost."""
+        if usage is None:
+            return None
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0) or 0
+        cost = estimate_cost(model, prompt, completion, cached)
+        with self.lock:
+            self.tokens["prompt"] += prompt
+            self.tokens["completion"] += completion
+            self.tokens["cached"] += cached
+            self.counters["api_calls"] += 1
+            if cost is not None:
+                self.cost += cost
+        self.event("usage", model=model, prompt_tokens=prompt, completion_tokens=completion,
+                   cached_tokens=cached, cost_usd=round(cost, 6) if cost is not None else None, **labels)
+        return cost
+
+    def summary(self) -> Dict:
+        """Aggregates for the run so far."""
+        with self.lock:
+            stages = {}
+            for stage, timings in self.timings.items():
+                stages[stage] = {"count": timings.count, "total": timings.total,
+                                 "mean": timings.total / timings.count,
+                                 **{f"p{round(q * 100)}": timings.percentile(q) for q in QUANTILES},
+                                 "max": timings.max}
+            wall = time.monotonic() - self.started
+            waited = sum(s["total"] for name, s in stages.items() if name.endswith(WAIT_SUFFIX))
+            return {"wall_seconds": wall, "wait_seconds": waited, "stages": stages,
+                    "counters": dict(self.counters), "gauges": dict(self.gauges),
+                    "tokens": dict(self.tokens), "cost_usd": self.cost}
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        lines = [f"Run summary: wall {summary['wall_seconds']:.1f}s, waiting {summary['wait_seconds']:.1f}s "
+                 f"(sum over threads)"]
+        for stage, s in sorted(summary["stages"].items()):
+            lines.append(f"  {stage:<24} n={s['count']:<6} total {s['total']:8.2f}s  p50 {s['p50']:.3f}s  "
+                         f"p95 {s['p95']:.3f}s  p99 {s['p99']:.3f}s  max {s['max']:.3f}s")
+        if summary["counters"]:
+            lines.append("  counters: " + ", ".join(f"{name} {value:g}" for name, value in
+                                                    sorted(summary["counters"].items())))
+        if summary["tokens"]:
+            tokens = summary["tokens"]
+            lines.append(f"  tokens: {tokens.get('prompt', 0)} prompt ({tokens.get('cached', 0)} cached), "
+                         f"{tokens.get('completion', 0)} completion; estimated cost ${summary['cost_usd']:.4f}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """The aggregates in the Prometheus text exposition format."""
+        summary = self.summary()
+        p = METRIC_PREFIX
+        lines = [f"# TYPE {p}_stage_seconds summary"]
+        for stage, s in sorted(summary["stages"].items()):
+            for q in QUANTILES:
+                lines.append(f"{p}_stage_seconds{_label_string({'stage': stage, 'quantile': q})} "
+                             f"{s[f'p{round(q * 100)}']}")
+            lines.append(f"{p}_stage_seconds_sum{_label_string({'stage': stage})} {s['total']}")
+            lines.append(f"{p}_stage_seconds_count{_label_string({'stage': stage})} {s['count']}")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            lines.append(f"{p}_{name}_total {value}")
+        for name, value in sorted(summary["gauges"].items()):
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value}")
+        lines.append(f"# TYPE {p}_tokens_total counter")
+        for kind, value in sorted(summary["tokens"].items()):
+            lines.append(f"{p}_tokens_total{_label_string({'kind': kind})} {value}")
+        lines.append(f"# TYPE {p}_cost_usd_total counter")
+        lines.append(f"{p}_cost_usd_total {summary['cost_usd']}")
+        lines.append(f"# TYPE {p}_wait_seconds_total counter")
+        lines.append(f"{p}_wait_seconds_total {summary['wait_seconds']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """Serve /metrics on a background thread until close()."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{self._server.server_port}/metrics")
+        return self._server.server_port
+
+    def close(self):
+        """Log the run summary, write it as the last event and stop the endpoint."""
+        logger.info(self.format_summary())
+        self.event("run_summary", **self.summary())
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Shared by the scraper, downloader and analyzer, like the logging module's root logger
+metrics = Metrics()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', nargs='?', const=DEFAULT_METRICS_FILE, metavar='PATH',
+                        help=f"Append per-stage metrics as JSONL (default file: {DEFAULT_METRICS_FILE})")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics during the run")
+
+
+def start_metrics(args):
+    """Open the JSONL file and the endpoint requested on the command line."""
+    if args.metrics:
+        metrics.open(args.metrics)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
@@ -0,0 +1,156 @@
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the batch instructions or response layout below change
+BATCH_PROMPT_VERSION = 1
+
+DEFAULT_IMAGES_PER_REQUEST = 4
+
+# Completion tokens gpt-4o can return in one response
+MAX_OUTPUT_TOKENS = 16384
+
+# Tokens for the "Image <id>" line and product metadata in front of each image
+LABEL_TOKENS = 40
+
+BATCH_INSTRUCTIONS = """Several items are shown below. Each image comes right after a line starting with "Image" that gives its id and what is known about the product. Analyze every image on its own, exactly as described above, and answer with one JSON object of the form {"results": [{"id": "<id>", "analysis": {...}}]}: one entry per image, in the order given, where "analysis" is the JSON object described above for that image."""
+
+
+def batch_prompt(prompt: str) -> str:
+    """The single-image `prompt` followed by the batch instructions.
+
+    The single-image prompt stays the leading part, so batched and single
+    requests share a cacheable prefix.
+    """
+    return f"{prompt}\n\n{BATCH_INSTRUCTIONS}"
+
+
+def batch_response_format(response_format: Dict) -> Dict:
+    """Wrap a single-image response format so the model returns a list of per-image results."""
+    if response_format.get("type") != "json_schema":
+        return response_format
+    schema = response_format["json_schema"]["schema"]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "sweater_analyses",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {"id": {"type": "string"}, "analysis": schema},
+                            "required": ["id", "analysis"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["results"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def product_metadata(image_path, category: str = "sweaters") -> Dict[str, str]:
+    """What the file name tells about the product, e.g. "Alex_Mill_Cardigan_page1.jpg" -> "Alex Mill Cardigan"."""
+    name = re.sub(r"_page\d+(_\d+)?$", "", Path(image_path).stem).replace("_", " ").strip()
+    return {"category": category, "product": name}
+
+
+def image_label(image_id: str, metadata: Optional[Dict] = None) -> str:
+    details = "; ".join(f"{key}: {value}" for key, value in (metadata or {}).items() if value)
+    return f"Image {image_id}" + (f" ({details})" if details else "")
+
+
+def split_results(payload, ids: Sequence[str]) -> Dict[str, Dict]:
+    """Per-image analyses of a batched response, keyed by the ids asked for.
+
+    Entries with an unknown id, a repeated id or a non-object analysis are
+    dropped, so the images they belong to are retried on their own. Raises
+    ValueError when the response is not a {"results": [...]} object.
+    """
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    if not isinstance(payload, dict) or not isinstance(payload.get("results"), list):
+        raise ValueError("Batched response has no results list")
+    wanted = set(ids)
+    results = {}
+    for entry in payload["results"]:
+        if not isinstance(entry, dict):
+            continue
+        image_id = str(entry.get("id", "")).strip()
+        if image_id not in wanted or image_id in results or not isinstance(entry.get("analysis"), dict):
+            logger.warning("Dropping batched result for unexpected or repeated id %r", image_id)
+            continue
+        results[image_id] = entry["analysis"]
+    return results
+
+
+def images_per_request(prompt_tokens: int, image_tokens: int, output_tokens: int, token_budget: float = None,
+                       maximum: int = DEFAULT_IMAGES_PER_REQUEST) -> int:
+    """Most images one request can carry within the token limits.
+
+    A request's completion must fit MAX_OUTPUT_TOKENS, and its whole estimate
+    must fit `token_budget` (the tokens-per-minute bucket), or the rate limiter
+    could never admit it.
+    """
+    limit = min(maximum, MAX_OUTPUT_TOKENS // output_tokens)
+    if token_budget:
+        limit = min(limit, int((token_budget - prompt_tokens) // (image_tokens + LABEL_TOKENS + output_tokens)))
+    return max(1, limit)
+
+
+class AdaptiveBatchSize:
+    """Images per request, grown after good responses and halved after malformed ones.
+
+    Long batched responses are the ones that get truncated or mix images up,
+    so each malformed or incomplete response halves the size and each complete
+    one adds an image, up to `maximum` (see images_per_request).
+    """
+
+    def __init__(self, maximum: int = DEFAULT_IMAGES_PER_REQUEST, minimum: int = 1):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.size = self.maximum
+        self.stats = {"requests": 0, "images": 0, "complete": 0, "malformed": 0, "fallbacks": 0,
+                      "prompt_tokens": 0, "api_seconds": 0.0}
+
+    def on_response(self, images: int, returned: int, prompt_tokens: int = 0, seconds: float = 0.0):
+        """Record a batched response that carried `returned` of its `images` analyses."""
+        self.stats["requests"] += 1
+        self.stats["images"] += images
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["api_seconds"] += seconds
+        self.stats["fallbacks"] += images - returned
+        if returned == images:
+            self.stats["complete"] += 1
+            self.size = min(self.maximum, self.size + 1)
+        else:
+            self.stats["malformed"] += 1
+            self.size = max(self.minimum, self.size // 2)
+            logger.info("Batched response carried %d of %d analyses; images per request cut to %d",
+                        returned, images, self.size)
+        metrics.count("batch_requests")
+        metrics.count("batch_fallbacks", images - returned)
+        metrics.gauge("images_per_request", self.stats["images"] / self.stats["requests"])
+        metrics.gauge("prompt_tokens_per_image", self.stats["prompt_tokens"] / self.stats["images"])
+
+    def report(self) -> str:
+        requests, images = self.stats["requests"], self.stats["images"]
+        if not requests:
+            return "no batched requests"
+        return (f"{images} images in {requests} batched requests ({images / requests:.1f} images/request, "
+                f"{self.stats['prompt_tokens'] / images:.0f} prompt tokens/image, "
+                f"{self.stats['api_seconds'] / images:.2f}s API time/image); {self.stats['malformed']} malformed, "
+                f"{self.stats['fallbacks']} images retried alone; images per request now {self.size}")
+
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from itertools import combinations
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pattern_mining import record_attributes
+from result_store import load_analysis, open_result_store
+
+DEFAULT_AGGREGATES = ".pattern_aggregates.sqlite"
+
+# Pairs seen fewer times than this are left out of snapshots to keep them small
+SNAPSHOT_MIN_PAIR_COUNT = 2
+
+
+def record_items(record) -> List[str]:
+    """The sorted "path=value" items of a result record, as in build_item_matrix."""
+    return sorted({f"{path}={value}" for path, value in record_attributes(record)})
+
+
+def items_digest(items: List[str]) -> str:
+    return hashlib.sha256("\n".join(items).encode("utf-8")).hexdigest()
+
+
+class PatternAggregates:
+    """Running attribute counts and pairwise co-occurrences over the analysis results.
+
+    The item set of every product is persisted along with the store version it
+    was read from, so an update only reads records that were added or replaced
+    since the last one and adjusts the counts by their difference. The digest of
+    the state identifies it for caching reports, and snapshots taken when a
+    report is written are the baseline of delta reports.
+    """
+
+    def __init__(self, path: str = DEFAULT_AGGREGATES):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS products (
+                key TEXT PRIMARY KEY,
+                version TEXT,
+                digest TEXT NOT NULL,
+                items TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS item_counts (
+                item TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pair_counts (
+                a TEXT NOT NULL,
+                b TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (a, b)
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                state TEXT NOT NULL
+            );
+        """)
+        self.products = {key: (version, digest, json.loads(items)) for key, version, digest, items in
+                         self.conn.execute("SELECT key, version, digest, items FROM products")}
+        self.item_counts = Counter(dict(self.conn.execute("SELECT item, count FROM item_counts")))
+        self.pair_counts = Counter({(a, b): count for a, b, count in
+                                    self.conn.execute("SELECT a, b, count FROM pair_counts")})
+        self._dirty_products = set()
+        self._dirty_items = set()
+        self._dirty_pairs = set()
+
+    def _apply(self, key: str, items: Optional[List[str]], version: Optional[str] = None):
+        """Replace the items of product `key` (None removes it) and adjust the counts."""
+        old = self.products.get(key)
+        old_items = old[2] if old else []
+        new_items = items or []
+        if old_items != new_items:
+            for sign, product_items in ((-1, old_items), (1, new_items)):
+                for item in product_items:
+                    self.item_counts[item] += sign
+                    self._dirty_items.add(item)
+                # Items are sorted, so each pair is (a, b) with a < b
+                for pair in combinations(product_items, 2):
+                    self.pair_counts[pair] += sign
+                    self._dirty_pairs.add(pair)
+        if items is None:
+            self.products.pop(key, None)
+        else:
+            self.products[key] = (version, items_digest(items), items)
+        self._dirty_products.add(key)
+
+    def update_from_store(self, store) -> Dict[str, int]:
+        """Bring the aggregates up to date with a result store, reading only new or replaced records."""
+        versions = store.versions()
+        counts = dict.fromkeys(("added", "changed", "removed", "unchanged"), 0)
+        for key, version in versions.items():
+            known = self.products.get(key)
+            if known is not None and known[0] == version:
+                counts["unchanged"] += 1
+                continue
+            items = record_items(store.get(key))
+            if known is not None and known[1] == items_digest(items):
+                # Rewritten with the same attributes; only remember the new version
+                self.products[key] = (version, known[1], known[2])
+                self._dirty_products.add(key)
+                counts["unchanged"] += 1
+                continue
+            counts["changed" if known is not None else "added"] += 1
+            self._apply(key, items, version)
+        for key in [key for key in self.products if key not in versions]:
+            self._apply(key, None)
+            counts["removed"] += 1
+        self.save()
+        return counts
+
+    def update_from_data(self, data: Dict) -> Dict[str, int]:
+        """Same as update_from_store for records already in memory (e.g. a legacy JSON file)."""
+        counts = dict.fromkeys(("added", "changed", "removed", "unchanged"), 0)
+        for key, record in data.items():
+            items = record_items(record)
+            known = self.products.get(key)
+            if known is not None and known[1] == items_digest(items):
+                counts["unchanged"] += 1
+                continue
+            counts["changed" if known is not None else "added"] += 1
+            self._apply(key, items)
+        for key in [key for key in self.products if key not in data]:
+            self._apply(key, None)
+            counts["removed"] += 1
+        self.save()
+        return counts
+
+    def update_from(self, path: str) -> Dict[str, int]:
+        """Update from the result store or legacy JSON file at `path`."""
+        if Path(path).suffix.lower() == ".json":
+            return self.update_from_data(load_analysis(path))
+        store = open_result_store(path)
+        try:
+            return self.update_from_store(store)
+        finally:
+            store.close()
+
+    def save(self):
+        with self.conn:
+            for key in self._dirty_products:
+                if key in self.products:
+                    version, digest, items = self.products[key]
+                    self.conn.execute("INSERT OR REPLACE INTO products (key, version, digest, items) "
+                                      "VALUES (?, ?, ?, ?)", (key, version, digest, json.dumps(items)))
+                else:
+                    self.conn.execute("DELETE FROM products WHERE key = ?", (key,))
+            for item in self._dirty_items:
+                if self.item_counts[item] > 0:
+                    self.conn.execute("INSERT OR REPLACE INTO item_counts (item, count) VALUES (?, ?)",
+                                      (item, self.item_counts[item]))
+                else:
+                    del self.item_counts[item]
+                    self.conn.execute("DELETE FROM item_counts WHERE item = ?", (item,))
+            for pair in self._dirty_pairs:
+                if self.pair_counts[pair] > 0:
+                    self.conn.execute("INSERT OR REPLACE INTO pair_counts (a, b, count) VALUES (?, ?, ?)",
+                                      (*pair, self.pair_counts[pair]))
+                else:
+                    del self.pair_counts[pair]
+                    self.conn.execute("DELETE FROM pair_counts WHERE a = ? AND b = ?", pair)
+        self._dirty_products.clear()
+        self._dirty_items.clear()
+        self._dirty_pairs.clear()
+
+    def digest(self) -> str:
+        """Digest of the aggregate state: changes whenever any product's attributes do."""
+        material = "\n".join(f"{key}\t{self.products[key][1]}" for key in sorted(self.products))
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def item_matrix(self, min_count: int = 1) -> Tuple[List[str], List[str], np.ndarray]:
+        """(product_keys, items, matrix) as from build_item_matrix, without reading any records."""
+        product_keys = sorted(self.products)
+        items = sorted(item for item, count in self.item_counts.items() if count >= min_count)
+        columns = {item: n for n, item in enumerate(items)}
+        matrix = np.zeros((len(product_keys), len(items)), dtype=bool)
+        for row, key in enumerate(product_keys):
+            matrix[row, [columns[item] for item in self.products[key][2] if item in columns]] = True
+        return product_keys, items, matrix
+
+    def state(self) -> Dict:
+        """The counts in a JSON-friendly form, as kept in snapshots."""
+        return {
+            "products": {key: digest for key, (_, digest, _) in sorted(self.products.items())},
+            "items": dict(sorted(self.item_counts.items())),
+            "pairs": [[a, b, count] for (a, b), count in sorted(self.pair_counts.items())
+                      if count >= SNAPSHOT_MIN_PAIR_COUNT],
+        }
+
+    def snapshot(self) -> bool:
+        """Record the current state as a delta baseline; False if it equals the latest snapshot."""
+        digest = self.digest()
+        latest = self.conn.execute("SELECT digest FROM snapshots ORDER BY snapshot_id DESC LIMIT 1").fetchone()
+        if latest and latest[0] == digest:
+            return False
+        with self.conn:
+            self.conn.execute("INSERT INTO snapshots (created_at, digest, state) VALUES (?, ?, ?)",
+                              (datetime.now().isoformat(), digest, json.dumps(self.state(), separators=(",", ":"))))
+        return True
+
+    def previous_snapshot(self) -> Optional[Dict]:
+        """The latest snapshot of a state other than the current one, or None."""
+        row = self.conn.execute("SELECT created_at, digest, state FROM snapshots WHERE digest != ? "
+                                "ORDER BY snapshot_id DESC LIMIT 1", (self.digest(),)).fetchone()
+        if row is None:
+            return None
+        return {"created_at": row[0], "digest": row[1], **json.loads(row[2])}
+
+    def delta(self, previous: Optional[Dict], min_support: int = 3, top_n: int = 15) -> Dict:
+        """What shifted between a snapshot (None: an empty catalog) and the current state."""
+        previous = previous or {"created_at": None, "digest": None, "products": {}, "items": {}, "pairs": []}
+        current = self.state()
+        before_products, after_products = previous["products"], current["products"]
+        n_before, n_after = len(before_products), len(after_products)
+
+        def share(count, total):
+            return count / total if total else 0.0
+
+        item_changes = []
+        for item in set(previous["items"]) | set(current["items"]):
+            before, after = previous["items"].get(item, 0), current["items"].get(item, 0)
+            if before != after:
+                item_changes.append({"item": item, "before": before, "after": after,
+                                     "share_change": round(share(after, n_after) - share(before, n_before), 4)})
+        item_changes.sort(key=lambda change: -abs(change["share_change"]))
+
+        before_pairs = {(a, b): count for a, b, count in previous["pairs"]}
+        after_pairs = {(a, b): count for a, b, count in current["pairs"]}
+        emerging = [{"items": list(pair), "before": before_pairs.get(pair, 0), "after": count}
+                    for pair, count in after_pairs.items()
+                    if count >= min_support and before_pairs.get(pair, 0) < min_support]
+        fading = [{"items": list(pair), "before": count, "after": after_pairs.get(pair, 0)}
+                  for pair, count in before_pairs.items()
+                  if count >= min_support and after_pairs.get(pair, 0) < min_support]
+        emerging.sort(key=lambda change: -change["after"])
+        fading.sort(key=lambda change: -change["before"])
+
+        return {
+            "since": previous["created_at"],
+            "from_digest": previous["digest"],
+            "to_digest": self.digest(),
+            "products_before": n_before,
+            "products_after": n_after,
+            "added": sorted(set(after_products) - set(before_products)),
+            "removed": sorted(set(before_products) - set(after_products)),
+            "changed": sorted(key for key in set(before_products) & set(after_products)
+                              if before_products[key] != after_products[key]),
+            "min_support": min_support,
+            "item_changes": item_changes[:top_n],
+            "emerging_pairs": emerging[:top_n],
+            "fading_pairs": fading[:top_n],
+        }
+
+    def close(self):
+        self.conn.close()
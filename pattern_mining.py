@@ -0,0 +1,158 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from canonicalize import canonicalize
+
+# Longer free-text values are descriptions rather than attributes and never repeat
+MAX_VALUE_WORDS = 4
+
+
+@lru_cache(maxsize=None)
+def normalize_key(key: str) -> str:
+    """Turn a response key like "Color Analysis" into an attribute path segment."""
+    return re.sub(r"[^a-z0-9]+", "_", key.lower()).strip("_")
+
+
+def flatten_attributes(analysis, prefix: str = "") -> List[Tuple[str, str]]:
+    """Flatten a nested analysis into (attribute path, value) pairs."""
+    pairs = []
+    if isinstance(analysis, dict):
+        for key, value in analysis.items():
+            path = f"{prefix}.{normalize_key(key)}" if prefix else normalize_key(key)
+            pairs.extend(flatten_attributes(value, path))
+    elif isinstance(analysis, list):
+        for value in analysis:
+            pairs.extend(flatten_attributes(value, prefix))
+    elif isinstance(analysis, (str, int, float, bool)):
+        words = str(analysis).split()
+        if words and len(words) <= MAX_VALUE_WORDS:
+            pairs.append((prefix, " ".join(words).rstrip(".").lower()))
+    return pairs
+
+
+def record_attributes(record) -> List[Tuple[str, str]]:
+    """(attribute path, value) pairs of a result record, from its canonical form.
+
+    Records without a stored canonical form (legacy JSON, stores written before
+    canonicalization) are canonicalized here. Only an analysis that maps onto no
+    template field at all falls back to its flattened free text.
+    """
+    if isinstance(record, dict) and record.get("canonical") is not None:
+        canonical = record["canonical"]
+    else:
+        analysis = record.get("analysis", record) if isinstance(record, dict) else record
+        canonical = canonicalize(analysis) if isinstance(analysis, dict) else None
+        if not canonical:
+            return flatten_attributes(analysis)
+    return [(path, value) for path, values in canonical.items() for value in values]
+
+
+def build_item_matrix(data: Dict, min_count: int = 1):
+    """One-hot encode every attribute value of every product.
+
+    Returns (product_keys, items, matrix) where matrix[p, i] is True when product
+    p has item i, and items are "path=value" strings seen at least `min_count` times.
+    """
+    product_keys = list(data)
+    item_ids = {}
+    rows = []
+    for key in product_keys:
+        ids = set()
+        for path, value in record_attributes(data[key]):
+            ids.add(item_ids.setdefault(f"{path}={value}", len(item_ids)))
+        rows.append(ids)
+
+    matrix = np.zeros((len(product_keys), len(item_ids)), dtype=bool)
+    for row, ids in enumerate(rows):
+        matrix[row, list(ids)] = True
+
+    items = np.array(list(item_ids), dtype=object)
+    keep = matrix.sum(axis=0) >= min_count
+    return product_keys, list(items[keep]), matrix[:, keep]
+
+
+def mine_frequent_itemsets(matrix: np.ndarray, min_support: int = 3, max_size: int = 3) -> List[Tuple[Tuple[int, ...], int]]:
+    """Depth-first frequent itemset search over the columns of a one-hot matrix.
+
+    Each itemset carries the vector of products that contain it, so the support
+    of all its one-item extensions comes from a single matrix-vector product.
+    Returns (item indices, support) pairs for every itemset of two or more items.
+    """
+    counts = matrix.sum(axis=0)
+    frequent = np.flatnonzero(counts >= min_support)
+    columns = matrix[:, frequent].astype(np.float32)
+    results = []
+
+    stack = [((int(i),), columns[:, n], n) for n, i in enumerate(frequent)]
+    while stack:
+        itemset, rows, position = stack.pop()
+        if len(itemset) >= max_size:
+            continue
+        tail = columns[:, position + 1:]
+        if not tail.shape[1]:
+            continue
+        extension_counts = rows @ tail
+        for offset in np.flatnonzero(extension_counts >= min_support):
+            n = position + 1 + offset
+            extended = itemset + (int(frequent[n]),)
+            results.append((extended, int(extension_counts[offset])))
+            stack.append((extended, rows * columns[:, n], n))
+    return results
+
+
+def cooccurrence_table(matrix: np.ndarray, min_support: int = 3) -> List[Tuple[int, int, int, float]]:
+    """Return (item a, item b, count, lift) for item pairs that co-occur at least `min_support` times."""
+    n_products = matrix.shape[0]
+    if not n_products:
+        return []
+    as_float = matrix.astype(np.float32)
+    together = as_float.T @ as_float
+    support = np.diag(together).copy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lift = together * n_products / np.outer(support, support)
+    a, b = np.nonzero(np.triu(together >= min_support, k=1))
+    return [(int(i), int(j), int(together[i, j]), float(lift[i, j])) for i, j in zip(a, b)]
+
+
+def mine_patterns(data: Dict, min_support: int = 3, max_size: int = 3, top_n: int = 25) -> Dict:
+    """Mine verified attribute combinations from analysis records.
+
+    Every count in the result is computed from the data, so reports built on it
+    can quote the numbers as-is.
+    """
+    product_keys, items, matrix = build_item_matrix(data, min_count=min_support)
+    return mine_item_matrix(product_keys, items, matrix, min_support=min_support,
+                            max_size=max_size, top_n=top_n)
+
+
+def mine_item_matrix(product_keys: List[str], items: List[str], matrix: np.ndarray,
+                     min_support: int = 3, max_size: int = 3, top_n: int = 25) -> Dict:
+    """Mine combinations from a prebuilt one-hot matrix (see build_item_matrix)."""
+    itemsets = mine_frequent_itemsets(matrix, min_support=min_support, max_size=max_size)
+    itemsets.sort(key=lambda entry: (-len(entry[0]), -entry[1]))
+
+    combinations = []
+    for indices, support in itemsets[:top_n]:
+        rows = np.flatnonzero(matrix[:, list(indices)].all(axis=1))
+        combinations.append({
+            "items": [items[i] for i in indices],
+            "count": support,
+            "support": support / len(product_keys),
+            "products": [product_keys[r] for r in rows],
+        })
+
+    pairs = cooccurrence_table(matrix, min_support=min_support)
+    pairs.sort(key=lambda entry: (-entry[3], -entry[2]))
+    return {
+        "products": len(product_keys),
+        "items": len(items),
+        "min_support": min_support,
+        "item_counts": sorted(((items[i], int(c)) for i, c in enumerate(matrix.sum(axis=0))),
+                              key=lambda entry: -entry[1])[:top_n],
+        "combinations": combinations,
+        "pairs": [{"items": [items[a], items[b]], "count": count, "lift": round(lift, 2)}
+                  for a, b, count, lift in pairs[:top_n]],
+    }
@@ -0,0 +1,109 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+DEFAULT_SHARD_CACHE = ".pattern_shard_cache"
+CHARS_PER_TOKEN = 4
+
+# A shard may end early at a content-defined boundary once it holds this share
+# of the budget, so adding a product only reshuffles the shard it lands in
+MIN_SHARD_FILL = 0.5
+BOUNDARY_MODULUS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def flatten_leaves(analysis, prefix: str = "") -> Dict[str, str]:
+    """Flatten a nested analysis into {dotted key path: value} with lists joined."""
+    leaves = {}
+    if isinstance(analysis, dict):
+        for key, value in analysis.items():
+            leaves.update(flatten_leaves(value, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(analysis, list):
+        if all(not isinstance(value, (dict, list)) for value in analysis):
+            leaves[prefix] = ", ".join(str(value) for value in analysis)
+        else:
+            for n, value in enumerate(analysis):
+                leaves.update(flatten_leaves(value, f"{prefix}.{n}"))
+    elif analysis is not None:
+        leaves[prefix] = str(analysis)
+    return leaves
+
+
+def compact_serialize(records: Dict) -> str:
+    """Serialize records without indentation, naming each key path once in a shared field table.
+
+    Output: {"fields": [path, ...], "rows": [[image key, {field index: value}], ...]}
+    """
+    fields = {}
+    rows = []
+    for key, record in records.items():
+        analysis = record.get("analysis", record) if isinstance(record, dict) else record
+        row = {}
+        for path, value in flatten_leaves(analysis).items():
+            row[fields.setdefault(path, len(fields))] = value
+        rows.append([key, row])
+    return json.dumps({"fields": list(fields), "rows": rows}, separators=(",", ":"), ensure_ascii=False)
+
+
+def _is_boundary(key: str) -> bool:
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % BOUNDARY_MODULUS == 0
+
+
+def shard_records(data: Dict, token_budget: int) -> List[Dict]:
+    """Split records into shards whose compact serialization fits `token_budget`.
+
+    Records are visited in key order and shards end either when the next record
+    would overflow the budget or at a key whose hash marks a boundary, so
+    boundaries stay put when unrelated products are added or changed.
+    """
+    shards = []
+    current = {}
+    current_tokens = 0
+    for key in sorted(data):
+        record_tokens = estimate_tokens(compact_serialize({key: data[key]}))
+        if current and current_tokens + record_tokens > token_budget:
+            shards.append(current)
+            current, current_tokens = {}, 0
+        current[key] = data[key]
+        current_tokens += record_tokens
+        if current_tokens >= token_budget * MIN_SHARD_FILL and _is_boundary(key):
+            shards.append(current)
+            current, current_tokens = {}, 0
+    if current:
+        shards.append(current)
+    return shards
+
+
+class ShardSummaryCache:
+    """Summaries of shards on disk, keyed by the shard content, model and prompt."""
+
+    def __init__(self, cache_dir: str = DEFAULT_SHARD_CACHE):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(shard_text: str, model: str, prompt: str) -> str:
+        material = "\n".join([model, hashlib.sha256(prompt.encode("utf-8")).hexdigest(), shard_text])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.cache_dir / f"{key}.json"
+        if not path.exists():
+            self.misses += 1
+            return None
+        self.hits += 1
+        with open(path, "r") as f:
+            return json.load(f)["summary"]
+
+    def put(self, key: str, summary: str):
+        path = self.cache_dir / f"{key}.json"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"summary": summary}, f)
+        tmp_path.replace(path)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from pathlib import Path
+
+from analysis_cache import DEFAULT_CACHE, AnalysisCache
+from download_images import DEFAULT_ACTIONS_PER_MINUTE, scrape_listings, scrape_shopbop
+from download_manifest import DEFAULT_MANIFEST
+from metrics import add_metrics_arguments, metrics, start_metrics
+from image_preprocess import DEFAULT_PREPROCESS_DIR, DETAIL_LEVELS, ImagePreprocessor
+from image_to_tags import (DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE, OUTPUT_MODES,
+                           analyze_and_store_async, estimated_tokens_for, open_analysis_store, setup_logging)
+from rate_limiter import RateLimiter
+from request_controller import DEFAULT_DEAD_LETTER, RequestController
+from result_store import DEFAULT_STORE
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = Path("shopbop_images")
+DEFAULT_QUEUE_SIZE = 32
+
+# Download outcomes that produce new image content to analyze
+NEW_CONTENT = ("added", "changed")
+
+
+async def run_pipeline(scrape, scrape_kwargs=None, concurrency=DEFAULT_CONCURRENCY,
+                       requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                       store_path=DEFAULT_STORE, cache=None, preprocessor=None, detail="high",
+                       queue_size=DEFAULT_QUEUE_SIZE, output_mode="json", controller=None, color_analyzer=None):
+    """Scrape and analyze at the same time, handing images over through a bounded queue.
+
+    `scrape` (scrape_shopbop or scrape_listings) runs on a thread. Each image it
+    downloads is put on a queue of `queue_size` as soon as it lands, and
+    `concurrency` workers analyze images from that queue under the API rate
+    limits, streaming results into the store. When the analyzers fall behind,
+    the queue fills, download workers block on it and the scraper stops
+    submitting, so backpressure reaches all the way back to the browser.
+
+    Images already on disk but missing from the store (for example from an
+    interrupted run) are queued as well, so a rerun resumes where the last one
+    stopped; products the manifest reports as unchanged are not analyzed again.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    store = open_analysis_store(store_path)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    if preprocessor:
+        detail = preprocessor.detail
+    estimated_tokens = estimated_tokens_for(detail, output_mode, color_analyzer)
+    queued = set()
+    stats = {"queued": 0, "analyzed": 0, "failed": 0}
+    timings = {"started": time.monotonic()}
+    scrape_done = asyncio.Event()
+
+    # Runs on the event loop thread, like every other store access
+    async def enqueue(image_path, force=False):
+        key = str(image_path)
+        if key in queued or (not force and key in store):
+            return
+        queued.add(key)
+        stats["queued"] += 1
+        with metrics.timer("analysis_queue_wait"):
+            await queue.put(image_path)
+        metrics.gauge("queue_depth", queue.qsize())
+
+    def on_complete(url, filename, ok, metadata):
+        # Called on a download thread; blocks while the queue is full
+        if ok and metadata.get("status") in NEW_CONTENT:
+            asyncio.run_coroutine_threadsafe(enqueue(Path(filename), force=True), loop).result()
+
+    def run_scraper():
+        try:
+            scrape(on_complete=on_complete, max_pending=queue_size, **(scrape_kwargs or {}))
+        except Exception as e:
+            logger.error(f"Scraper failed: {str(e)}")
+        finally:
+            timings["scraped"] = time.monotonic()
+            loop.call_soon_threadsafe(scrape_done.set)
+
+    async def feed_backlog():
+        for image_path in sorted(IMAGES_DIR.glob("*.jpg")):
+            await enqueue(image_path)
+
+    async def worker():
+        while True:
+            image_path = await queue.get()
+            metrics.gauge("queue_depth", queue.qsize())
+            if image_path is None:
+                return
+            timings.setdefault("first_analysis", time.monotonic())
+            try:
+                analysis = await analyze_and_store_async(image_path, store, limiter=limiter, cache=cache,
+                                                         preprocessor=preprocessor, detail=detail,
+                                                         estimated_tokens=estimated_tokens,
+                                                         output_mode=output_mode, controller=controller,
+                                                         color_analyzer=color_analyzer)
+            except Exception as e:
+                # A dead worker would stop draining the queue and stall the scraper
+                logger.error(f"Error analyzing {image_path}: {str(e)}")
+                analysis = None
+            stats["analyzed" if analysis else "failed"] += 1
+            timings["last_analysis"] = time.monotonic()
+
+    IMAGES_DIR.mkdir(exist_ok=True)
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        # Daemon thread, so an interrupted pipeline exits without waiting for the browser
+        threading.Thread(target=run_scraper, name="scraper", daemon=True).start()
+        await feed_backlog()
+        await scrape_done.wait()
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        store.close()
+
+    finished = time.monotonic()
+    started = timings["started"]
+    logger.info(f"Pipeline finished: {stats['queued']} images queued, {stats['analyzed']} analyzed, "
+                f"{stats['failed']} failed")
+    analysis_span = timings["last_analysis"] - timings["first_analysis"] if "last_analysis" in timings else 0.0
+    logger.info(f"Scraping took {timings['scraped'] - started:.1f}s, analysis ran for {analysis_span:.1f}s, "
+                f"end to end {finished - started:.1f}s; rate limit waits {limiter.total_wait:.1f}s")
+    if controller is not None:
+        logger.info(f"Request controller: {controller.report()}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scrape Shopbop and analyze images as they download")
+    parser.add_argument('--pages', type=int, default=5,
+                        help="Number of listing pages to load (0 = until the listing runs out)")
+    parser.add_argument('--workers', type=int, default=8, help="Parallel image downloads")
+    parser.add_argument('--host-rate', type=float, default=4.0,
+                        help="Maximum download requests per second per host")
+    parser.add_argument('--actions-per-minute', type=float, default=DEFAULT_ACTIONS_PER_MINUTE,
+                        help="Politeness budget for page loads and clicks")
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="Download manifest")
+    parser.add_argument('--no-browser', action='store_true',
+                        help="Fetch listing pages over plain HTTP and parse them without Chrome")
+    parser.add_argument('--snapshots', metavar='DIR',
+                        help="Parse saved listing HTML files from DIR instead of fetching (implies --no-browser)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of analysis requests in flight")
+    parser.add_argument('--rpm', type=int, default=DEFAULT_REQUESTS_PER_MINUTE, help="Requests per minute limit")
+    parser.add_argument('--tpm', type=int, default=DEFAULT_TOKENS_PER_MINUTE, help="Tokens per minute limit")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="Downloaded images waiting for analysis before the scraper is held back")
+    parser.add_argument('--store', default=DEFAULT_STORE, help="Result store to append to (.jsonl or .sqlite)")
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help="Content-addressed analysis cache file")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Always call the API, even for previously analyzed image content")
+    parser.add_argument('--detail', choices=DETAIL_LEVELS, default="high",
+                        help="Vision detail level sent with each image")
+    parser.add_argument('--preprocess', action='store_true',
+                        help="Crop, resize and re-encode images before upload")
+    parser.add_argument('--preprocess-dir', default=DEFAULT_PREPROCESS_DIR,
+                        help="Directory caching preprocessed images")
+    parser.add_argument('--output', choices=OUTPUT_MODES, default="json",
+                        help="Free-form JSON, or a strict schema of enum codes with far fewer output tokens")
+    parser.add_argument('--no-retry', action='store_true',
+                        help="Give up on an image after its first failed request")
+    parser.add_argument('--dead-letter', default=DEFAULT_DEAD_LETTER,
+                        help="File listing images whose analysis failed for good")
+    parser.add_argument('--local-colors', action='store_true',
+                        help="Compute the color fields from pixels and leave them out of the prompt")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging()
+    start_metrics(args)
+
+    scrape_kwargs = {"total_pages": args.pages, "workers": args.workers, "per_host_rate": args.host_rate,
+                     "manifest_path": args.manifest, "actions_per_minute": args.actions_per_minute}
+    scrape = scrape_shopbop
+    if args.no_browser or args.snapshots:
+        scrape = scrape_listings
+        scrape_kwargs["snapshot_dir"] = args.snapshots
+
+    cache = None if args.no_cache else AnalysisCache(args.cache)
+    preprocessor = ImagePreprocessor(detail=args.detail, cache_dir=args.preprocess_dir) if args.preprocess else None
+    controller = None
+    if not args.no_retry:
+        controller = RequestController(concurrency=args.concurrency, dead_letter_path=args.dead_letter)
+    color_analyzer = None
+    if args.local_colors:
+        from color_analyzer import ColorAnalyzer
+        color_analyzer = ColorAnalyzer()
+    try:
+        asyncio.run(run_pipeline(scrape, scrape_kwargs, concurrency=args.concurrency,
+                                 requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                 store_path=args.store, cache=cache, preprocessor=preprocessor,
+                                 detail=args.detail, queue_size=args.queue_size,
+                                 output_mode=args.output, controller=controller,
+                                 color_analyzer=color_analyzer))
+    finally:
+        if cache is not None:
+            cache.close()
+        metrics.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEAD_LETTER = "dead_letter.jsonl"
+
+# Error classes
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+SERVER_ERROR = "server_error"
+BAD_RESPONSE = "bad_response"
+PERMANENT = "permanent"
+
+RETRYABLE = {RATE_LIMIT, TIMEOUT, CONNECTION, SERVER_ERROR, BAD_RESPONSE}
+
+# Errors that mean the API is overloaded, so fewer requests should be in flight
+THROTTLING = {RATE_LIMIT, TIMEOUT, SERVER_ERROR}
+
+# Bad responses are usually the model, not the service; retrying them forever wastes tokens
+MAX_BAD_RESPONSE_RETRIES = 2
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def classify_error(exc: BaseException) -> str:
+    """Sort an exception from an API call into one of the error classes above."""
+    # Imported here so callers that never reach the API do not pay for importing openai
+    import openai
+
+    if isinstance(exc, openai.RateLimitError):
+        # Running out of quota is also a 429, but waiting will not fix it
+        if getattr(exc, "code", None) == "insufficient_quota":
+            return PERMANENT
+        return RATE_LIMIT
+    if isinstance(exc, (openai.APITimeoutError, asyncio.TimeoutError, TimeoutError)):
+        return TIMEOUT
+    if isinstance(exc, openai.APIConnectionError):
+        return CONNECTION
+    if isinstance(exc, openai.APIStatusError):
+        if exc.status_code >= 500 or exc.status_code in (408, 409):
+            return SERVER_ERROR
+        return PERMANENT
+    if isinstance(exc, ValueError):
+        # Unparseable or invalid content: the parsers raise ValueError, and json.JSONDecodeError is one.
+        # Other exceptions are bugs in our own code, which another paid call would only hit again.
+        return BAD_RESPONSE
+    return PERMANENT
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Seconds in a header value such as "20", "1.5s", "250ms" or "6m0s"."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait, from retry-after or rate-limit reset headers."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        delay = parse_duration(headers["retry-after-ms"])
+        if delay is not None:
+            return delay / 1000
+    if headers.get("retry-after"):
+        delay = parse_duration(headers["retry-after"])
+        if delay is None:
+            try:
+                delay = (parsedate_to_datetime(headers["retry-after"]) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return max(0.0, delay)
+    # Only the exhausted limit's reset time matters
+    resets = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0" and headers.get(f"x-ratelimit-reset-{kind}"):
+            delay = parse_duration(headers[f"x-ratelimit-reset-{kind}"])
+            if delay is not None:
+                resets.append(delay)
+    return max(resets) if resets else None
+
+
+class AIMDConcurrency:
+    """Concurrency limit adjusted additive-increase / multiplicative-decrease.
+
+    Each success raises the limit by `increase / limit`, about one extra slot per
+    limit's worth of successes; each throttling signal multiplies it by
+    `decrease`, at most once per `cooldown` seconds so a burst of failures from
+    one overload counts once.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = None, increase: float = 1.0,
+                 decrease: float = 0.5, cooldown: float = 2.0):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(max(minimum, min(initial, self.maximum)))
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_cut = 0.0
+        self._condition = None
+
+    def slots(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.slots())
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+    def on_throttle(self):
+        now = time.monotonic()
+        if now - self.last_cut >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self.last_cut = now
+            logger.info("Throttled; concurrency limit cut to %d", self.slots())
+
+
+class DeadLetterList:
+    """Append-only JSONL list of requests that failed for good, for targeted re-runs."""
+
+    def __init__(self, path: str = DEFAULT_DEAD_LETTER):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def add(self, key: str, error_class: str, error: BaseException, attempts: int):
+        entry = {"key": key, "error_class": error_class, "error": str(error)[:500],
+                 "attempts": attempts, "timestamp": datetime.now().isoformat()}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def entries(self) -> Dict[str, Dict]:
+        """Latest entry per key."""
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path, "r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["key"]] = entry
+        return entries
+
+    def keys(self):
+        return list(self.entries())
+
+    def remove(self, keys: Iterable[str]):
+        """Drop the entries for `keys`, e.g. after they succeeded on a re-run."""
+        keys = set(keys)
+        with self.lock:
+            remaining = [entry for key, entry in self.entries().items() if key not in keys]
+            tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp_path, "w") as f:
+                for entry in remaining:
+                    f.write(json.dumps(entry) + "\n")
+            tmp_path.replace(self.path)
+
+
+class RequestController:
+    """Retries, backoff and adaptive concurrency for API calls.
+
+    Failed calls are classified; retryable ones are retried with jittered
+    exponential backoff, never sooner than the server's retry-after or
+    rate-limit reset. A rate limit pauses every caller, not only the one that
+    hit it. Requests that fail for good go to the dead-letter list.
+    """
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 concurrency: int = 8, min_concurrency: int = 1, dead_letter_path: str = DEFAULT_DEAD_LETTER):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = AIMDConcurrency(concurrency, minimum=min_concurrency, maximum=concurrency)
+        self.dead_letters = DeadLetterList(dead_letter_path)
+        self.paused_until = 0.0
+        self.failed_keys = set()
+        self.stats = {"calls": 0, "succeeded": 0, "retries": 0, "dead_lettered": 0}
+        self.errors = dict.fromkeys(sorted(RETRYABLE | {PERMANENT}), 0)
+
+    def _delay(self, attempt: int, exc: BaseException) -> float:
+        delay = random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * 2 ** attempt)
+        hinted = retry_after(exc)
+        if hinted is not None:
+            delay = max(delay, hinted)
+        return delay
+
+    def _failed(self, key: str, attempt: int, exc: BaseException, dead_letter: bool = True) -> Optional[float]:
+        """Record a failed attempt; return the delay before retrying, or None to give up."""
+        error_class = classify_error(exc)
+        self.errors[error_class] += 1
+        metrics.count(f"api_errors_{error_class}")
+        if error_class in THROTTLING:
+            self.concurrency.on_throttle()
+        retries_allowed = MAX_BAD_RESPONSE_RETRIES if error_class == BAD_RESPONSE else self.max_retries
+        if error_class not in RETRYABLE or attempt >= retries_allowed:
+            logger.error("Giving up on %s after %d attempts (%s): %s", key, attempt + 1, error_class, exc)
+            if not dead_letter:
+                return None
+            self.dead_letters.add(key, error_class, exc, attempt + 1)
+            self.failed_keys.add(key)
+            self.stats["dead_lettered"] += 1
+            return None
+        delay = self._delay(attempt, exc)
+        if error_class == RATE_LIMIT:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.stats["retries"] += 1
+        logger.warning("Retrying %s in %.1fs after %s: %s", key, delay, error_class, exc)
+        return delay
+
+    def _succeeded(self):
+        self.stats["succeeded"] += 1
+        self.concurrency.on_success()
+
+    async def call_async(self, key: str, request, dead_letter: bool = True):
+        """Await `request()` (a coroutine function) with retries; None if it failed for good.
+
+        With `dead_letter` False, a request that fails for good is not added to the
+        dead-letter list, e.g. because the caller falls back to other requests.
+        """
+        self.stats["calls"] += 1
+        for attempt in range(self.max_retries + 1):
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                with metrics.timer("rate_limit_pause_wait"):
+                    await asyncio.sleep(pause)
+            await self.concurrency.acquire()
+            try:
+                result = await request()
+            except Exception as e:
+                error = e
+            else:
+                self._succeeded()
+                return result
+            finally:
+                # Also when the task is cancelled, or the slot would never come back
+                await self.concurrency.release()
+            delay = self._failed(key, attempt, error, dead_letter)
+            if delay is None:
+                return None
+            with metrics.timer("retry_backoff_wait"):
+                await asyncio.sleep(delay)
+        return None
+
+    def call(self, key: str, request, dead_letter: bool = True):
+        """Synchronous call_async for one request at a time."""
+        self.stats["calls"] += 1
+        for attempt in range(self.max_retries + 1):
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                with metrics.timer("rate_limit_pause_wait"):
+                    time.sleep(pause)
+            try:
+                result = request()
+            except Exception as e:
+                delay = self._failed(key, attempt, e, dead_letter)
+                if delay is None:
+                    return None
+                with metrics.timer("retry_backoff_wait"):
+                    time.sleep(delay)
+            else:
+                self._succeeded()
+                return result
+        return None
+
+    def report(self) -> str:
+        errors = ", ".join(f"{name} {count}" for name, count in self.errors.items() if count)
+        return (f"{self.stats['succeeded']}/{self.stats['calls']} calls succeeded, {self.stats['retries']} retries, "
+                f"{self.stats['dead_lettered']} dead-lettered; errors: {errors or 'none'}; "
+                f"concurrency limit {self.concurrency.slots()}")
@@ -0,0 +1,310 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, so one writer per store
+    fcntl = None
+
+DEFAULT_STORE = "shopbop_analysis.jsonl"
+LEGACY_JSON = "shopbop_analysis.json"
+
+
+class JsonlResultStore:
+    """Append-only JSONL result store with a sidecar offset index.
+
+    Every put appends a single line, so writes are O(1) and a crash can at most
+    leave a partial last line, which is discarded the next time the store opens.
+    The `.idx` file maps keys to byte offsets so opening the store only reads
+    the index, not the records. Later lines for a key supersede earlier ones.
+
+    Several processes may append to one store: opening and every put hold an
+    exclusive lock on the data file, and a record's offset is the file's size
+    under that lock. Records other processes put after this one opened are not
+    visible until the store is reopened. With `durable`, every put is fsynced.
+    """
+
+    def __init__(self, path: str, durable: bool = False):
+        self.path = Path(path)
+        self.index_path = Path(str(path) + ".idx")
+        self.durable = durable
+        self.index = {}
+        self._data = open(self.path, "ab")
+        with self._locked():
+            self._load_index()
+        self._reader = open(self.path, "rb")
+        self._index_file = open(self.index_path, "a", encoding="utf-8")
+
+    @contextlib.contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._data.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._data.fileno(), fcntl.LOCK_UN)
+
+    def _load_index(self):
+        size = self.path.stat().st_size
+        indexed_end = 0
+        index_lines = 0
+        if self.index_path.exists():
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        offset, key = json.loads(line)
+                    except ValueError:
+                        break
+                    if offset >= size:
+                        break
+                    self.index[key] = offset
+                    indexed_end = max(indexed_end, offset)
+                    index_lines += 1
+
+        # Index entries are written after the record, so re-scan anything past
+        # the last indexed record and rewrite the index if it was behind
+        indexed = len(self.index)
+        good_end = self._scan_from(indexed_end)
+        if good_end < size:
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+        if len(self.index) != indexed or index_lines != len(self.index) or good_end < size:
+            self._rewrite_index()
+
+    def _scan_from(self, offset: int) -> int:
+        """Index complete records from `offset` on and return the end of the last good one."""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    return offset
+                try:
+                    key = json.loads(line)["key"]
+                except (ValueError, KeyError):
+                    return offset
+                self.index[key] = offset
+                offset += len(line)
+
+    def _rewrite_index(self):
+        tmp_path = Path(str(self.index_path) + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, offset in sorted(self.index.items(), key=lambda item: item[1]):
+                f.write(json.dumps([offset, key]) + "\n")
+        os.replace(tmp_path, self.index_path)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def versions(self) -> Dict[str, str]:
+        """A value per key that changes whenever the key's record is replaced (its offset)."""
+        return {key: str(offset) for key, offset in self.index.items()}
+
+    def get(self, key: str, default=None):
+        offset = self.index.get(key)
+        if offset is None:
+            return default
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline())["record"]
+
+    def put(self, key: str, record: Dict):
+        line = (json.dumps({"key": key, "record": record}, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._locked():
+            # Other processes may have appended since this one last wrote
+            offset = os.fstat(self._data.fileno()).st_size
+            self._data.write(line)
+            self._data.flush()
+            if self.durable:
+                os.fsync(self._data.fileno())
+            if os.stat(self.index_path).st_ino != os.fstat(self._index_file.fileno()).st_ino:
+                # Another process opened the store and rewrote the index
+                self._index_file.close()
+                self._index_file = open(self.index_path, "a", encoding="utf-8")
+            self._index_file.write(json.dumps([offset, key]) + "\n")
+            self._index_file.flush()
+        self.index[key] = offset
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        for key in list(self.index):
+            yield key, self.get(key)
+
+    def close(self):
+        self._data.close()
+        self._reader.close()
+        self._index_file.close()
+
+
+class SqliteResultStore:
+    """Result store backed by a single SQLite table (one row per image key)."""
+
+    def __init__(self, path: str, durable: bool = False):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=%s" % ("FULL" if durable else "NORMAL"))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def __contains__(self, key: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute("SELECT key FROM results ORDER BY rowid")]
+
+    def versions(self) -> Dict[str, str]:
+        """A value per key that changes whenever the key's record is replaced (its update time)."""
+        return dict(self.conn.execute("SELECT key, updated_at FROM results"))
+
+    def get(self, key: str, default=None):
+        row = self.conn.execute("SELECT record FROM results WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, key: str, record: Dict):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, record, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(record, ensure_ascii=False), datetime.now().isoformat()),
+            )
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        for key, record in self.conn.execute("SELECT key, record FROM results ORDER BY rowid"):
+            yield key, json.loads(record)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_result_store(path: str = DEFAULT_STORE, durable: bool = False):
+    """Open the result store at `path`, choosing the backend from the file extension.
+
+    With `durable`, every put is flushed to disk before it returns. Without it a
+    crash of the process loses nothing, but a crash of the machine may lose the
+    last few results (the JSONL store discards a partial last line on open).
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".jsonl":
+        return JsonlResultStore(path, durable=durable)
+    if suffix in (".db", ".sqlite", ".sqlite3"):
+        return SqliteResultStore(path, durable=durable)
+    raise ValueError(f"Unsupported result store format: {path} (use .jsonl or .sqlite)")
+
+
+def import_legacy_json(store, json_path: str = LEGACY_JSON) -> int:
+    """Copy records from a legacy shopbop_analysis.json that the store does not have yet.
+
+    Records are canonicalized on the way in, like newly analyzed ones.
+    """
+    from canonicalize import add_canonical  # canonicalize imports this module
+
+    if not os.path.exists(json_path):
+        return 0
+    with open(json_path, "r") as f:
+        legacy = json.load(f)
+    imported = 0
+    for key, record in legacy.items():
+        if key not in store:
+            store.put(key, add_canonical(record) if isinstance(record, dict) else record)
+            imported += 1
+    return imported
+
+
+def export_legacy_json(store, output_file: str = LEGACY_JSON) -> str:
+    """Write the store out in the legacy shopbop_analysis.json format."""
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(dict(store.items()), f, indent=2)
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def swap_directory(tmp_dir, path) -> str:
+    """Move the finished directory `tmp_dir` to `path`, replacing the one there.
+
+    The old directory is renamed to `<path>.old` before the new one moves in,
+    and deleted only afterwards, so there is always a complete copy on disk:
+    a reader (or a crash) between the two renames finds it via saved_directory.
+    """
+    path = Path(path)
+    old = Path(str(path) + ".old")
+    if path.exists():
+        if old.exists():
+            shutil.rmtree(old)
+        os.replace(path, old)
+    os.replace(tmp_dir, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return str(path)
+
+
+def saved_directory(path) -> Path:
+    """Where to read a directory saved with swap_directory.
+
+    That is `path`, or its `.old` copy while a swap is under way or after one
+    was interrupted.
+    """
+    path = Path(path)
+    old = Path(str(path) + ".old")
+    if not (path / "manifest.json").exists() and (old / "manifest.json").exists():
+        return old
+    return path
+
+
+def load_analysis(path: str) -> Dict:
+    """Load all analysis records from either a legacy JSON file or a result store."""
+    if Path(path).suffix.lower() == ".json":
+        with open(path, "r") as f:
+            return json.load(f)
+    store = open_result_store(path)
+    try:
+        return dict(store.items())
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import or export analysis result stores")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write a store out as legacy JSON")
+    export_parser.add_argument("store", nargs="?", default=DEFAULT_STORE)
+    export_parser.add_argument("output", nargs="?", default=LEGACY_JSON)
+    import_parser = subparsers.add_parser("import", help="Load legacy JSON into a store")
+    import_parser.add_argument("source", nargs="?", default=LEGACY_JSON)
+    import_parser.add_argument("store", nargs="?", default=DEFAULT_STORE)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        store = open_result_store(args.store)
+        try:
+            print(f"Exported {len(store)} records to {export_legacy_json(store, args.output)}")
+        finally:
+            store.close()
+    else:
+        store = open_result_store(args.store)
+        try:
+            print(f"Imported {import_legacy_json(store, args.source)} records into {args.store}")
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
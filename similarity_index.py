@@ -0,0 +1,309 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from color_analyzer import ColorAnalyzer, srgb_to_lab
+from result_store import saved_directory, swap_directory
+
+DEFAULT_INDEX_DIR = "shopbop_similarity"
+FORMAT_VERSION = 1
+
+HASH_BYTES = 8
+# Lab histogram of the garment: 4 lightness x 4 a x 4 b bins
+COLOR_BINS = (4, 4, 4)
+COLOR_DIMS = int(np.prod(COLOR_BINS))
+# Gradient magnitude of the garment, pooled to a 16 x 8 grid; ignores color, so it
+# matches the same style in other colorways
+LAYOUT_SHAPE = (16, 8)
+LAYOUT_DIMS = LAYOUT_SHAPE[0] * LAYOUT_SHAPE[1]
+
+# Near-duplicates: at most this many of the 64 hash bits differ...
+DUPLICATE_HASH_DISTANCE = 6
+# ...and the garment colors agree at least this well (Bhattacharyya coefficient)
+DUPLICATE_COLOR_SIMILARITY = 0.9
+
+_POPCOUNT = np.array([bin(n).count("1") for n in range(256)], dtype=np.uint8)
+
+
+def difference_hash(rgb: np.ndarray) -> np.ndarray:
+    """64-bit dHash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its neighbor."""
+    gray = np.asarray(Image.fromarray(rgb).convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(gray[:, 1:] > gray[:, :-1])
+
+
+def hamming_distances(queries: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """(m, n) bit distances between m and n packed hashes."""
+    return _POPCOUNT[queries[:, None, :] ^ hashes[None, :, :]].sum(axis=2, dtype=np.int32)
+
+
+def color_histogram(lab: np.ndarray) -> np.ndarray:
+    """Square-rooted Lab histogram of garment pixels; dot products are Bhattacharyya coefficients."""
+    l_bins, a_bins, b_bins = COLOR_BINS
+    l_index = np.clip((lab[:, 0] / 100 * l_bins).astype(np.int64), 0, l_bins - 1)
+    a_index = np.clip(((lab[:, 1] + 60) / 120 * a_bins).astype(np.int64), 0, a_bins - 1)
+    b_index = np.clip(((lab[:, 2] + 60) / 120 * b_bins).astype(np.int64), 0, b_bins - 1)
+    counts = np.bincount((l_index * a_bins + a_index) * b_bins + b_index, minlength=COLOR_DIMS)
+    return np.sqrt(counts / max(1, counts.sum())).astype(np.float32)
+
+
+def layout_vector(lightness: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Zero-mean, unit-length map of garment edges, pooled over the garment's bounding box."""
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    vector = np.zeros(LAYOUT_DIMS, dtype=np.float32)
+    if not len(rows) or not len(cols):
+        return vector
+    gy, gx = np.gradient(lightness)
+    edges = (np.hypot(gx, gy) * mask)[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].astype(np.float32)
+    pooled = np.asarray(Image.fromarray(edges, mode="F").resize(LAYOUT_SHAPE[::-1], Image.BOX), dtype=np.float32)
+    vector = pooled.ravel() - pooled.mean()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SimilarityIndex:
+    """Compact visual descriptors of catalog images, memory-mapped, with batched kNN queries.
+
+    Each image gets a 64-bit perceptual hash of the whole frame (near-duplicate
+    shots), a color histogram of the garment and a color-blind edge layout of
+    the garment (same style in other colorways). The arrays are read with
+    mmap; images added since the last save are held in memory until save().
+    Safe to share between download threads.
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_DIR, analyzer: ColorAnalyzer = None,
+                 duplicate_distance: int = DUPLICATE_HASH_DISTANCE,
+                 duplicate_color: float = DUPLICATE_COLOR_SIMILARITY):
+        self.path = Path(path)
+        self.analyzer = analyzer or ColorAnalyzer(texture=False)
+        self.duplicate_distance = duplicate_distance
+        self.duplicate_color = duplicate_color
+        self.lock = threading.RLock()
+        self.keys = []
+        self.stats = {}
+        hashes = np.zeros((0, HASH_BYTES), dtype=np.uint8)
+        colors = np.zeros((0, COLOR_DIMS), dtype=np.float32)
+        layouts = np.zeros((0, LAYOUT_DIMS), dtype=np.float32)
+        saved = saved_directory(self.path)
+        if (saved / "manifest.json").exists():
+            with open(saved / "manifest.json", "r") as f:
+                manifest = json.load(f)
+            if manifest["version"] != FORMAT_VERSION:
+                raise ValueError(f"Unsupported similarity index format version {manifest['version']}")
+            self.keys = manifest["keys"]
+            self.stats = manifest["stats"]
+            if self.keys:
+                hashes = np.load(saved / "hashes.npy", mmap_mode="r")
+                colors = np.load(saved / "colors.npy", mmap_mode="r")
+                layouts = np.load(saved / "layouts.npy", mmap_mode="r")
+        self._base = (hashes, colors, layouts)
+        self._added = ([], [], [])
+        self._arrays = self._base
+        self._rows = {key: row for row, key in enumerate(self.keys)}
+        self._alive = np.ones(len(self.keys), dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+
+    def describe(self, image_path) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(hash, color histogram, layout) of one image."""
+        rgb = self.analyzer.load(image_path)
+        lab = srgb_to_lab(rgb)
+        mask = self.analyzer.segment(rgb, lab)
+        return difference_hash(rgb), color_histogram(lab[mask]), layout_vector(lab[..., 0], mask)
+
+    def is_current(self, key: str, image_path) -> bool:
+        """True if `key` is indexed and its file has not changed since."""
+        stat = os.stat(image_path)
+        return key in self._rows and self.stats.get(key) == [stat.st_size, stat.st_mtime]
+
+    def add(self, key: str, image_path=None, descriptor=None):
+        """Index (or re-index) an image under `key`; returns its descriptor."""
+        image_path = image_path or key
+        descriptor = descriptor or self.describe(image_path)
+        stat = os.stat(image_path)
+        with self.lock:
+            if key in self._rows:
+                self._alive[self._rows[key]] = False
+            else:
+                self.keys.append(key)
+            self._rows[key] = len(self._alive)
+            self._alive = np.append(self._alive, True)
+            for part, value in zip(self._added, descriptor):
+                part.append(value)
+            self.stats[key] = [stat.st_size, stat.st_mtime]
+            self._arrays = None
+        return descriptor
+
+    def index_directory(self, directory, pattern: str = "*.jpg") -> int:
+        """Describe images in `directory` that are new or changed since they were indexed."""
+        added = 0
+        for image_path in sorted(Path(directory).glob(pattern)):
+            if not self.is_current(str(image_path), image_path):
+                self.add(str(image_path), image_path)
+                added += 1
+        return added
+
+    def arrays(self):
+        """(hashes, colors, layouts, row keys, alive) over every row, memory-mapped rows first."""
+        with self.lock:
+            if self._arrays is None:
+                self._arrays = tuple(np.concatenate([base, np.array(added, dtype=base.dtype).reshape(-1, base.shape[1])])
+                                     if added else base for base, added in zip(self._base, self._added))
+            row_keys = [None] * len(self._alive)
+            for key, row in self._rows.items():
+                row_keys[row] = key
+            return (*self._arrays, row_keys, self._alive.copy())
+
+    def _descriptors(self, queries) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Stack query descriptors; queries are indexed keys, image paths or descriptors."""
+        hashes, colors, layouts = [], [], []
+        stored = None
+        for query in queries:
+            if isinstance(query, tuple):
+                descriptor = query
+            elif str(query) in self._rows:
+                stored = stored or self.arrays()
+                row = self._rows[str(query)]
+                descriptor = (stored[0][row], stored[1][row], stored[2][row])
+            else:
+                descriptor = self.describe(query)
+            hashes.append(descriptor[0])
+            colors.append(descriptor[1])
+            layouts.append(descriptor[2])
+        return np.array(hashes, dtype=np.uint8), np.array(colors, dtype=np.float32), np.array(layouts, dtype=np.float32)
+
+    def knn(self, queries, k: int = 5, color_weight: float = 0.5) -> List[List[Tuple[str, float]]]:
+        """The `k` most similar indexed images for each query, best first, as (key, score).
+
+        Scores blend color similarity and layout similarity; `color_weight=0`
+        looks for the same style regardless of color. A query that is an
+        indexed key never matches itself.
+        """
+        queries = list(queries)
+        _, query_colors, query_layouts = self._descriptors(queries)
+        _, colors, layouts, row_keys, alive = self.arrays()
+        scores = color_weight * (query_colors @ colors.T) + (1 - color_weight) * (query_layouts @ layouts.T)
+        scores[:, ~alive] = -np.inf
+        for n, query in enumerate(queries):
+            if not isinstance(query, tuple) and str(query) in self._rows:
+                scores[n, self._rows[str(query)]] = -np.inf
+        k = min(k, int(alive.sum()))
+        if k <= 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for n, candidates in enumerate(top):
+            order = candidates[np.argsort(-scores[n, candidates], kind="stable")]
+            results.append([(row_keys[row], float(scores[n, row])) for row in order if np.isfinite(scores[n, row])])
+        return results
+
+    def near_duplicates(self, queries) -> List[List[str]]:
+        """For each query, every indexed near-duplicate (other than itself), closest first."""
+        queries = list(queries)
+        query_hashes, query_colors, _ = self._descriptors(queries)
+        hashes, colors, _, row_keys, alive = self.arrays()
+        if not len(row_keys):
+            return [[] for _ in queries]
+        distances = hamming_distances(query_hashes, np.asarray(hashes))
+        matches = (distances <= self.duplicate_distance) & (query_colors @ colors.T >= self.duplicate_color) & alive
+        found = []
+        for n, query in enumerate(queries):
+            if not isinstance(query, tuple) and str(query) in self._rows:
+                matches[n, self._rows[str(query)]] = False
+            rows = np.flatnonzero(matches[n])
+            found.append([row_keys[row] for row in rows[np.argsort(distances[n, rows], kind="stable")]])
+        return found
+
+    def find_duplicates(self, queries) -> List[Optional[str]]:
+        """For each query, the closest indexed near-duplicate (other than itself), or None."""
+        return [keys[0] if keys else None for keys in self.near_duplicates(queries)]
+
+    def find_duplicate(self, query) -> Optional[str]:
+        return self.find_duplicates([query])[0]
+
+    def duplicate_groups(self, block: int = 1024) -> List[List[str]]:
+        """Groups of indexed images that are near-duplicates of each other."""
+        hashes, colors, _, row_keys, alive = self.arrays()
+        parent = list(range(len(row_keys)))
+
+        def find(row):
+            while parent[row] != row:
+                parent[row] = parent[parent[row]]
+                row = parent[row]
+            return row
+
+        hashes = np.asarray(hashes)
+        for start in range(0, len(row_keys), block):
+            distances = hamming_distances(hashes[start:start + block], hashes)
+            similar = colors[start:start + block] @ colors.T >= self.duplicate_color
+            pairs = np.argwhere((distances <= self.duplicate_distance) & similar & alive & alive[start:start + block, None])
+            for row, other in pairs:
+                if start + row < other:
+                    parent[find(start + row)] = find(other)
+        groups = {}
+        for row, key in enumerate(row_keys):
+            if key is not None and alive[row]:
+                groups.setdefault(find(row), []).append(key)
+        return [sorted(group) for group in groups.values() if len(group) > 1]
+
+    def save(self) -> str:
+        """Write the live rows to a new directory and swap it in (see result_store.swap_directory)."""
+        with self.lock:
+            hashes, colors, layouts, row_keys, alive = self.arrays()
+            rows = np.flatnonzero(alive)
+            keys = [row_keys[row] for row in rows]
+            tmp_dir = Path(str(self.path) + ".tmp")
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            tmp_dir.mkdir(parents=True)
+            np.save(tmp_dir / "hashes.npy", np.asarray(hashes)[rows])
+            np.save(tmp_dir / "colors.npy", np.asarray(colors)[rows])
+            np.save(tmp_dir / "layouts.npy", np.asarray(layouts)[rows])
+            with open(tmp_dir / "manifest.json", "w") as f:
+                json.dump({"version": FORMAT_VERSION, "keys": keys,
+                           "stats": {key: self.stats[key] for key in keys}}, f)
+            return swap_directory(tmp_dir, self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the visual similarity index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Index new and changed images")
+    build_parser.add_argument("images", nargs="?", default="shopbop_images")
+    similar_parser = subparsers.add_parser("similar", help="Print the images most like the given ones")
+    similar_parser.add_argument("queries", nargs="+", help="Indexed keys or image files")
+    similar_parser.add_argument("-k", type=int, default=5)
+    similar_parser.add_argument("--style", action="store_true",
+                                help="Ignore color, to find the same style in other colorways")
+    subparsers.add_parser("duplicates", help="Print groups of near-duplicate images")
+    parser.add_argument("--index", default=DEFAULT_INDEX_DIR)
+    args = parser.parse_args()
+
+    index = SimilarityIndex(args.index)
+    if args.command == "build":
+        added = index.index_directory(args.images)
+        index.save()
+        print(f"Indexed {added} new or changed images ({len(index)} total) in {args.index}")
+    elif args.command == "similar":
+        for query, neighbors in zip(args.queries, index.knn(args.queries, k=args.k,
+                                                             color_weight=0.0 if args.style else 0.5)):
+            print(query)
+            for key, score in neighbors:
+                print(f"  {score:.3f}  {key}")
+    else:
+        for group in index.duplicate_groups():
+            print("  ".join(group))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import json
+import logging
+import string
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from canonicalize import Vocabulary
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the keys, codes or prompt below change
+STRUCTURED_VERSION = 1
+
+# Enough for every field to carry a few codes
+STRUCTURED_MAX_TOKENS = 400
+
+KEY_ALPHABET = string.ascii_lowercase + string.ascii_uppercase
+
+VOCABULARY = Vocabulary()
+
+
+def _short_key(n: int) -> str:
+    key = ""
+    while True:
+        key = KEY_ALPHABET[n % len(KEY_ALPHABET)] + key
+        n = n // len(KEY_ALPHABET) - 1
+        if n < 0:
+            return key
+
+
+# One short key per template leaf, in template order, so the mapping is stable
+FIELDS = {_short_key(n): path for n, path in enumerate(VOCABULARY.leaves)}
+
+
+def _build_prompt(fields: Dict[str, str]) -> str:
+    legend = "\n".join(
+        f"{key} {path}: " + " | ".join(f"{code} {value}" for code, value in enumerate(VOCABULARY.leaves[path]))
+        for key, path in fields.items())
+    return f"""As a luxury knitwear design expert, analyze the design, color and style of the sweater/knit item in the image.
+
+Answer with one JSON object. Each key below is a field of the analysis; its value is the list of option numbers that describe the item, most prominent first. Use one option unless several clearly apply. Every key must be present.
+
+{legend}"""
+
+
+def _build_schema(fields: Dict[str, str]) -> Dict:
+    return {
+        "type": "object",
+        "properties": {
+            key: {"type": "array", "items": {"type": "integer", "enum": list(range(len(VOCABULARY.leaves[path])))}}
+            for key, path in fields.items()
+        },
+        "required": list(fields),
+        "additionalProperties": False,
+    }
+
+
+def _response_format(schema: Dict) -> Dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "sweater_analysis", "strict": True, "schema": schema},
+    }
+
+
+# Built once at import and never formatted per request, so every request shares
+# a byte-identical prefix and the provider's prompt cache can reuse it
+STRUCTURED_PROMPT = _build_prompt(FIELDS)
+
+SCHEMA = _build_schema(FIELDS)
+
+RESPONSE_FORMAT = _response_format(SCHEMA)
+
+
+@lru_cache(maxsize=None)
+def _variant(omit: Tuple[str, ...]):
+    # Keys stay the same when fields are left out, so records remain comparable
+    fields = {key: path for key, path in FIELDS.items() if path not in omit}
+    return fields, _build_prompt(fields), _response_format(_build_schema(fields))
+
+
+def structured_prompt(omit=()) -> str:
+    """STRUCTURED_PROMPT without the template leaves in `omit`."""
+    return _variant(tuple(omit))[1] if omit else STRUCTURED_PROMPT
+
+
+def response_format(omit=()) -> Dict:
+    """RESPONSE_FORMAT without the template leaves in `omit`."""
+    return _variant(tuple(omit))[2] if omit else RESPONSE_FORMAT
+
+
+def _codes(key: str, value) -> List[int]:
+    codes = value if isinstance(value, list) else [value]
+    options = VOCABULARY.leaves[FIELDS[key]]
+    valid = []
+    for code in codes:
+        if isinstance(code, bool) or not isinstance(code, int) or not 0 <= code < len(options):
+            raise ValueError(f"Invalid code {code!r} for field {key} ({FIELDS[key]})")
+        if code not in valid:
+            valid.append(code)
+    return valid
+
+
+def expand_response(payload: Dict, omit=()) -> Dict:
+    """Validate a compact {short key: [codes]} response and expand it into the template layout.
+
+    Fields with one option become a string and fields with several a list, as
+    in the free-form responses. Raises ValueError on unknown keys, missing keys
+    or out-of-range codes. Leaves in `omit` were not asked for and must be absent.
+    """
+    fields = _variant(tuple(omit))[0] if omit else FIELDS
+    if not isinstance(payload, dict):
+        raise ValueError("Structured response is not a JSON object")
+    unknown = set(payload) - set(fields)
+    if unknown:
+        raise ValueError(f"Unknown fields in structured response: {sorted(unknown)}")
+    missing = set(fields) - set(payload)
+    if missing:
+        raise ValueError(f"Missing fields in structured response: {sorted(missing)}")
+
+    analysis = {}
+    for key, path in fields.items():
+        values = [VOCABULARY.leaves[path][code] for code in _codes(key, payload[key])]
+        if not values:
+            continue
+        node = analysis
+        *parents, leaf = path.split(".")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = values[0] if len(values) == 1 else values
+    return analysis
+
+
+def verbose_tokens(analysis: Dict) -> int:
+    """Rough completion tokens the same analysis costs as indented free-form JSON."""
+    return len(json.dumps(analysis, indent=2)) // 4 + 1
+
+
+def log_savings(analysis: Dict, usage, label: str = ""):
+    """Log the completion tokens a structured response used against its verbose equivalent."""
+    if usage is None:
+        return
+    completion = usage.completion_tokens
+    verbose = verbose_tokens(analysis)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    logger.info("Structured output%s: %d completion tokens vs ~%d as verbose JSON (saved ~%d); "
+                "%d of %d prompt tokens cached", f" for {label}" if label else "", completion, verbose,
+                verbose - completion, cached, usage.prompt_tokens)
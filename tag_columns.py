@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from pattern_mining import record_attributes
+from result_store import DEFAULT_STORE, LEGACY_JSON, load_analysis, saved_directory, swap_directory
+
+DEFAULT_COLUMNS_DIR = "shopbop_tags"
+FORMAT_VERSION = 1
+
+
+def _write_strings(out_dir: Path, strings: List[str]):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(out_dir / "strings.bin", "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(out_dir / "string_offsets.npy", offsets)
+
+
+def compile_columns(data: Dict, out_dir: str = DEFAULT_COLUMNS_DIR) -> str:
+    """Compile analysis records into one integer-coded column per attribute path.
+
+    Every string (product keys and attribute values) is stored once in a shared
+    dictionary. Single-valued paths get a codes array with -1 for missing values;
+    paths where any product has several values get a CSR-style offsets array.
+    """
+    strings = {}
+
+    def code(value: str) -> int:
+        return strings.setdefault(value, len(strings))
+
+    product_keys = list(data)
+    product_codes = np.array([code(key) for key in product_keys], dtype=np.int32)
+    values_by_path = defaultdict(lambda: defaultdict(list))
+    for row, key in enumerate(product_keys):
+        for path, value in record_attributes(data[key]):
+            codes = values_by_path[path][row]
+            value_code = code(value)
+            if value_code not in codes:
+                codes.append(value_code)
+
+    tmp_dir = Path(str(out_dir) + ".tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    columns = {}
+    for n, path in enumerate(sorted(values_by_path)):
+        rows = values_by_path[path]
+        name = f"col{n:05d}"
+        if any(len(codes) > 1 for codes in rows.values()):
+            offsets = np.zeros(len(product_keys) + 1, dtype=np.int64)
+            for row, codes in rows.items():
+                offsets[row + 1] = len(codes)
+            np.cumsum(offsets, out=offsets)
+            flat = np.empty(offsets[-1], dtype=np.int32)
+            for row, codes in rows.items():
+                flat[offsets[row]:offsets[row + 1]] = codes
+            np.save(tmp_dir / f"{name}.offsets.npy", offsets)
+            np.save(tmp_dir / f"{name}.codes.npy", flat)
+            columns[path] = {"name": name, "multi": True}
+        else:
+            codes = np.full(len(product_keys), -1, dtype=np.int32)
+            for row, value_codes in rows.items():
+                codes[row] = value_codes[0]
+            np.save(tmp_dir / f"{name}.codes.npy", codes)
+            columns[path] = {"name": name, "multi": False}
+
+    np.save(tmp_dir / "products.npy", product_codes)
+    _write_strings(tmp_dir, list(strings))
+    with open(tmp_dir / "manifest.json", "w") as f:
+        json.dump({"version": FORMAT_VERSION, "products": len(product_keys),
+                   "strings": len(strings), "columns": columns}, f)
+
+    # Swap the finished directory in so readers never see a half-written store
+    return swap_directory(tmp_dir, out_dir)
+
+
+class TagColumns:
+    """Read-only, memory-mapped view of a compiled tag column store."""
+
+    def __init__(self, path: str = DEFAULT_COLUMNS_DIR):
+        self.path = saved_directory(path)
+        with open(self.path / "manifest.json", "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported tag column format version {manifest['version']}")
+        self.num_products = manifest["products"]
+        self._columns = manifest["columns"]
+        self._blob = np.memmap(self.path / "strings.bin", dtype=np.uint8, mode="r") \
+            if os.path.getsize(self.path / "strings.bin") else np.zeros(0, dtype=np.uint8)
+        self._string_offsets = np.load(self.path / "string_offsets.npy", mmap_mode="r")
+        self._products = np.load(self.path / "products.npy", mmap_mode="r")
+        self._loaded = {}
+        self._codes_by_string = None
+
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    def string(self, code: int) -> str:
+        start, end = self._string_offsets[code], self._string_offsets[code + 1]
+        return bytes(self._blob[start:end]).decode("utf-8")
+
+    def code(self, value: str) -> int:
+        """Dictionary code of `value`, or -1 when it never occurs."""
+        if self._codes_by_string is None:
+            self._codes_by_string = {self.string(n): n for n in range(len(self._string_offsets) - 1)}
+        return self._codes_by_string.get(value, -1)
+
+    def product_key(self, row: int) -> str:
+        return self.string(int(self._products[row]))
+
+    def product_keys(self) -> List[str]:
+        return [self.product_key(row) for row in range(self.num_products)]
+
+    def column(self, path: str):
+        """Return (codes, offsets) for a path; offsets is None for single-valued columns."""
+        if path not in self._loaded:
+            info = self._columns[path]
+            codes = np.load(self.path / f"{info['name']}.codes.npy", mmap_mode="r")
+            offsets = np.load(self.path / f"{info['name']}.offsets.npy", mmap_mode="r") if info["multi"] else None
+            self._loaded[path] = (codes, offsets)
+        return self._loaded[path]
+
+    def value_counts(self, path: str) -> Dict[str, int]:
+        """Number of products having each value of `path`."""
+        codes, _ = self.column(path)
+        present = codes[codes >= 0]
+        if not len(present):
+            return {}
+        values, counts = np.unique(present, return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+        return {self.string(int(values[n])): int(counts[n]) for n in order}
+
+    def rows_with(self, path: str, value: str) -> np.ndarray:
+        """Indices of the products that have `value` at `path`."""
+        code = self.code(value)
+        codes, offsets = self.column(path)
+        if code < 0:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.flatnonzero(codes == code)
+        if offsets is None:
+            return positions
+        return np.unique(np.searchsorted(offsets, positions, side="right") - 1)
+
+    def values_for(self, row: int, path: str) -> List[str]:
+        codes, offsets = self.column(path)
+        if offsets is None:
+            return [self.string(int(codes[row]))] if codes[row] >= 0 else []
+        return [self.string(int(c)) for c in codes[offsets[row]:offsets[row + 1]]]
+
+    def item_matrix(self, min_count: int = 1):
+        """One-hot (product_keys, items, matrix) in the layout used by pattern_mining."""
+        items = []
+        blocks = []
+        for path in self._columns:
+            codes, offsets = self.column(path)
+            if offsets is None:
+                rows = np.flatnonzero(codes >= 0)
+                values = codes[rows]
+            else:
+                rows = np.repeat(np.arange(self.num_products), np.diff(offsets))
+                values = np.asarray(codes)
+            if not len(values):
+                continue
+            unique, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+            keep = counts >= min_count
+            if not keep.any():
+                continue
+            remap = np.cumsum(keep) - 1
+            block = np.zeros((self.num_products, int(keep.sum())), dtype=bool)
+            selected = keep[inverse]
+            block[rows[selected], remap[inverse[selected]]] = True
+            blocks.append(block)
+            items.extend(f"{path}={self.string(int(code))}" for code in unique[keep])
+        matrix = np.hstack(blocks) if blocks else np.zeros((self.num_products, 0), dtype=bool)
+        return self.product_keys(), items, matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile and query the columnar tag store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser("compile", help="Compile analysis results into columns")
+    compile_parser.add_argument("source", nargs="?", default=None,
+                                help=f"Result store or legacy JSON (default: {DEFAULT_STORE} or {LEGACY_JSON})")
+    compile_parser.add_argument("output", nargs="?", default=DEFAULT_COLUMNS_DIR)
+    counts_parser = subparsers.add_parser("counts", help="Print value counts for an attribute path")
+    counts_parser.add_argument("path", nargs="?", help="Attribute path; omit to list the columns")
+    counts_parser.add_argument("--columns", default=DEFAULT_COLUMNS_DIR)
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        source = args.source or (DEFAULT_STORE if os.path.exists(DEFAULT_STORE) else LEGACY_JSON)
+        data = load_analysis(source)
+        print(f"Compiled {len(data)} products from {source} into {compile_columns(data, args.output)}")
+    else:
+        columns = TagColumns(args.columns)
+        if not args.path:
+            for path in columns.columns():
+                print(path)
+            return
+        for value, count in columns.value_counts(args.path).items():
+            print(f"{count:6d}  {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+import argparse
+import json
+import re
+import shutil
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from pattern_mining import record_attributes
+from result_store import DEFAULT_STORE, open_result_store, saved_directory, swap_directory
+
+DEFAULT_TAG_INDEX = "shopbop_tag_index"
+FORMAT_VERSION = 1
+
+# Postings holding more than this share of the products are stored as bitsets,
+# the rest as sorted id arrays (the same trade-off as roaring bitmaps' containers)
+DENSE_FRACTION = 1 / 32
+
+_POPCOUNT = np.array([bin(n).count("1") for n in range(256)], dtype=np.uint16)
+_TOKEN = re.compile(r'\s*(\(|\)|[^\s()"=]+="[^"]*"|"[^"]*"|[^\s()]+)')
+_KEYWORDS = {"and": "AND", "&": "AND", "or": "OR", "|": "OR", "not": "NOT", "!": "NOT"}
+
+
+def normalize_value(value: str) -> str:
+    """Case-, hyphen- and spacing-insensitive form of a value, e.g. "Cable-Knit" -> "cable knit"."""
+    return " ".join(re.split(r"[\s_\-]+", value.lower())).strip()
+
+
+def popcount(words: np.ndarray, axis=None):
+    """Number of set bits in a bitset (or per row of stacked bitsets with axis=1)."""
+    if hasattr(np, "bitwise_count"):
+        counts = np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+    else:
+        counts = _POPCOUNT[words.view(np.uint8)].sum(axis=axis, dtype=np.int64)
+    return int(counts) if axis is None else counts
+
+
+def ids_to_words(ids: np.ndarray, n_words: int) -> np.ndarray:
+    bits = np.zeros(n_words * 64, dtype=bool)
+    bits[ids] = True
+    return np.packbits(bits, bitorder="little").view(np.uint64)
+
+
+def words_to_ids(words: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder="little")).astype(np.uint32)
+
+
+class QueryError(ValueError):
+    pass
+
+
+class TagIndex:
+    """Inverted index from every attribute value to the products that have it.
+
+    Each "path=value" term of a product's canonical attributes (see
+    record_attributes) maps to a compressed posting: a sorted id array for rare
+    values, a bitset for common ones. Queries combine terms with AND, OR and NOT
+    as word-wide bit operations, so they take microseconds even on tens of
+    thousands of products. Product ids are never reused; removed products are
+    cleared from the live set. Updates are incremental: only records added or
+    replaced in the result store since the last update are read.
+    """
+
+    def __init__(self, path: str = DEFAULT_TAG_INDEX):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.keys: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.versions: Dict[str, Optional[str]] = {}
+        self.postings: Dict[str, np.ndarray] = {}
+        self._dense = {}
+        self._by_value = None
+        self._by_path = None
+        self._live = None
+        if (saved_directory(self.path) / "manifest.json").exists():
+            self._load()
+
+    def _load(self):
+        saved = saved_directory(self.path)
+        with open(saved / "manifest.json", "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported tag index format version {manifest['version']}")
+        self.keys = manifest["keys"]
+        self.ids = {key: n for n, key in enumerate(self.keys) if key is not None}
+        self.versions = manifest["versions"]
+        arrays = np.load(saved / "arrays.npy", mmap_mode="r")
+        bitsets = np.load(saved / "bitsets.npy", mmap_mode="r")
+        n_words = self._n_words()
+        for term, (kind, offset, length) in manifest["terms"].items():
+            if kind == "bitset":
+                self._dense[term] = np.asarray(bitsets[offset:offset + n_words])
+                self.postings[term] = None
+            else:
+                self.postings[term] = np.asarray(arrays[offset:offset + length])
+
+    def _n_words(self) -> int:
+        return (len(self.keys) + 63) // 64
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.ids
+
+    # Updates
+
+    def _postings_of(self, term: str) -> np.ndarray:
+        if self.postings.get(term) is None and term in self._dense:
+            self.postings[term] = words_to_ids(self._dense[term])
+        return self.postings.get(term, np.zeros(0, dtype=np.uint32))
+
+    def update(self, records: Dict[str, Optional[Dict]], versions: Dict[str, str] = None):
+        """Index (or re-index) the given records; a record of None removes its product."""
+        versions = versions or {}
+        added, replaced = defaultdict(list), []
+        with self.lock:
+            for key, record in records.items():
+                product_id = self.ids.get(key)
+                if product_id is not None:
+                    replaced.append(product_id)
+                if record is None:
+                    if product_id is not None:
+                        self.keys[product_id] = None
+                        del self.ids[key]
+                        self.versions.pop(key, None)
+                    continue
+                if product_id is None:
+                    product_id = self.ids[key] = len(self.keys)
+                    self.keys.append(key)
+                self.versions[key] = versions.get(key)
+                for term in {f"{path}={value}" for path, value in record_attributes(record)}:
+                    added[term].append(product_id)
+            touched = set(added)
+            if replaced:
+                # Clear replaced and removed products from every posting before adding their new terms
+                is_replaced = np.zeros(len(self.keys), dtype=bool)
+                is_replaced[replaced] = True
+                for term in list(self.postings):
+                    ids = self._postings_of(term)
+                    kept = ids[~is_replaced[ids]]
+                    if len(kept) != len(ids):
+                        self.postings[term] = kept
+                        touched.add(term)
+            for term in touched:
+                ids = self._postings_of(term)
+                if added.get(term):
+                    # Postings no longer hold these products, so no id is repeated
+                    ids = np.sort(np.concatenate((ids, np.array(added[term], dtype=np.uint32))))
+                if len(ids):
+                    self.postings[term] = ids
+                else:
+                    self.postings.pop(term, None)
+                self._dense.pop(term, None)
+            # New products grew the id space; bitsets of the right length are rebuilt on demand
+            n_words = self._n_words()
+            for term in [term for term, words in self._dense.items() if len(words) != n_words]:
+                self._postings_of(term)
+                del self._dense[term]
+            self._by_value = self._by_path = None
+            self._live = None
+
+    def update_from_store(self, store) -> Dict[str, int]:
+        """Index the records added or replaced in `store` since the last update and drop removed ones."""
+        current = store.versions()
+        changed = {key: store.get(key) for key, version in current.items()
+                   if key not in self.ids or self.versions.get(key) != version}
+        gone = {key: None for key in self.ids if key not in current}
+        self.update({**changed, **gone}, current)
+        return {"indexed": len(changed), "removed": len(gone), "products": len(self)}
+
+    def save(self):
+        """Write the index to a temporary directory and swap it in (see result_store.swap_directory)."""
+        with self.lock:
+            threshold = max(1, int(len(self.keys) * DENSE_FRACTION))
+            terms, arrays, bitsets = {}, [], []
+            array_offset = bitset_offset = 0
+            for term in sorted(self.postings):
+                ids = self._postings_of(term)
+                if len(ids) > threshold:
+                    words = self._words(term)
+                    terms[term] = ["bitset", bitset_offset, len(ids)]
+                    bitsets.append(words)
+                    bitset_offset += len(words)
+                else:
+                    terms[term] = ["array", array_offset, len(ids)]
+                    arrays.append(ids)
+                    array_offset += len(ids)
+            tmp_dir = Path(str(self.path) + ".tmp")
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            tmp_dir.mkdir(parents=True)
+            np.save(tmp_dir / "arrays.npy", np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint32))
+            np.save(tmp_dir / "bitsets.npy", np.concatenate(bitsets) if bitsets else np.zeros(0, dtype=np.uint64))
+            with open(tmp_dir / "manifest.json", "w") as f:
+                json.dump({"version": FORMAT_VERSION, "keys": self.keys, "versions": self.versions,
+                           "terms": terms}, f)
+            swap_directory(tmp_dir, self.path)
+
+    # Queries
+
+    def _words(self, term: str) -> np.ndarray:
+        words = self._dense.get(term)
+        if words is None:
+            words = self._dense[term] = ids_to_words(self._postings_of(term), self._n_words())
+        return words
+
+    def live(self) -> np.ndarray:
+        """Bitset of the products currently indexed (the universe NOT is taken against)."""
+        if self._live is None:
+            self._live = ids_to_words(np.array(list(self.ids.values()), dtype=np.uint32), self._n_words())
+        return self._live
+
+    def _build_lookups(self):
+        by_value, by_path = defaultdict(list), defaultdict(list)
+        for term in sorted(self.postings):
+            path, value = term.split("=", 1)
+            by_value[normalize_value(value)].append(term)
+            by_path[path].append(term)
+        self._by_value, self._by_path = by_value, by_path
+
+    def _terms_by_value(self) -> Dict[str, List[str]]:
+        if self._by_value is None:
+            self._build_lookups()
+        return self._by_value
+
+    def _terms_by_path(self) -> Dict[str, List[str]]:
+        if self._by_path is None:
+            self._build_lookups()
+        return self._by_path
+
+    def terms_for(self, text: str) -> List[str]:
+        """Terms matching a query term: "value" (any attribute) or "path=value".
+
+        Values match case-, hyphen- and spacing-insensitively. A path matches the
+        attribute paths containing its dot-separated segments in a row, so
+        "neckline=crew" matches design.style_details.neckline.style=Crew.
+        """
+        path, _, value = text.rpartition("=")
+        candidates = self._terms_by_value().get(normalize_value(value.strip('"')), [])
+        if not path:
+            return candidates
+        wanted = f".{path.lower()}."
+        return [term for term in candidates if wanted in f".{term.split('=', 1)[0].lower()}."]
+
+    def term_words(self, text: str) -> np.ndarray:
+        words = np.zeros(self._n_words(), dtype=np.uint64)
+        for term in self.terms_for(text):
+            words |= self._words(term)
+        return words
+
+    def evaluate(self, query: str) -> np.ndarray:
+        """Bitset of the products matching a boolean query.
+
+        Terms are combined with AND, OR and NOT (also &, | and !) and grouped with
+        parentheses; terms next to each other are ANDed. Values with spaces are
+        quoted or hyphenated: `cream cable-knit neckline=crew "drop shoulder"`.
+        """
+        tokens = [token for token in _TOKEN.findall(query) if token]
+        position = 0
+
+        def peek():
+            return _KEYWORDS.get(tokens[position].lower(), tokens[position]) if position < len(tokens) else None
+
+        def take():
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def parse_or():
+            words = parse_and()
+            while peek() == "OR":
+                take()
+                words = words | parse_and()
+            return words
+
+        def parse_and():
+            words = parse_not()
+            while peek() not in (None, "OR", ")"):
+                if peek() == "AND":
+                    take()
+                words = words & parse_not()
+            return words
+
+        def parse_not():
+            token = peek()
+            if token is None:
+                raise QueryError(f"Query ends unexpectedly: {query!r}")
+            if token == "NOT":
+                take()
+                return self.live() & ~parse_not()
+            if token == "(":
+                take()
+                words = parse_or()
+                if peek() != ")":
+                    raise QueryError(f"Missing closing parenthesis in {query!r}")
+                take()
+                return words
+            if token in ("AND", "OR", ")"):
+                raise QueryError(f"Unexpected {take()!r} in {query!r}")
+            return self.term_words(take())
+
+        with self.lock:
+            words = parse_or()
+            if position < len(tokens):
+                raise QueryError(f"Unexpected {tokens[position]!r} in {query!r}")
+            return words & self.live()
+
+    def query(self, query: str, limit: int = None) -> List[str]:
+        """Keys of the products matching `query`, in indexing order."""
+        ids = words_to_ids(self.evaluate(query))
+        return [self.keys[n] for n in ids[:limit]]
+
+    def count(self, query: str) -> int:
+        return popcount(self.evaluate(query))
+
+    def facets(self, query: str = None, paths: Iterable[str] = None, top: int = None) -> Dict[str, Dict[str, int]]:
+        """Per attribute path, the number of matching products having each value.
+
+        `query` of None counts over every product; `paths` narrows the attribute
+        paths the same way path terms do (e.g. "neckline").
+        """
+        with self.lock:
+            words = self.evaluate(query) if query else self.live()
+            wanted = [f".{path.lower()}." for path in paths] if paths else None
+            facets = {}
+            for path, terms in sorted(self._terms_by_path().items()):
+                if wanted and not any(w in f".{path.lower()}." for w in wanted):
+                    continue
+                # One popcount over the stacked bitsets of the path's values
+                matches = np.stack([self._words(term) for term in terms]) & words
+                counts = popcount(matches, axis=1)
+                values = sorted(((term.split("=", 1)[1], int(count)) for term, count in zip(terms, counts) if count),
+                                key=lambda item: -item[1])
+                if values:
+                    facets[path] = dict(values[:top])
+        return facets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and query the inverted tag index")
+    parser.add_argument('--index', default=DEFAULT_TAG_INDEX, help="Index directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="Index new and changed results")
+    update_parser.add_argument("store", nargs="?", default=DEFAULT_STORE)
+    query_parser = subparsers.add_parser("query", help="List the products matching a boolean query")
+    query_parser.add_argument("query", help='e.g. \'cream cable-knit neckline=crew NOT (sleeves=raglan OR "v neck")\'')
+    query_parser.add_argument("--limit", type=int, default=50)
+    query_parser.add_argument("--count", action="store_true", help="Only print the number of matches")
+    facets_parser = subparsers.add_parser("facets", help="Value counts per attribute among the matches")
+    facets_parser.add_argument("query", nargs="?", help="Restrict to the products matching this query")
+    facets_parser.add_argument("--path", action="append", help="Only facet these attribute paths")
+    facets_parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    index = TagIndex(args.index)
+    if args.command == "update":
+        store = open_result_store(args.store)
+        try:
+            stats = index.update_from_store(store)
+        finally:
+            store.close()
+        index.save()
+        print(f"Indexed {stats['indexed']} products, removed {stats['removed']}; "
+              f"{stats['products']} products in {args.index}")
+        return
+
+    start = time.perf_counter()
+    try:
+        if args.command == "query":
+            result = index.count(args.query) if args.count else index.query(args.query, limit=args.limit)
+        else:
+            result = index.facets(args.query, paths=args.path, top=args.top)
+    except QueryError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+    if args.command == "query" and args.count:
+        print(result)
+    elif args.command == "query":
+        print("\n".join(result))
+        print(f"{index.count(args.query)} matches")
+    else:
+        for path, values in result.items():
+            print(path)
+            for value, count in values.items():
+                print(f"  {count:6d}  {value}")
+    print(f"({elapsed * 1000:.2f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import image_to_tags
+from rate_limiter import RateLimiter
+from request_controller import RequestController
+
+IMAGE = sorted((Path(__file__).resolve().parent.parent / "shopbop_images").glob("*.jpg"))[0]
+TOKENS_PER_CALL = 2000
+ESTIMATE = 3000
+BUDGET = 60000
+
+
+def response(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                           usage=SimpleNamespace(total_tokens=TOKENS_PER_CALL, prompt_tokens=1500,
+                                                 completion_tokens=500))
+
+
+def client(contents, calls):
+    """A chat completions client answering with `contents` in turn; awaitable for the async client."""
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return response(contents[len(calls) - 1])
+
+    async def create_async(**kwargs):
+        return create(**kwargs)
+
+    completions = SimpleNamespace(create=create, create_async=create_async)
+    stub = SimpleNamespace(chat=SimpleNamespace(completions=completions), with_options=lambda **_: stub)
+    return stub
+
+
+def async_client(contents, calls):
+    stub = client(contents, calls)
+    stub.chat.completions.create = stub.chat.completions.create_async
+    return stub
+
+
+@pytest.fixture
+def controller(tmp_path):
+    return RequestController(base_delay=0, dead_letter_path=str(tmp_path / "dead_letter.jsonl"))
+
+
+def frozen_limiter(requests_per_minute=None):
+    """A limiter whose buckets do not refill, so what is left shows what was charged."""
+    limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=BUDGET)
+    for bucket in (limiter.request_bucket, limiter.token_bucket):
+        if bucket:
+            bucket.rate = 0.0
+    return limiter
+
+
+def spent(limiter):
+    return BUDGET - limiter.token_bucket.tokens
+
+
+def test_every_paid_retry_is_charged_once(monkeypatch, controller):
+    calls = []
+    monkeypatch.setattr(image_to_tags, "get_client", lambda: client(["not json", "{", '{"ok": true}'], calls))
+    limiter = frozen_limiter(requests_per_minute=600)
+    limiter.acquire(ESTIMATE)
+    analysis = image_to_tags.analyze_image(IMAGE, controller=controller, limiter=limiter, estimated_tokens=ESTIMATE)
+    assert analysis == {"ok": True}
+    assert len(calls) == 3
+    assert spent(limiter) == 3 * TOKENS_PER_CALL
+    # Each retry took another request from the requests-per-minute budget
+    assert 600 - limiter.request_bucket.tokens == 3
+
+
+def test_every_paid_retry_is_charged_once_async(monkeypatch, controller):
+    calls = []
+    monkeypatch.setattr(image_to_tags, "get_async_client",
+                        lambda: async_client(["not json", "{", '{"ok": true}'], calls))
+    limiter = frozen_limiter()
+
+    async def run():
+        await limiter.acquire_async(ESTIMATE)
+        return await image_to_tags.analyze_image_async(IMAGE, controller=controller, limiter=limiter,
+                                                       estimated_tokens=ESTIMATE)
+
+    assert asyncio.run(run()) == {"ok": True}
+    assert len(calls) == 3
+    assert spent(limiter) == 3 * TOKENS_PER_CALL
+
+
+def test_usage_of_a_failed_request_is_still_settled(monkeypatch, controller):
+    calls = []
+    monkeypatch.setattr(image_to_tags, "get_client", lambda: client(["not json"] * 3, calls))
+    limiter = frozen_limiter()
+    limiter.acquire(ESTIMATE)
+    assert image_to_tags.analyze_image(IMAGE, controller=controller, limiter=limiter,
+                                       estimated_tokens=ESTIMATE) is None
+    assert spent(limiter) == 3 * TOKENS_PER_CALL
+    assert controller.failed_keys == {str(IMAGE)}
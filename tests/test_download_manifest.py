@@ -0,0 +1,38 @@
+import pytest
+
+from download_manifest import DownloadManifest
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = DownloadManifest(str(tmp_path / "manifest.sqlite"))
+    yield manifest
+    manifest.close()
+
+
+def test_failed_fetch_keeps_a_listed_product(manifest, tmp_path):
+    files = {}
+    for n in (1, 2):
+        files[n] = tmp_path / f"{n}.jpg"
+        files[n].write_bytes(b"image %d" % n)
+    manifest.start_run()
+    manifest.record("p1", "added", image_url="http://img/1.jpg", filename=str(files[1]), content_hash="h1")
+    manifest.record("p2", "added", image_url="http://img/2.jpg", filename=str(files[2]), content_hash="h2")
+    manifest.finish_run()
+
+    manifest.start_run()
+    manifest.record("p1", "failed", image_url="http://img/1-new.jpg")
+    report = manifest.finish_run()
+    assert report["removed"] == ["p2"]
+    assert report["failed"] == 1
+    assert [product["product_key"] for product in manifest.products()] == ["p1"]
+    product = manifest.get("p1")
+    assert product["image_url"] == "http://img/1-new.jpg"
+    assert (product["filename"], product["content_hash"]) == (str(files[1]), "h1")
+
+
+def test_failed_fetch_of_an_unknown_product_is_not_recorded(manifest):
+    manifest.start_run()
+    manifest.record("p1", "failed", image_url="http://img/1.jpg")
+    assert manifest.finish_run()["failed"] == 1
+    assert manifest.get("p1") is None
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+import pytest
+
+import image_downloader
+from image_downloader import fetch
+
+
+class ThrottlingSession:
+    """Answers every request with a 503 asking to retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return SimpleNamespace(status_code=503, headers={"Retry-After": self.retry_after}, close=lambda: None)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(image_downloader.time, "sleep", sleeps.append)
+    monkeypatch.setattr(image_downloader.random, "uniform", lambda low, high: 1.0)
+    return sleeps
+
+
+def test_retry_after_replaces_a_shorter_backoff(sleeps, tmp_path):
+    session = ThrottlingSession("5")
+    assert fetch(session, "http://img/1.jpg", str(tmp_path / "1.part"), retries=3, backoff=1.0) is None
+    assert session.requests == 4
+    # One wait per retry, none after the last attempt
+    assert sleeps == [5, 5, 5]
+
+
+def test_a_longer_backoff_wins_over_retry_after(sleeps, tmp_path):
+    session = ThrottlingSession("1")
+    fetch(session, "http://img/1.jpg", str(tmp_path / "1.part"), retries=3, backoff=2.0)
+    assert sleeps == [2.0, 4.0, 8.0]
@@ -0,0 +1,83 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import image_to_tags
+from multi_image import MAX_OUTPUT_TOKENS, AdaptiveBatchSize, images_per_request, split_results
+
+IMAGES = sorted((Path(__file__).resolve().parent.parent / "shopbop_images").glob("*.jpg"))[:3]
+
+
+def test_split_results_keeps_valid_entries_by_id():
+    payload = {"results": [{"id": "2", "analysis": {"color": "red"}}, {"id": " 1 ", "analysis": {"color": "blue"}}]}
+    assert split_results(payload, ["1", "2"]) == {"1": {"color": "blue"}, "2": {"color": "red"}}
+    assert split_results(json.dumps(payload), ["1", "2"]) == {"1": {"color": "blue"}, "2": {"color": "red"}}
+
+
+def test_split_results_drops_unknown_repeated_and_invalid_entries():
+    payload = {"results": [
+        {"id": "1", "analysis": {"color": "red"}},
+        {"id": "1", "analysis": {"color": "blue"}},
+        {"id": "3", "analysis": {"color": "green"}},
+        {"id": "2", "analysis": "not an object"},
+        "not an entry",
+        {"analysis": {"color": "pink"}},
+    ]}
+    assert split_results(payload, ["1", "2"]) == {"1": {"color": "red"}}
+
+
+@pytest.mark.parametrize("payload", [[], {"results": {}}, {"analysis": {}}, "[]"])
+def test_split_results_rejects_responses_without_a_results_list(payload):
+    with pytest.raises(ValueError):
+        split_results(payload, ["1"])
+
+
+def test_adaptive_batch_size_halves_on_incomplete_and_grows_on_complete():
+    size = AdaptiveBatchSize(maximum=8)
+    size.on_response(8, 5)
+    assert size.size == 4
+    size.on_response(4, 0)
+    size.on_response(2, 1)
+    size.on_response(1, 0)
+    assert size.size == 1
+    size.on_response(1, 1)
+    assert size.size == 2
+    assert size.stats["fallbacks"] == 3 + 4 + 1 + 1
+
+
+def test_images_per_request_fits_output_and_token_budget():
+    assert images_per_request(500, 800, 1000, maximum=100) == MAX_OUTPUT_TOKENS // 1000
+    assert images_per_request(500, 800, 1000, token_budget=5000, maximum=100) == 2
+    assert images_per_request(500, 800, 1000, token_budget=100, maximum=100) == 1
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.acquired, self.settled = [], []
+
+    def acquire(self, tokens=0):
+        self.acquired.append(tokens)
+
+    def record_usage(self, estimated, actual):
+        self.settled.append((estimated, actual))
+
+
+def test_batch_fallbacks_acquire_their_own_tokens(monkeypatch):
+    # A batched request that fails outright sends every image on its own
+    failing = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **_: 1 / 0)))
+    monkeypatch.setattr(image_to_tags, "get_client", lambda: failing)
+    calls = []
+
+    def analyze_image(image_path, *args, limiter=None, estimated_tokens=None, **kwargs):
+        calls.append((image_path, limiter, estimated_tokens))
+        return {"image": str(image_path)}
+
+    monkeypatch.setattr(image_to_tags, "analyze_image", analyze_image)
+    limiter = RecordingLimiter()
+    analyses = image_to_tags.analyze_image_batch(IMAGES, limiter=limiter, estimated_tokens=20000)
+    single = image_to_tags.estimated_tokens_for()
+    assert analyses == {image_path: {"image": str(image_path)} for image_path in IMAGES}
+    assert limiter.acquired == [single] * len(IMAGES)
+    assert calls == [(image_path, limiter, single) for image_path in IMAGES]
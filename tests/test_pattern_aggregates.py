@@ -0,0 +1,116 @@
+from collections import Counter
+
+import pytest
+
+from pattern_aggregates import PatternAggregates, record_items
+from result_store import open_result_store
+
+
+def record(*items):
+    canonical = {}
+    for item in items:
+        path, value = item.split("=")
+        canonical.setdefault(path, []).append(value)
+    return {"analysis": {}, "canonical": canonical}
+
+
+def recount(records):
+    """Item and pair counts computed from scratch, to compare the running ones with."""
+    items, pairs = Counter(), Counter()
+    for rec in records:
+        product_items = record_items(rec)
+        items.update(product_items)
+        pairs.update((a, b) for n, a in enumerate(product_items) for b in product_items[n + 1:])
+    return items, pairs
+
+
+class DictStore:
+    """The part of the result store interface update_from_store reads, with removal."""
+
+    def __init__(self):
+        self.records, self.changes, self.reads = {}, 0, 0
+
+    def put(self, key, rec):
+        self.changes += 1
+        self.records[key] = (str(self.changes), rec)
+
+    def remove(self, key):
+        del self.records[key]
+
+    def versions(self):
+        return {key: version for key, (version, _) in self.records.items()}
+
+    def get(self, key):
+        self.reads += 1
+        return self.records[key][1]
+
+
+@pytest.fixture
+def aggregates(tmp_path):
+    aggregates = PatternAggregates(str(tmp_path / "aggregates.sqlite"))
+    yield aggregates
+    aggregates.close()
+
+
+def assert_counts_match(aggregates, store):
+    items, pairs = recount(rec for _, rec in store.records.values())
+    assert +aggregates.item_counts == items
+    assert +aggregates.pair_counts == pairs
+
+
+def test_update_counts_added_changed_and_removed_records(aggregates):
+    store = DictStore()
+    store.put("a", record("color=red", "neck=crew"))
+    store.put("b", record("color=blue", "neck=crew"))
+    assert aggregates.update_from_store(store) == {"added": 2, "changed": 0, "removed": 0, "unchanged": 0}
+    assert_counts_match(aggregates, store)
+
+    store.put("a", record("color=red", "neck=v"))
+    store.put("c", record("color=red", "neck=crew", "knit=cable"))
+    store.remove("b")
+    assert aggregates.update_from_store(store) == {"added": 1, "changed": 1, "removed": 1, "unchanged": 0}
+    assert_counts_match(aggregates, store)
+    assert aggregates.item_counts["color=blue"] == 0
+
+
+def test_update_reads_only_new_or_replaced_records(aggregates):
+    store = DictStore()
+    store.put("a", record("color=red"))
+    store.put("b", record("color=blue"))
+    aggregates.update_from_store(store)
+    store.reads = 0
+    store.put("b", record("color=blue"))
+    # Rewritten with the same attributes: read once, counts untouched
+    assert aggregates.update_from_store(store) == {"added": 0, "changed": 0, "removed": 0, "unchanged": 2}
+    assert store.reads == 1
+    assert aggregates.update_from_store(store)["unchanged"] == 2
+    assert store.reads == 1
+
+
+def test_counts_survive_reopening(aggregates, tmp_path):
+    store = DictStore()
+    store.put("a", record("color=red", "neck=crew"))
+    store.put("b", record("color=red", "neck=v"))
+    aggregates.update_from_store(store)
+    digest = aggregates.digest()
+
+    reopened = PatternAggregates(str(tmp_path / "aggregates.sqlite"))
+    try:
+        store.remove("a")
+        assert reopened.update_from_store(store)["removed"] == 1
+        assert_counts_match(reopened, store)
+        assert reopened.digest() != digest
+    finally:
+        reopened.close()
+
+
+def test_update_from_a_result_store(aggregates, tmp_path):
+    store = open_result_store(str(tmp_path / "results.jsonl"))
+    try:
+        store.put("a", record("color=red", "neck=crew"))
+        assert aggregates.update_from_store(store)["added"] == 1
+        store.put("a", record("color=blue", "neck=crew"))
+        assert aggregates.update_from_store(store)["changed"] == 1
+        assert dict(+aggregates.item_counts) == {"color=blue": 1, "neck=crew": 1}
+    finally:
+        store.close()
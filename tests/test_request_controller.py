@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from request_controller import BAD_RESPONSE, PERMANENT, RequestController, classify_error
+
+
+@pytest.fixture
+def controller(tmp_path):
+    return RequestController(base_delay=0, dead_letter_path=str(tmp_path / "dead_letter.jsonl"))
+
+
+@pytest.mark.parametrize("exc", [ValueError("Missing fields"), json.JSONDecodeError("Expecting value", "x", 0)])
+def test_invalid_content_is_a_bad_response(exc):
+    assert classify_error(exc) == BAD_RESPONSE
+
+
+@pytest.mark.parametrize("exc", [TypeError("bug"), AttributeError("bug"), IndexError("bug"), KeyError("bug")])
+def test_programming_errors_are_permanent(exc):
+    assert classify_error(exc) == PERMANENT
+
+
+def test_bad_responses_are_retried_a_limited_number_of_times(controller):
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise ValueError("Response has no content")
+
+    assert controller.call("image", request) is None
+    assert len(calls) == 3
+    assert controller.failed_keys == {"image"}
+
+
+def test_programming_errors_fail_without_another_call(controller):
+    calls = []
+
+    def request():
+        calls.append(1)
+        return None.choices
+
+    assert controller.call("image", request) is None
+    assert len(calls) == 1
+    assert controller.dead_letters.entries()["image"]["error_class"] == PERMANENT
@@ -0,0 +1,66 @@
+import pytest
+
+from tag_index import QueryError, TagIndex
+
+
+def record(**canonical):
+    return {"analysis": {}, "canonical": {path.replace("__", "."): values for path, values in canonical.items()}}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = TagIndex(str(tmp_path / "tag_index"))
+    index.update({
+        "red-crew": record(colors__primary=["Red"], design__neckline=["Crew"]),
+        "red-v": record(colors__primary=["Red"], design__neckline=["V-Neck"]),
+        "blue-crew": record(colors__primary=["Blue"], design__neckline=["Crew"], design__knit=["Cable Knit"]),
+        "gone": record(colors__primary=["Green"], design__neckline=["Crew"]),
+    })
+    index.update({"gone": None})
+    return index
+
+
+def test_terms_are_anded_and_ored(index):
+    assert index.query("red crew") == ["red-crew"]
+    assert index.query("red AND crew") == ["red-crew"]
+    assert index.query("red & crew") == ["red-crew"]
+    assert index.query("red OR blue") == ["red-crew", "red-v", "blue-crew"]
+    assert index.query("blue | v-neck") == ["red-v", "blue-crew"]
+
+
+def test_parentheses_group_before_and(index):
+    assert index.query("(red OR blue) AND crew") == ["red-crew", "blue-crew"]
+    assert index.query("red OR (blue AND v-neck)") == ["red-crew", "red-v"]
+
+
+def test_values_match_loosely_and_paths_narrow_them(index):
+    assert index.query('"cable knit"') == ["blue-crew"]
+    assert index.query("Cable-Knit") == ["blue-crew"]
+    assert index.query("neckline=crew") == ["red-crew", "blue-crew"]
+    assert index.query("primary=crew") == []
+
+
+def test_not_is_taken_over_the_live_products(index):
+    # "gone" was removed, so negating a term must not bring it back
+    assert index.query("NOT red") == ["blue-crew"]
+    assert index.query("! red") == ["blue-crew"]
+    assert index.count("NOT nothing-matches") == 3
+    assert index.query("crew NOT blue") == ["red-crew"]
+
+
+def test_removed_products_do_not_match(index):
+    assert index.query("green") == []
+    assert len(index) == 3
+
+
+@pytest.mark.parametrize("query", ["", "red AND", "(red OR blue", "red)", "OR red", "NOT"])
+def test_malformed_queries_raise(index, query):
+    with pytest.raises(QueryError):
+        index.evaluate(query)
+
+
+def test_saved_index_answers_the_same(index, tmp_path):
+    index.save()
+    loaded = TagIndex(str(tmp_path / "tag_index"))
+    assert loaded.query("(red OR blue) AND NOT v-neck") == ["red-crew", "blue-crew"]
+    assert loaded.count("crew") == 2
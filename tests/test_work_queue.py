@@ -0,0 +1,130 @@
+import pytest
+
+from result_store import open_result_store
+from work_queue import DONE, FAILED, LEASED, PENDING, WorkQueue, run_worker
+
+# A lease that is already over when it is granted
+EXPIRED = -1.0
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=2)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = open_result_store(str(tmp_path / "results.jsonl"))
+    yield store
+    store.close()
+
+
+def attempts(queue, key):
+    return queue.conn.execute("SELECT attempts FROM tasks WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_live_lease_is_not_handed_out_again(queue):
+    queue.add(["a", "b"])
+    _, keys = queue.claim("w1", batch_size=8, ttl=300)
+    assert keys == ["a", "b"]
+    assert queue.claim("w2", batch_size=8, ttl=300)[1] == []
+    assert queue.counts()[LEASED] == 2
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(queue):
+    queue.add(["a", "b"])
+    first, _ = queue.claim("w1", ttl=EXPIRED)
+    second, keys = queue.claim("w2", ttl=300)
+    assert keys == ["a", "b"]
+    assert second != first
+    assert queue.heartbeat(first) == 0
+    assert queue.heartbeat(second) == 2
+
+
+def test_late_result_from_expired_lease_is_accepted_once(queue):
+    queue.add(["a"])
+    first, _ = queue.claim("w1", ttl=EXPIRED)
+    second, _ = queue.claim("w2", ttl=300)
+    assert queue.complete("a", first, {"by": "w1"})
+    # The task is done, so the worker now holding the lease keeps the first result
+    assert not queue.complete("a", second, {"by": "w2"})
+    assert [(key, result) for _, key, result in queue.results_since()] == [("a", {"by": "w1"})]
+    assert queue.counts()[DONE] == 1
+
+
+def test_failures_use_up_the_attempt_budget(queue):
+    queue.add(["a"])
+    for _ in range(2):
+        token, keys = queue.claim("w1")
+        assert keys == ["a"]
+        queue.fail("a", token, "boom")
+    assert queue.claim("w1")[1] == []
+    assert queue.counts()[FAILED] == 1
+    assert queue.retry_failed() == 1
+    assert queue.claim("w1")[1] == ["a"]
+
+
+def test_expired_leases_use_up_the_attempt_budget(queue):
+    queue.add(["a"])
+    queue.claim("w1", ttl=EXPIRED)
+    queue.claim("w2", ttl=EXPIRED)
+    assert queue.claim("w3")[1] == []
+    assert queue.counts()[FAILED] == 1
+
+
+def test_fail_with_a_stale_token_is_ignored(queue):
+    queue.add(["a"])
+    first, _ = queue.claim("w1", ttl=EXPIRED)
+    queue.claim("w2", ttl=300)
+    queue.fail("a", first, "boom")
+    assert queue.counts()[LEASED] == 1
+
+
+def test_release_does_not_count_an_attempt(queue):
+    queue.add(["a"])
+    token, _ = queue.claim("w1")
+    queue.release(token)
+    assert attempts(queue, "a") == 0
+    assert queue.counts()[PENDING] == 1
+
+
+def test_run_worker_completes_stored_keys_and_fails_the_rest(queue, store):
+    queue.add(["a", "b", "c"])
+
+    def process(keys):
+        for key in keys:
+            if key != "b":
+                store.put(key, {"analysis": {"key": key}})
+
+    stats = run_worker(queue, process, store, worker="w1", batch_size=2)
+    assert stats == {"batches": 2, "completed": 2, "duplicates": 0, "failed": 2}
+    assert queue.counts() == {PENDING: 0, LEASED: 0, DONE: 2, FAILED: 1}
+
+
+def test_run_worker_releases_the_lease_when_processing_raises(queue, store):
+    queue.add(["a", "b"])
+
+    def process(keys):
+        raise RuntimeError("worker crashed")
+
+    with pytest.raises(RuntimeError):
+        run_worker(queue, process, store, worker="w1")
+    assert queue.counts()[PENDING] == 2
+    assert attempts(queue, "a") == attempts(queue, "b") == 0
+
+
+def test_run_worker_merges_results_of_other_workers(queue, store):
+    queue.add(["a", "b"])
+    token, keys = queue.claim("other", batch_size=1)
+    queue.complete(keys[0], token, {"analysis": {"by": "other"}})
+
+    def process(keys):
+        for key in keys:
+            store.put(key, {"analysis": {"by": "w1"}})
+
+    stats = run_worker(queue, process, store, worker="w1")
+    assert stats["completed"] == 1
+    assert store.get("a") == {"analysis": {"by": "other"}}
+    assert store.get("b") == {"analysis": {"by": "w1"}}
@@ -0,0 +1,274 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE = "analysis_queue.sqlite"
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_LEASE_TTL = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+# How long an idle worker waits before looking for expired leases again
+DEFAULT_POLL_INTERVAL = 10.0
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Lease-based work queue in SQLite, shared by workers in several processes or hosts.
+
+    Workers claim batches of tasks under a lease that expires after `ttl`
+    seconds unless it is renewed by a heartbeat, so the tasks of a crashed
+    worker are handed out again. Results are stored with their task, and only
+    the first result for a task is kept: a late result from a worker whose lease
+    expired is accepted if nobody finished the task meanwhile, and ignored
+    otherwise. A task that fails `max_attempts` times is marked failed.
+
+    The database uses a rollback journal rather than WAL, which needs shared
+    memory, so it also works on a network filesystem. Lease expiry uses wall
+    clock time, so the hosts' clocks must be in sync (NTP).
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = Path(path)
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Transactions are begun explicitly, so claims take the write lock up front
+        self.conn = sqlite3.connect(str(self.path), timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                lease_token TEXT,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                result TEXT,
+                done_seq INTEGER,
+                updated_at TEXT NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tasks_done_seq ON tasks (done_seq)")
+        self.merged_seq = 0
+
+    @contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def add(self, keys: Iterable[str]) -> int:
+        """Queue tasks for `keys`; keys already queued (in any state) are left alone."""
+        now = datetime.now().isoformat()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO tasks (key, status, updated_at) VALUES (?, ?, ?)",
+                             ((key, PENDING, now) for key in keys))
+            return conn.total_changes - before
+
+    def claim(self, worker: str, batch_size: int = DEFAULT_BATCH_SIZE, ttl: float = DEFAULT_LEASE_TTL):
+        """Lease up to `batch_size` pending or expired tasks; returns (lease token, keys)."""
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            # A task whose every lease expired probably kills its worker; stop handing it out
+            conn.execute("UPDATE tasks SET status = ?, error = 'lease expired', lease_token = NULL, "
+                         "lease_expires = NULL WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                         (FAILED, LEASED, now, self.max_attempts))
+            rows = conn.execute(
+                "SELECT key, status FROM tasks WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                "ORDER BY attempts, key LIMIT ?", (PENDING, LEASED, now, batch_size)).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = ?, lease_token = ?, worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE key = ?",
+                ((LEASED, token, worker, now + ttl, datetime.now().isoformat(), key) for key, _ in rows))
+        reclaimed = sum(1 for _, status in rows if status == LEASED)
+        if reclaimed:
+            logger.warning("Reclaimed %d tasks from expired leases", reclaimed)
+            metrics.count("leases_reclaimed", reclaimed)
+        return token, [key for key, _ in rows]
+
+    def heartbeat(self, token: str, ttl: float = DEFAULT_LEASE_TTL) -> int:
+        """Extend the lease `token`; returns the number of tasks it still holds."""
+        with self._transaction() as conn:
+            return conn.execute("UPDATE tasks SET lease_expires = ? WHERE lease_token = ? AND status = ?",
+                                (time.time() + ttl, token, LEASED)).rowcount
+
+    @contextmanager
+    def keep_alive(self, token: str, ttl: float = DEFAULT_LEASE_TTL):
+        """Renew the lease `token` every third of `ttl` on a background thread while the block runs."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(ttl / 3):
+                try:
+                    if not self.heartbeat(token, ttl):
+                        logger.warning("Lease %s no longer holds any tasks", token)
+                except sqlite3.Error as e:
+                    logger.warning("Heartbeat for lease %s failed: %s", token, e)
+
+        thread = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, key: str, token: str, result: Dict) -> bool:
+        """Store the result of a task; False if another worker had already finished it."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status, lease_token FROM tasks WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] == DONE:
+                return False
+            if row[1] != token:
+                logger.info("Accepting the late result for %s from an expired lease", key)
+            seq = conn.execute("SELECT COALESCE(MAX(done_seq), 0) + 1 FROM tasks").fetchone()[0]
+            conn.execute("UPDATE tasks SET status = ?, result = ?, done_seq = ?, error = NULL, lease_token = NULL, "
+                         "lease_expires = NULL, updated_at = ? WHERE key = ?",
+                         (DONE, json.dumps(result, ensure_ascii=False), seq, datetime.now().isoformat(), key))
+        return True
+
+    def fail(self, key: str, token: str, error: str):
+        """Give a task back after a failed attempt, or mark it failed once it ran out of attempts."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, "
+                "lease_token = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE key = ? AND lease_token = ? AND status = ?",
+                (self.max_attempts, FAILED, PENDING, error[:500], datetime.now().isoformat(), key, token, LEASED))
+
+    def release(self, token: str):
+        """Give back the unfinished tasks of a lease without counting an attempt."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE tasks SET status = ?, attempts = MAX(attempts - 1, 0), lease_token = NULL, "
+                         "lease_expires = NULL, updated_at = ? WHERE lease_token = ? AND status = ?",
+                         (PENDING, datetime.now().isoformat(), token, LEASED))
+
+    def retry_failed(self) -> int:
+        """Queue the failed tasks again with a fresh attempt budget."""
+        with self._transaction() as conn:
+            return conn.execute("UPDATE tasks SET status = ?, attempts = 0, updated_at = ? WHERE status = ?",
+                                (PENDING, datetime.now().isoformat(), FAILED)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            counts = dict.fromkeys((PENDING, LEASED, DONE, FAILED), 0)
+            counts.update(self.conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def results_since(self, seq: int = 0):
+        """(done_seq, key, result) of the tasks finished after `seq`, in completion order."""
+        with self.lock:
+            rows = self.conn.execute("SELECT done_seq, key, result FROM tasks WHERE done_seq > ? ORDER BY done_seq",
+                                     (seq,)).fetchall()
+        return [(done_seq, key, json.loads(result)) for done_seq, key, result in rows]
+
+    def merge_into(self, store) -> int:
+        """Copy the results finished since the last merge into `store`; returns the number written.
+
+        Idempotent: a result the store already holds is not written again.
+        """
+        merged = 0
+        for seq, key, result in self.results_since(self.merged_seq):
+            if store.get(key) != result:
+                store.put(key, result)
+                merged += 1
+            self.merged_seq = seq
+        return merged
+
+    def close(self):
+        self.conn.close()
+
+
+def run_worker(queue: WorkQueue, process: Callable[[List[str]], None], store, worker: Optional[str] = None,
+               batch_size: int = DEFAULT_BATCH_SIZE, ttl: float = DEFAULT_LEASE_TTL,
+               poll_interval: float = DEFAULT_POLL_INTERVAL) -> Dict[str, int]:
+    """Claim and process batches of tasks until the queue has none left.
+
+    `process(keys)` does the work and puts each successful result in `store`
+    under its key; afterwards every key of the batch is completed with the
+    stored record, or failed if there is none. Results finished by other workers
+    are merged into `store` before each claim. While other workers still hold
+    leases, an idle worker polls every `poll_interval` seconds so it can take
+    over the tasks of one that crashed.
+    """
+    worker = worker or default_worker_id()
+    stats = {"batches": 0, "completed": 0, "duplicates": 0, "failed": 0}
+    while True:
+        queue.merge_into(store)
+        token, keys = queue.claim(worker, batch_size, ttl)
+        if not keys:
+            if not queue.counts()[LEASED]:
+                break
+            with metrics.timer("lease_poll_wait"):
+                time.sleep(poll_interval)
+            continue
+        stats["batches"] += 1
+        logger.info("Leased %d tasks (%s)", len(keys), token)
+        try:
+            with queue.keep_alive(token, ttl):
+                process(keys)
+        except BaseException:
+            queue.release(token)
+            raise
+        for key in keys:
+            record = store.get(key)
+            if record is None:
+                queue.fail(key, token, "analysis failed")
+                stats["failed"] += 1
+            elif queue.complete(key, token, record):
+                stats["completed"] += 1
+            else:
+                # Another worker finished it after our lease expired; keep theirs
+                stats["duplicates"] += 1
+    queue.merge_into(store)
+    logger.info("Worker %s finished: %d batches, %d completed, %d failed, %d duplicates",
+                worker, stats["batches"], stats["completed"], stats["failed"], stats["duplicates"])
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or maintain the analysis work queue")
+    parser.add_argument('command', choices=['status', 'retry-failed'])
+    parser.add_argument('--queue', default=DEFAULT_QUEUE, help="Work queue database")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    try:
+        if args.command == 'retry-failed':
+            print(f"Queued {queue.retry_failed()} failed tasks again")
+        print(", ".join(f"{status} {count}" for status, count in queue.counts().items()))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()